@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+'''
+Compare peak RSS and wall time of the tarball download paths
+
+The legacy path reads the whole response in memory and hashes the
+file back in one read, the streaming path is get_latest_wp()
+Each run happens in a fresh child process so that ru_maxrss only
+accounts for that run
+'''
+import argparse
+import hashlib
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import build_project  # noqa: E402
+from bench.standins import LocalServer, make_fake_tarball  # noqa: E402
+
+
+def legacy_download(url, md5_url, dest):
+    latest_md5 = urlopen(md5_url).read().decode('UTF-8')
+    with urlopen(url) as tarball_resp:
+        with open(dest, 'wb') as tarball:
+            tarball.write(tarball_resp.read())
+    with open(dest, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest() == latest_md5
+
+
+def streaming_download(url, md5_url, dest):
+    # Neither the lookup and store of the artifact cache belong in the
+    # timing, nor the fake tarball in the cache of the user
+    build_project.wp_cache['dir'] = None
+    build_project.wp_latest['url'] = url
+    build_project.wp_latest['md5'] = md5_url
+    build_project.wp_latest['file'] = dest
+    return build_project.get_latest_wp()
+
+
+modes = {
+    'legacy': legacy_download,
+    'streaming': streaming_download,
+    }
+
+
+def child(args):
+    dest = os.path.join(args.workdir, '%s.tar.gz' % args.child)
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        ok = modes[args.child](args.url, args.md5_url, dest)
+        sys.stdout = stdout
+    wall = time.perf_counter() - start
+    os.remove(dest)
+    print(json.dumps({
+        'mode': args.child,
+        'ok': ok,
+        'wall': wall,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256,
+                        help='Size of the fake tarball in MB')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--child', choices=modes.keys(),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--md5-url', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        return child(args)
+
+    workdir = tempfile.mkdtemp()
+    make_fake_tarball(workdir, args.size * 1024 * 1024)
+    results = {}
+    with LocalServer(workdir) as server:
+        for mode in modes:
+            for r in range(args.rounds):
+                out = subprocess.check_output([
+                    sys.executable, os.path.abspath(__file__),
+                    '--child', mode,
+                    '--url', server.url('wordpress-latest.tar.gz'),
+                    '--md5-url', server.url('wordpress-latest.tar.gz.md5'),
+                    '--workdir', workdir])
+                run = json.loads(out.decode('UTF-8'))
+                if not run['ok']:
+                    print('%s download did not verify' % mode)
+                    return 1
+                results.setdefault(mode, []).append(run)
+
+    print('%d MB tarball, best of %d rounds' % (args.size, args.rounds))
+    print('%-10s %10s %14s' % ('mode', 'wall (s)', 'peak RSS (MB)'))
+    for mode, runs in results.items():
+        print('%-10s %10.3f %14.1f' % (mode,
+                                       min(r['wall'] for r in runs),
+                                       min(r['peak_rss'] for r in runs) /
+                                       1024))
+    for name in os.listdir(workdir):
+        os.remove(os.path.join(workdir, name))
+    os.rmdir(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+'''
+Compare the extraction of a synthetic WordPress-like archive
+
+The legacy path is the rmtree() and extractall() that
+extract_wp_tarball() used to do, the other ones are
+extract_wp_tarball() with a single writer thread, with the default
+writer pool and with each external gzip decompressor available
+Every run starts from an empty directory, the no-change run extracts
+the same tarball a second time
+'''
+import argparse
+import io
+import os
+import random
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import build_project  # noqa: E402
+
+
+def make_archive(path, files):
+    '''
+    Write a tarball of files PHP-like files of 1KB to 32KB spread in
+    nested directories like a WordPress release
+    '''
+    rand = random.Random(42)
+    words = [b'function', b'return', b'$wp_query', b'array(', b'if (',
+             b'esc_html', b'<?php', b'echo', b'}', b'{', b';\n']
+    with tarfile.open(path, 'w:gz') as tar:
+        for i in range(files):
+            name = 'wordpress/wp-%s/dir%02d/file%04d.php' % (
+                rand.choice(['admin', 'includes', 'content']), i % 40, i)
+            size = rand.randint(1024, 32 * 1024)
+            content = b' '.join(rand.choice(words)
+                                for w in range(size // 6))[:size]
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = 1500000000
+            tar.addfile(info, io.BytesIO(content))
+
+
+def legacy_extract():
+    if os.path.exists(build_project.wp_latest['dir']):
+        shutil.rmtree(build_project.wp_latest['dir'])
+    new_wp = tarfile.open(build_project.wp_latest['file'], 'r')
+    new_wp.extractall()
+    new_wp.close()
+    return True
+
+
+def quiet(function):
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            return function()
+        finally:
+            sys.stdout = stdout
+
+
+def clean():
+    for name in ('wordpress', 'wordpress.manifest', 'releases'):
+        if os.path.islink(name) or os.path.isfile(name):
+            os.remove(name)
+        elif os.path.isdir(name):
+            shutil.rmtree(name)
+    # Do not let the writeback of the previous run skew the next one
+    os.sync()
+
+
+def timed(function, rounds, warm=False):
+    best = None
+    for r in range(rounds):
+        clean()
+        if warm:
+            quiet(function)
+            os.sync()
+        start = time.perf_counter()
+        if not quiet(function):
+            raise RuntimeError('extraction failed')
+        wall = time.perf_counter() - start
+        best = wall if best is None else min(best, wall)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=3000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    root = os.getcwd()
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)
+    make_archive(build_project.wp_latest['file'], args.files)
+
+    workers = build_project.wp_extract['workers']
+    runs = [('legacy extractall', legacy_extract, {})]
+    runs.append(('1 writer, gzip module', build_project.extract_wp_tarball,
+                 {'workers': 1, 'gzip': []}))
+    runs.append(('%d writers, gzip module' % workers,
+                 build_project.extract_wp_tarball, {'gzip': []}))
+    for command in build_project.wp_extract['gzip']:
+        if shutil.which(command[0]):
+            runs.append(('%d writers, %s' % (workers, command[0]),
+                         build_project.extract_wp_tarball,
+                         {'gzip': [command]}))
+
+    print('%d files, %d CPUs, best of %d rounds' % (args.files,
+                                                    os.cpu_count(),
+                                                    args.rounds))
+    print('%-28s %10s %12s' % ('mode', 'cold (s)', 'no-change (s)'))
+    defaults = dict(build_project.wp_extract)
+    try:
+        for name, function, settings in runs:
+            build_project.wp_extract.update(defaults)
+            build_project.wp_extract.update(settings)
+            cold = timed(function, args.rounds)
+            warm = timed(function, args.rounds, warm=True)
+            print('%-28s %10.3f %12.3f' % (name, cold, warm))
+    finally:
+        build_project.wp_extract.update(defaults)
+        os.chdir(root)
+        shutil.rmtree(workdir)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+'''
+Time the stages of build_project.main() against local stand-ins
+
+The tarball is served by a local HTTP server, the php-fpm repository
+is a file:// git repository and the docker client is a fake one
+recording the build contexts, so the benchmark runs offline
+Each round builds a project from scratch with empty caches (cold),
+another project with the caches left by the first one (warm), then
+the second project again (no-change)
+The best times are compared with a baseline saved by --save-baseline
+on the same host, the benchmark fails when a stage got slower than the
+baseline allows or when there is no baseline
+'''
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+import build_project  # noqa: E402
+from bench.standins import LocalServer, FakeDockerClient, \
+    make_wordpress_tarball, make_php_fpm_repo  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ['cold', 'warm', 'no-change']
+PROJECT_FILES = ['docker-compose.yml', 'wp-config.template',
+                 'wp_automate.template', 'php-fpm_entrypoint.sh.template',
+                 'docker-compose.override.yml.template',
+                 'mariadb.cnf.template',
+                 'wordpress.conf.template', 'php-fpm-pool.template',
+                 'opcache.template']
+
+
+def make_project(path):
+    '''
+    Project directory holding the files of this repository the build
+    reads
+    '''
+    os.makedirs(os.path.join(path, 'apache-vhost'))
+    for name in PROJECT_FILES:
+        shutil.copy(os.path.join(ROOT, name), path)
+    return path
+
+
+def reset_state(workdir):
+    '''
+    Empty the artifact cache and the php-fpm mirror, and forget what
+    this process kept in memory, like a new build host would
+    '''
+    for name in ('cache', 'mirror.git'):
+        if os.path.exists(os.path.join(workdir, name)):
+            shutil.rmtree(os.path.join(workdir, name))
+    build_project._template_envs.clear()
+    build_project._configs.clear()
+
+
+def run_main(project, metrics):
+    '''
+    Run build_project.main() in project
+    Returns its wall time and the wall time of each of its stages
+    '''
+    if os.path.exists(metrics):
+        os.remove(metrics)
+    cwd, argv = os.getcwd(), sys.argv
+    sys.argv = ['build_project.py', '--metrics', metrics]
+    os.chdir(project)
+    with open(os.devnull, 'w') as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            start = time.perf_counter()
+            ok = build_project.main()
+            wall = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+            sys.argv = argv
+            os.chdir(cwd)
+    if not ok:
+        raise RuntimeError('build of %s failed' % project)
+    with open(metrics) as f:
+        stages = dict((record['stage'], record['wall_seconds'])
+                      for record in map(json.loads, f))
+    stages['main'] = wall
+    return stages
+
+
+def run_round(workdir, client_box, metrics):
+    reset_state(workdir)
+    client_box[0] = FakeDockerClient()
+    times = {}
+    for scenario, project in (('cold', 'cold'), ('warm', 'warm'),
+                              ('no-change', 'warm')):
+        path = os.path.join(workdir, 'projects', project)
+        if scenario != 'no-change':
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            make_project(path)
+        times[scenario] = run_main(path, metrics)
+    return times
+
+
+def compare(results, baseline, tolerance, min_delta):
+    '''
+    Stages slower than their baseline by more than tolerance, and by
+    more than min_delta seconds to ignore the noise of the short ones
+    '''
+    regressions = []
+    for scenario, stages in sorted(results.items()):
+        for stage, wall in sorted(stages.items()):
+            base = baseline.get(scenario, {}).get(stage)
+            if base is None:
+                continue
+            if wall > base * (1 + tolerance) and wall - base > min_delta:
+                regressions.append((scenario, stage, base, wall))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=1800,
+                        help='Files of the synthetic WordPress tarball')
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--baseline',
+                        default=os.path.join(ROOT, 'bench',
+                                             'pipeline_baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Store the times of this run as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Slowdown allowed over the baseline '
+                        '(default: %(default)s)')
+    parser.add_argument('--min-delta', type=float, default=0.05,
+                        help='Slowdown in seconds always allowed '
+                        '(default: %(default)s)')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    srvdir = os.path.join(workdir, 'www')
+    os.mkdir(srvdir)
+    make_wordpress_tarball(srvdir, args.files)
+    repo = make_php_fpm_repo(os.path.join(workdir, 'bitnami-docker-php-fpm'))
+
+    # Fresh for every round, see run_round()
+    client_box = [None]
+    saved = [dict(config) for config in (build_project.wp_latest,
+                                         build_project.wp_cache,
+                                         build_project.wp_extract,
+                                         build_project.php_fpm)]
+    from_env = build_project.docker.from_env
+    build_project.docker.from_env = lambda: client_box[0]
+    results = {}
+    builds = []
+    try:
+        with LocalServer(srvdir) as server:
+            build_project.wp_latest.update({
+                'url': server.url('wordpress-latest.tar.gz'),
+                'md5': server.url('wordpress-latest.tar.gz.md5')})
+            build_project.wp_cache['dir'] = os.path.join(workdir, 'cache')
+            build_project.wp_extract['gid'] = os.getgid()
+            build_project.php_fpm.update({
+                'url': repo, 'update': True,
+                'mirror': os.path.join(workdir, 'mirror.git')})
+            for r in range(args.rounds):
+                times = run_round(workdir, client_box,
+                                  os.path.join(workdir, 'metrics.jsonl'))
+                builds = client_box[0].images.builds
+                for scenario, stages in times.items():
+                    best = results.setdefault(scenario, {})
+                    for stage, wall in stages.items():
+                        best[stage] = min(best.get(stage, wall), wall)
+    finally:
+        build_project.docker.from_env = from_env
+        for config, values in zip((build_project.wp_latest,
+                                   build_project.wp_cache,
+                                   build_project.wp_extract,
+                                   build_project.php_fpm), saved):
+            config.clear()
+            config.update(values)
+        shutil.rmtree(workdir)
+
+    stages = sorted(set(stage for times in results.values()
+                        for stage in times), key=lambda s: (s == 'main', s))
+    print('%d files, %d CPUs, best of %d rounds' % (args.files,
+                                                    os.cpu_count(),
+                                                    args.rounds))
+    print('%-12s' % 'stage' + ''.join('%12s' % s for s in SCENARIOS))
+    for stage in stages:
+        print('%-12s' % stage + ''.join(
+            '%11.3fs' % results[s][stage] if stage in results[s]
+            else '%12s' % '-' for s in SCENARIOS))
+    for build in builds:
+        print('Image %s : context of %d files, %.1f KB' % (
+            build['tag'], build['context_files'],
+            build['context_bytes'] / 1024))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Baseline saved to %s' % args.baseline)
+        return 0
+    if not os.path.exists(args.baseline):
+        print('No baseline in %s, record one for this host with '
+              '"make bench-baseline" or --save-baseline' % args.baseline,
+              file=sys.stderr)
+        return 1
+    with open(args.baseline) as f:
+        regressions = compare(results, json.load(f), args.tolerance,
+                              args.min_delta)
+    for scenario, stage, base, wall in regressions:
+        print('Regression : %s %s took %.3fs, baseline %.3fs' % (
+            scenario, stage, wall, base))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
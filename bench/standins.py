@@ -0,0 +1,270 @@
+'''
+Local stand-ins for the network services used by build_project.py
+so that the tests and benchmarks can run offline on a plain Linux box
+'''
+import hashlib
+import io
+import os
+import random
+import re
+import socket
+import subprocess
+import tarfile
+import threading
+
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import docker
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    '''
+    Static file handler that does not log every request on stderr
+    '''
+    def log_message(self, format, *args):
+        pass
+
+
+class RangeHandler(QuietHandler):
+    '''
+    Static file handler honouring single 'bytes=N-' Range requests
+    Every byte count queued in the server's cuts list drops the
+    connection of the next response after that many bytes of body,
+    to emulate a flaky network
+    '''
+    range_regex = re.compile(r'^bytes=(\d+)-$')
+
+    def send_head(self):
+        self.server.ranges.append(self.headers.get('Range'))
+        match = self.range_regex.match(self.headers.get('Range', ''))
+        if not match:
+            return super().send_head()
+
+        path = self.translate_path(self.path)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self.send_error(404)
+            return None
+        size = os.fstat(f.fileno()).st_size
+        start = int(match.group(1))
+        if start >= size:
+            f.close()
+            self.send_error(416)
+            return None
+
+        f.seek(start)
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range',
+                         'bytes %d-%d/%d' % (start, size - 1, size))
+        self.send_header('Content-Length', str(size - start))
+        self.end_headers()
+        return f
+
+    def end_headers(self):
+        self.send_header('Accept-Ranges', 'bytes')
+        super().end_headers()
+
+    def copyfile(self, source, outputfile):
+        if not self.server.cuts:
+            return super().copyfile(source, outputfile)
+        outputfile.write(source.read(self.server.cuts.pop(0)))
+        outputfile.flush()
+        self.connection.shutdown(socket.SHUT_RDWR)
+        self.close_connection = True
+
+
+class KeepAliveHandler(QuietHandler):
+    '''
+    Static file handler keeping the connections open like apache does,
+    the pages ending with / are sent in chunks like PHP output
+    Every connection accepted is counted in the server's connections
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        self.server.connections = getattr(self.server, 'connections', 0) + 1
+
+    def do_GET(self):
+        if not self.path.split('?')[0].endswith('/'):
+            return super().do_GET()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for chunk in (b'<html>', b'<body>WordPress</body>', b'</html>'):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+        self.wfile.write(b'0\r\n\r\n')
+
+
+class LocalServer(object):
+    '''
+    Serve a directory over HTTP on a random localhost port
+    from a background thread
+    '''
+    def __init__(self, root, handler=RangeHandler):
+        self.root = root
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0),
+                                         partial(handler, directory=root))
+        # Range headers received and connection cuts, see RangeHandler
+        self.httpd.ranges = []
+        self.httpd.cuts = []
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+
+    @property
+    def ranges(self):
+        return self.httpd.ranges
+
+    @property
+    def cuts(self):
+        return self.httpd.cuts
+
+    def url(self, name):
+        return 'http://127.0.0.1:%d/%s' % (self.httpd.server_port, name)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def make_fake_tarball(root, size, name='wordpress-latest.tar.gz'):
+    '''
+    Write size bytes of random data as name in root along with its
+    .md5 file, the same way wordpress.org publishes them
+    Returns the MD5 of the generated file
+    '''
+    checksum = hashlib.md5()
+    block = 1024 * 1024
+    with open(os.path.join(root, name), 'wb') as tarball:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(block, remaining))
+            tarball.write(chunk)
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    with open(os.path.join(root, '%s.md5' % name), 'w') as md5:
+        md5.write(checksum.hexdigest())
+    return checksum.hexdigest()
+
+
+def make_wordpress_tarball(root, files, name='wordpress-latest.tar.gz',
+                           version='4.8.1'):
+    '''
+    Write a tarball of files PHP, CSS and JS files of 1KB to 32KB spread
+    in nested directories like a WordPress release, with its
+    wp-includes/version.php, as name in root along with its .md5 file
+    Returns the MD5 of the generated file
+    '''
+    rand = random.Random(42)
+    words = [b'function', b'return', b'$wp_query', b'array(', b'if (',
+             b'esc_html', b'<?php', b'echo', b'}', b'{', b';\n']
+    path = os.path.join(root, name)
+    with tarfile.open(path, 'w:gz') as tar:
+        def add(name, content):
+            info = tarfile.TarInfo('wordpress/%s' % name)
+            info.size = len(content)
+            info.mode = 0o644
+            info.mtime = 1500000000
+            tar.addfile(info, io.BytesIO(content))
+
+        add('wp-includes/version.php',
+            ("<?php\n$wp_version = '%s';\n" % version).encode('UTF-8'))
+        for i in range(files):
+            size = rand.randint(1024, 32 * 1024)
+            content = b' '.join(rand.choice(words)
+                                for w in range(size // 6))[:size]
+            add('wp-%s/dir%02d/file%04d.%s' % (
+                rand.choice(['admin', 'includes', 'content']), i % 40, i,
+                rand.choice(['php', 'php', 'php', 'css', 'js'])), content)
+
+    with open(path, 'rb') as tarball:
+        checksum = hashlib.md5(tarball.read()).hexdigest()
+    with open('%s.md5' % path, 'w') as md5:
+        md5.write(checksum)
+    return checksum
+
+
+def make_php_fpm_repo(path, version='5.6'):
+    '''
+    Create a git repository laid out like bitnami-docker-php-fpm, with
+    a version directory holding a Dockerfile and a rootfs and the tag of
+    its release, to be cloned through a file:// url
+    '''
+    os.makedirs(os.path.join(path, version, 'rootfs'))
+    with open(os.path.join(path, version, 'Dockerfile'), 'w') as dfile:
+        dfile.write('FROM bitnami/minideb-extras:jessie-r14\n'
+                    'ENV BITNAMI_APP_NAME="php-fpm" \\\n'
+                    '    BITNAMI_IMAGE_VERSION="%s.31-r0"\n'
+                    'COPY rootfs /\n'
+                    'ENTRYPOINT ["/app-entrypoint.sh"]\n'
+                    'CMD ["php-fpm", "-F"]\n' % version)
+    with open(os.path.join(path, version, 'rootfs',
+                           'app-entrypoint.sh'), 'w') as entrypoint:
+        entrypoint.write('#!/bin/bash\nexec "$@"\n')
+    git = ['git', '-C', path, '-c', 'user.name=bench',
+           '-c', 'user.email=bench@localhost']
+    subprocess.check_call(git[:3] + ['init', '-q'])
+    subprocess.check_call(git + ['add', '.'])
+    subprocess.check_call(git + ['commit', '-q', '-m', 'php-fpm %s' %
+                                 version])
+    # Tagged with the release of the image, the default php_fpm['ref']
+    subprocess.check_call(git[:3] + ['tag', '%s.31-r0' % version])
+    return 'file://%s' % os.path.abspath(path)
+
+
+class FakeImage(object):
+    def __init__(self, tag, labels=None):
+        self.tags = [tag]
+        self.labels = labels or {}
+
+
+class FakeImages(object):
+    '''
+    Images collection of FakeDockerClient, every build records the
+    number of files and bytes of its context
+    '''
+    def __init__(self):
+        self.images = {}
+        self.builds = []
+
+    def get(self, tag):
+        if tag not in self.images:
+            raise docker.errors.ImageNotFound(tag)
+        return self.images[tag]
+
+    def build(self, path=None, tag=None, labels=None, fileobj=None,
+              custom_context=False, encoding=None, **kwargs):
+        files = size = 0
+        if custom_context:
+            data = fileobj.read()
+            size = len(data)
+            with tarfile.open(fileobj=io.BytesIO(data),
+                              mode='r:gz' if encoding == 'gzip' else 'r') \
+                    as tar:
+                files = sum(1 for member in tar if member.isfile())
+        else:
+            for top, dirs, names in os.walk(path):
+                for name in names:
+                    files += 1
+                    size += os.lstat(os.path.join(top, name)).st_size
+        self.builds.append({'tag': tag, 'context_files': files,
+                            'context_bytes': size})
+        self.images[tag] = FakeImage(tag, labels)
+        return self.images[tag], iter([])
+
+
+class FakeDockerClient(object):
+    '''
+    Docker client keeping the images it builds in memory, for the code
+    paths of build_project.py that do not run containers
+    '''
+    def __init__(self):
+        self.images = FakeImages()
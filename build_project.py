@@ -1,5 +1,7 @@
 #!/usr/bin/python3
 import urllib.error
+import http.client
+import socket
 import os
 import sys
 import tarfile
@@ -9,40 +11,660 @@ import docker
 import subprocess
 import re
 import argparse
+import contextlib
+import fcntl
+import resource
+import json
+import threading
+import time
+import io
+import gzip
+import shlex
+import glob
+import tempfile
+import asyncio
+import random
 
-from urllib.request import urlopen
-from jinja2 import FileSystemLoader, Environment, exceptions
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    as_completed, wait, FIRST_COMPLETED
+
+from urllib.request import urlopen, Request
+from urllib.parse import urlsplit
+import yaml
+from jinja2 import FileSystemLoader, FileSystemBytecodeCache, Environment, \
+    exceptions
+from jinja2.bccache import Bucket
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 wp_latest = {
     'file': 'latest.tar.gz',
     'url': 'https://wordpress.org/wordpress-latest.tar.gz',
     'md5': 'https://wordpress.org/wordpress-latest.tar.gz.md5',
     'dir': './wordpress',
+    # Versioned source trees, dir points to their current symlink
+    'releases': './releases',
+    # Releases kept around for rollbacks
+    'keep': 3,
+    }
+
+wp_cache = {
+    # Shared by all the projects of a build host, None disables the cache
+    'dir': os.environ.get('WP_CACHE_DIR',
+                          os.path.expanduser('~/.cache/bitnami-project')),
+    # Least recently used releases are evicted above that size
+    'max_size': 1024 * 1024 * 1024,
+    # Least recently used compiled templates are evicted above that count
+    'max_templates': 256,
+    }
+
+wp_extract = {
+    # Threads writing the extracted files
+    'workers': min(32, (os.cpu_count() or 1) * 2),
+    # External decompressors tried in order before the gzip module,
+    # they run on their own core(s) while we hash and write the files
+    'gzip': [['pigz', '-dc'], ['igzip', '-dc']],
+    # Group owning the source tree, daemon in the bitnami images
+    'gid': 1,
+    }
+
+wp_precompress = {
+    # Encodings of the siblings written next to the static assets, in the
+    # order Apache prefers them, br is skipped without the brotli module
+    'encodings': ['br', 'gzip'],
+    # Extensions of the assets and the type they are served with
+    'types': {
+        'css': 'text/css',
+        'js': 'application/javascript',
+        'svg': 'image/svg+xml',
+        'json': 'application/json',
+        'ttf': 'font/ttf',
+        'eot': 'application/vnd.ms-fontobject',
+        },
+    # Smaller files are served as they are
+    'min_size': 256,
+    # Threads compressing the files, zlib and brotli release the GIL
+    'workers': os.cpu_count() or 1,
+    }
+
+php_fpm = {
+    'url': 'https://github.com/bitnami/bitnami-docker-php-fpm.git',
+    # Bare mirror refreshed with git fetch, shared by all the projects
+    # of a build host, a file:// url or a path works offline
+    'mirror': os.environ.get(
+        'PHP_FPM_MIRROR',
+        os.path.expanduser('~/.cache/bitnami-project/'
+                           'bitnami-docker-php-fpm.git')),
+    # Tag or commit the image is built from, the release of the upstream
+    # image the compose files use, so that every build host gets the same
+    # image until it is changed here, a branch follows upstream
+    'ref': os.environ.get('PHP_FPM_REF', '5.6.31-r0'),
+    # Only this directory of the repository is checked out
+    'version': '5.6',
+    # Fetch upstream before the checkout, the batch mode does it once for
+    # all its projects
+    'update': True,
+    }
+
+php_fpm_tuning = {
+    # CPUs and memory in MB given to php-fpm, None detects them from the
+    # cgroup limits of the build host
+    'cpus': None,
+    'memory': None,
+    # Memory used by a child serving WordPress, in MB
+    'child_memory': 64,
+    # Requests served by a child before it is recycled, bounds leaks
+    'max_requests': 500,
+    # New releases are switched to behind the current symlink without
+    # restarting php-fpm, opcache has to notice the files changed there
+    'validate_timestamps': True,
+    # Where the bitnami image reads extra pool and PHP settings from
+    'pool_conf': '/opt/bitnami/php/etc/php-fpm.d/zz-tuning.conf',
+    'opcache_ini': '/opt/bitnami/php/etc/conf.d/opcache.ini',
+    }
+
+php_fpm_startup = {
+    # Seconds the entrypoint waits for mariadb, php-fpm is then started
+    # without installing WordPress
+    'deadline': 120,
+    # First and longest delay between two probes of mariadb, in ms, the
+    # delay doubles after every failed probe
+    'backoff_min': 20,
+    'backoff_max': 250,
+    # Written by the entrypoint once WordPress is installed, the
+    # healthcheck of docker-compose.override.yml looks for it
+    'marker': '/tmp/php-fpm.ready',
+    'healthcheck_interval': '10s',
+    'healthcheck_timeout': '2s',
+    'healthcheck_retries': 3,
+    }
+
+mariadb_tuning = {
+    # Memory in MB given to mariadb when the project declares no
+    # MARIADB_MEMORY budget, as a share of the memory available here
+    'memory_share': 0.25,
+    # Memory held by each connection for its sort, join and read
+    # buffers, in MB, set aside before sizing the buffer pool
+    'connection_memory': 4,
+    # Connections allowed on top of the one of each php-fpm child, for
+    # wp_automate.php, cron and the mysql client
+    'extra_connections': 10,
+    # Off: its single lock serializes the php-fpm children and every
+    # write to wp_options empties it, the buffer pool keeps the pages
+    'query_cache_size': 0,
+    # Where the mariadb image reads extra settings from, the rendered
+    # mariadb.cnf is mounted there by docker-compose.override.yml
+    'conf': '/bitnami/mariadb/conf/my_custom.cnf',
+    # Indexes wp_automate.php adds to the tables of every site, by
+    # table name without its prefix
+    'indexes': {
+        # Every page load reads the autoloaded options
+        'options': {'autoload': 'autoload'},
+        # get_post_meta() and meta_query look up by post and key, and
+        # by key and value
+        'postmeta': {'post_id_meta_key': 'post_id, meta_key(191)',
+                     'meta_key_value': 'meta_key(191), meta_value(32)'},
+        },
+    }
+
+db_snapshot = {
+    # Seed the database of new stacks with a snapshot of a database where
+    # WordPress is already installed, see --db-snapshot
+    'enabled': False,
+    # Data directory of the mariadb service, only seeded when empty
+    'data_dir': './mariadb-data',
+    # Snapshots are kept there when the artifact cache is disabled
+    'dir': './.db-snapshots',
+    # Seconds given to the throwaway stack to install WordPress
+    'timeout': 300,
+    }
+
+apache_vhost = {
+    'server_name': 'wordpress.example.com',
+    # Compression of the text responses, brotli needs mod_brotli which
+    # Apache only ships from 2.4.26 on
+    'deflate': True,
+    'brotli': False,
+    'compress_types': ['text/html', 'text/plain', 'text/css', 'text/xml',
+                       'application/javascript', 'application/json',
+                       'application/xml', 'image/svg+xml'],
+    # Lifetime in seconds of the static assets of wp-content and
+    # wp-includes, WordPress versions its scripts and styles in their URL
+    'static_max_age': 365 * 24 * 3600,
+    'static_extensions': ['css', 'js', 'png', 'jpe?g', 'gif', 'svg', 'ico',
+                          'webp', 'woff2?', 'ttf', 'eot'],
+    # FastCGI connections to php-fpm kept by each Apache process, max
+    # defaults to its number of threads
+    'fcgi_reuse': True,
+    'fcgi_max': None,
+    'fcgi_connect_timeout': 5,
+    'fcgi_timeout': 300,
+    }
+
+loadtest = {
+    # Where apache listens, the requests carry the server name of the
+    # vhost in their Host header like a browser would
+    'url': 'http://127.0.0.1:80',
+    # Seconds measured, after the warmup ones which fill opcache and the
+    # connection pools
+    'duration': 30,
+    'warmup': 5,
+    # Clients running at the same time, each keeps its connection open
+    'concurrency': 16,
+    'timeout': 10,
+    # Share of each kind of request in the mix, and the paths requested
+    'mix': {'home': 4, 'login': 1, 'static': 4, 'rest': 1},
+    'paths': {
+        'home': ['/'],
+        'login': ['/wp-login.php'],
+        'static': ['/wp-includes/css/dashicons.min.css',
+                   '/wp-includes/js/jquery/jquery.js',
+                   '/wp-includes/js/wp-emoji-release.min.js',
+                   '/wp-content/themes/twentyseventeen/style.css'],
+        # Works without pretty permalinks, unlike /wp-json/
+        'rest': ['/?rest_route=/wp/v2/posts'],
+        },
+    # A pool size of the sweep is only picked when it failed less often
+    'max_error_rate': 0.01,
+    }
+
+# cgroup filesystem the CPU and memory limits are read from
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Sizes of the opcache hash table, max_accelerated_files is rounded up
+# to one of them by PHP
+OPCACHE_PRIMES = [223, 463, 983, 1979, 3907, 7963, 16229, 32531, 65407,
+                  130987, 262237, 524521, 1048793]
+
+# Size of the blocks used to stream and hash the tarball
+CHUNK_SIZE = 64 * 1024
+
+# Number of times a dropped tarball transfer is resumed before giving up
+DOWNLOAD_ATTEMPTS = 5
+
+# ioctl cloning a whole file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+# Size in bytes up to which the docker build context is kept in memory,
+# larger ones go to a temporary file
+CONTEXT_MEMORY = 64 * 1024 * 1024
+
+# Image label holding the hash of the inputs of the custom php-fpm image
+IMAGE_INPUTS_LABEL = 'bitnami-project.inputs'
+
+# Checkout of the php-fpm image repository the custom image is built from
+BITNAMI_REPO = 'bitnami-docker-php-fpm'
+
+# Values measured for every stage by --metrics, and their description
+STAGE_METRICS = {
+    'wall_seconds': 'Wall time of the stage',
+    'cpu_seconds': 'CPU time of the build and its child processes while '
+                   'the stage ran, stages running together share it',
+    'peak_rss_bytes': 'Peak resident set size of the build process when '
+                      'the stage completed',
+    'bytes_downloaded': 'Bytes downloaded by the stage',
+    'bytes_written': 'Bytes written by the stage',
+    'files_written': 'Files written by the stage',
+    'files_unchanged': 'Files the stage found up to date',
+    'files_removed': 'Files removed by the stage',
+    'files_changed': 'Files whose group was changed by the stage',
+    'images_built': 'Docker images built by the stage',
+    'context_bytes': 'Bytes of docker build context sent by the stage',
     }
 
 
+# Metrics of the stage run by the current thread, see _measure()
+_recording = threading.local()
+
+
+def _record(**counters):
+    '''
+    Add counters to the metrics of the stage running in this thread
+    Does nothing outside of a stage
+    '''
+    metrics = getattr(_recording, 'metrics', None)
+    if metrics is not None:
+        for name, value in counters.items():
+            metrics[name] = metrics.get(name, 0) + value
+
+
+def _cpu_time():
+    usage = [resource.getrusage(who) for who in (resource.RUSAGE_SELF,
+                                                 resource.RUSAGE_CHILDREN)]
+    return sum(u.ru_utime + u.ru_stime for u in usage)
+
+
+@contextlib.contextmanager
+def _measure(metrics):
+    '''
+    Record in metrics the wall time, CPU time and peak RSS of the block
+    along with the counters given to _record() by its thread
+    '''
+    previous = getattr(_recording, 'metrics', None)
+    _recording.metrics = metrics
+    start, cpu = time.perf_counter(), _cpu_time()
+    try:
+        yield metrics
+    finally:
+        metrics['wall_seconds'] = time.perf_counter() - start
+        metrics['cpu_seconds'] = _cpu_time() - cpu
+        # ru_maxrss is in kilobytes on Linux
+        metrics['peak_rss_bytes'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * 1024
+        _recording.metrics = previous
+
+
 def check_md5_ok(file_to_check, md5):
     '''
     Verify the MD5 checksum of a file
     The file is expected to exist
     '''
-    with open(file_to_check, 'rb') as f:
-        checksum = hashlib.md5(f.read()).hexdigest()
-    if checksum == md5:
+    checksum = hashlib.md5()
+    _hash_file(file_to_check, checksum)
+    if checksum.hexdigest() == md5:
         return True
     else:
         return False
 
 
+def _hash_file(path, checksum):
+    '''
+    Feed the content of path to the checksum object in CHUNK_SIZE blocks
+    Returns the number of bytes read
+    '''
+    size = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            checksum.update(chunk)
+            size += len(chunk)
+    return size
+
+
+def stream_to_file(response, dest, checksum, mode='wb'):
+    '''
+    Copy an HTTP response to dest in CHUNK_SIZE blocks
+    Each block is fed to the checksum object as it is written so
+    the digest is complete as soon as the last byte arrives
+    Returns the number of bytes written
+    '''
+    written = 0
+    with open(dest, mode) as out:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            out.write(chunk)
+            checksum.update(chunk)
+            written += len(chunk)
+    return written
+
+
+def download_tarball(url, dest, md5):
+    '''
+    Download url to dest through a dest.partial file which is only
+    renamed to dest once its MD5 matches
+    A partial file left by an interrupted run, or a transfer that drops
+    before completion, is resumed with a Range request. The partial
+    content is hashed first so the digest still covers the whole file
+    Returns True when dest is in place and verified
+    '''
+    partial = '%s.partial' % dest
+    checksum = hashlib.md5()
+    offset = 0
+    if os.path.exists(partial):
+        offset = _hash_file(partial, checksum)
+    # A fresh download that fails verification is not worth retrying
+    fresh = offset == 0
+    failures = 0
+
+    while True:
+        request = Request(url)
+        if offset:
+            request.add_header('Range', 'bytes=%d-' % offset)
+        try:
+            with urlopen(request) as tarball_resp:
+                if offset and tarball_resp.status != 206:
+                    # The server ignored the Range, start over
+                    checksum = hashlib.md5()
+                    offset = 0
+                received = stream_to_file(tarball_resp, partial, checksum,
+                                          'ab' if offset else 'wb')
+                _record(bytes_downloaded=received)
+                offset += received
+                # read() returns short data instead of raising when the
+                # connection drops, length holds what is still missing
+                if tarball_resp.length:
+                    raise http.client.IncompleteRead(b'',
+                                                     tarball_resp.length)
+
+        except urllib.error.HTTPError as err:
+            # 416 means that the partial file already holds everything
+            if err.code != 416:
+                raise
+
+        except (urllib.error.URLError,
+                http.client.IncompleteRead,
+                ConnectionResetError,
+                socket.timeout) as err:
+            failures += 1
+            if failures == DOWNLOAD_ATTEMPTS:
+                raise
+            print('Transfer interrupted, resuming : %s' % err)
+            # Every byte written to the partial file went through checksum
+            if os.path.exists(partial):
+                offset = os.path.getsize(partial)
+            continue
+
+        if checksum.hexdigest() == md5:
+            os.replace(partial, dest)
+            return True
+
+        os.remove(partial)
+        if fresh:
+            return False
+        # The partial file was left by an older release
+        print('Discarding stale %s' % partial)
+        checksum = hashlib.md5()
+        offset = 0
+        fresh = True
+
+
+def link_file(src, dest):
+    '''
+    Make dest share the content of src, with a hardlink when both are
+    on the same filesystem, a reflink or a plain copy otherwise
+    dest is replaced atomically
+    '''
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    try:
+        os.link(src, tmp)
+    except OSError:
+        with open(src, 'rb') as source, open(tmp, 'wb') as copy:
+            try:
+                fcntl.ioctl(copy.fileno(), FICLONE, source.fileno())
+            except OSError:
+                shutil.copyfileobj(source, copy, CHUNK_SIZE)
+    os.replace(tmp, dest)
+
+
+def tarball_version(tarball):
+    '''
+    Read the WordPress release from wp-includes/version.php
+    Returns None when it cannot be found
+    '''
+    version_regex = re.compile(r"\$wp_version\s*=\s*'([^']+)'")
+    try:
+        with tarfile.open(tarball, 'r') as tar:
+            for member in tar:
+                if member.name.endswith('wp-includes/version.php'):
+                    content = tar.extractfile(member).read().decode('UTF-8')
+                    version = version_regex.search(content)
+                    return version.group(1) if version else None
+    except (tarfile.TarError, OSError, UnicodeDecodeError):
+        pass
+    return None
+
+
+class ArtifactCache(object):
+    '''
+    Content addressed store of WordPress tarballs shared by the
+    projects of a build host
+    Blobs are named after their MD5. index.json maps release versions to
+    digests and keeps the LRU and hit/miss bookkeeping
+    '''
+    def __init__(self, root, max_size):
+        self.root = root
+        self.max_size = max_size
+        self.blobs = os.path.join(root, 'blobs')
+        self.index_file = os.path.join(root, 'index.json')
+
+    def blob(self, digest):
+        return os.path.join(self.blobs, '%s.tar.gz' % digest)
+
+    @contextlib.contextmanager
+    def index(self):
+        '''
+        Hold the cache lock and yield the index, which is written back
+        when the block completes
+        '''
+        os.makedirs(self.blobs, exist_ok=True)
+        with open(os.path.join(self.root, 'index.lock'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(self.index_file, 'r') as f:
+                    index = json.load(f)
+            except (OSError, ValueError):
+                index = {'releases': {}, 'blobs': {}, 'hits': 0, 'misses': 0}
+
+            yield index
+
+            tmp = '%s.tmp' % self.index_file
+            with open(tmp, 'w') as f:
+                json.dump(index, f, indent=2, sort_keys=True)
+            os.replace(tmp, self.index_file)
+
+    def fetch(self, digest, dest):
+        '''
+        Link the blob matching digest to dest
+        Returns the blob's index entry on a cache hit, None otherwise
+        '''
+        with self.index() as index:
+            if digest not in index['blobs'] or \
+                    not os.path.exists(self.blob(digest)):
+                index['blobs'].pop(digest, None)
+                index['misses'] += 1
+                return None
+            index['hits'] += 1
+            index['blobs'][digest]['last_used'] = time.time()
+            link_file(self.blob(digest), dest)
+            return dict(index['blobs'][digest])
+
+    def store(self, tarball, digest):
+        '''
+        Add an already verified tarball to the cache then evict the least
+        recently used releases until the cache fits in max_size
+        '''
+        version = tarball_version(tarball)
+        with self.index() as index:
+            if not os.path.exists(self.blob(digest)):
+                link_file(tarball, self.blob(digest))
+            if version:
+                index['releases'][version] = digest
+            index['blobs'][digest] = {
+                'version': version,
+                'size': os.path.getsize(self.blob(digest)),
+                'last_used': time.time(),
+                }
+
+            total = sum(b['size'] for b in index['blobs'].values())
+            for old in sorted(index['blobs'],
+                              key=lambda d: index['blobs'][d]['last_used']):
+                if total <= self.max_size:
+                    break
+                if old == digest:
+                    continue
+                total -= index['blobs'].pop(old)['size']
+                index['releases'] = {v: d for v, d in
+                                     index['releases'].items() if d != old}
+                if os.path.exists(self.blob(old)):
+                    os.remove(self.blob(old))
+
+    def stats(self):
+        with self.index() as index:
+            return index['hits'], index['misses']
+
+
+def _cache_fetch(cache, digest):
+    '''
+    Look the tarball up in the artifact cache and link it in place
+    Cache errors are reported but never fail the build
+    '''
+    try:
+        entry = cache.fetch(digest, wp_latest['file'])
+        hits, misses = cache.stats()
+    except OSError as err:
+        print('Artifact cache unavailable : %s' % err)
+        return False
+
+    print('Artifact cache %s (hits: %d, misses: %d)' % (
+        'hit' if entry else 'miss', hits, misses))
+    if entry:
+        print('Using WordPress %s from %s' % (entry['version'] or digest,
+                                              cache.root))
+    return bool(entry)
+
+
+def _cache_store(cache, digest):
+    try:
+        cache.store(wp_latest['file'], digest)
+    except OSError as err:
+        print('Unable to store %s in the artifact cache : %s' % (
+            wp_latest['file'], err))
+
+
+def _read_metadata():
+    '''
+    Load the sidecar metadata of the local tarball
+    Returns None unless it still describes the file on disk
+    '''
+    try:
+        with open('%s.meta' % wp_latest['file'], 'r') as f:
+            meta = json.load(f)
+        st = os.stat(wp_latest['file'])
+    except (OSError, ValueError):
+        return None
+    if meta.get('size') != st.st_size or \
+            meta.get('mtime_ns') != st.st_mtime_ns:
+        return None
+    return meta
+
+
+def _write_metadata(md5, headers):
+    '''
+    Record the verified MD5 of the local tarball along with the
+    validators of the MD5 URL for the next conditional request
+    '''
+    meta_file = '%s.meta' % wp_latest['file']
+    try:
+        st = os.stat(wp_latest['file'])
+        with open('%s.tmp' % meta_file, 'w') as f:
+            json.dump({
+                'md5': md5,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                }, f, indent=2, sort_keys=True)
+        os.replace('%s.tmp' % meta_file, meta_file)
+    except OSError as err:
+        print('Unable to record %s : %s' % (meta_file, err))
+
+
 def get_latest_wp():
 
     try:
-        # Get the MD5 of the latest file first
-        latest_md5 = urlopen(wp_latest['md5']).read().decode('UTF-8')
+        # Get the MD5 of the latest file first, unless it did not
+        # change since our tarball was verified
+        md5_request = Request(wp_latest['md5'])
+        meta = _read_metadata()
+        if meta and meta['etag']:
+            md5_request.add_header('If-None-Match', meta['etag'])
+        if meta and meta['last_modified']:
+            md5_request.add_header('If-Modified-Since', meta['last_modified'])
+        try:
+            md5_resp = urlopen(md5_request)
+        except urllib.error.HTTPError as err:
+            if err.code != 304 or not meta:
+                raise
+            print('We have the latest %s (not modified)' % wp_latest['file'],
+                  end='')
+            return True
+        latest_md5 = md5_resp.read().decode('UTF-8', 'replace').strip()
+        # It names the blob of the artifact cache
+        if not re.fullmatch('[0-9a-f]{32}', latest_md5):
+            print('Invalid MD5 value %r' % latest_md5[:64])
+            return False
 
         # Check if we don't already have the latest file
+        if meta and meta['md5'] == latest_md5:
+            _write_metadata(latest_md5, md5_resp.headers)
+            print('We have the latest %s' % wp_latest['file'], end='')
+            return True
+
+        # Other projects of this host may have fetched it already
+        cache = None
+        if wp_cache['dir']:
+            cache = ArtifactCache(wp_cache['dir'], wp_cache['max_size'])
+            if _cache_fetch(cache, latest_md5):
+                _write_metadata(latest_md5, md5_resp.headers)
+                print('We have the latest %s' % wp_latest['file'], end='')
+                return True
+
         if os.path.exists(wp_latest['file']):
             if check_md5_ok(wp_latest['file'], latest_md5):
+                if cache:
+                    _cache_store(cache, latest_md5)
+                _write_metadata(latest_md5, md5_resp.headers)
                 print('We have the latest %s' % wp_latest['file'], end='')
                 return True
             else:
@@ -50,12 +672,11 @@ def get_latest_wp():
 
         # Either we don't have a file or the MD5 doesn't match
         # Get a new one
-        with urlopen(wp_latest['url']) as tarball_resp:
-            print('Downloading new %s' % wp_latest['file'])
-            with open(wp_latest['file'], 'wb') as tarball:
-                tarball.write(tarball_resp.read())
-
-        if check_md5_ok(wp_latest['file'], latest_md5):
+        print('Downloading new %s' % wp_latest['file'])
+        if download_tarball(wp_latest['url'], wp_latest['file'], latest_md5):
+            if cache:
+                _cache_store(cache, latest_md5)
+            _write_metadata(latest_md5, md5_resp.headers)
             print('We have the latest %s' % wp_latest['file'], end='')
             return True
         else:
@@ -65,151 +686,1407 @@ def get_latest_wp():
 
     except (urllib.error.URLError,
             urllib.error.HTTPError,
-            ConnectionResetError) as err:
+            http.client.IncompleteRead,
+            ConnectionResetError,
+            socket.timeout) as err:
         print('Unable to fetch MD5 value or tarball')
         return False
 
 
-def extract_wp_tarball():
-
-    # First we cleanup the old wp dir
+def _load_manifest(manifest_file):
     try:
-        if os.path.exists(wp_latest['dir']):
-            shutil.rmtree(wp_latest['dir'])
+        with open(manifest_file, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
-    except PermissionError as err:
-        print('Unable to remove old %s directory : %s' % (wp_latest['dir'],
-                                                          err))
+
+def _save_manifest(manifest_file, manifest):
+    with open('%s.tmp' % manifest_file, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace('%s.tmp' % manifest_file, manifest_file)
+
+
+def _member_path(member):
+    '''
+    Path of member relative to the top directory of the tarball, None
+    for members that would land outside of it
+    '''
+    name = os.path.normpath(member.name)
+    if os.path.isabs(name) or name.startswith('..'):
+        return None
+    parts = name.split(os.sep, 1)
+    return parts[1] if len(parts) > 1 else ''
+
+
+def _unchanged_on_disk(name, entry):
+    '''
+    Check the file still has the size and mtime recorded in its
+    manifest entry
+    '''
+    try:
+        st = os.stat(name)
+    except OSError:
         return False
+    return [st.st_size, int(st.st_mtime)] == entry[:2]
+
+
+def _can_chgrp(gid):
+    '''
+    Check whether we are allowed to give our files to the gid group
+    '''
+    return os.geteuid() == 0 or gid == os.getegid() or gid in os.getgroups()
 
+
+def _write_member(member, data, gid=None):
+    '''
+    Write data to the file described by member, its directory is
+    expected to exist. The file is given to the gid group if not None
+    An existing file is replaced through a temporary file, which keeps
+    the old file intact, and its inode untouched, until the new content
+    is complete
+    '''
     try:
-        print('Extracting new tarball', end='')
-        new_wp = tarfile.open(wp_latest['file'], 'r')
-        new_wp.extractall()
+        dest = member.name
+        f = open(dest, 'xb')
+    except FileExistsError:
+        dest = '%s.%d.%d.tmp' % (member.name, os.getpid(),
+                                 threading.get_ident())
+        f = open(dest, 'wb')
+    with f:
+        f.write(data)
+        if gid is not None:
+            os.fchown(f.fileno(), -1, gid)
+    os.chmod(dest, member.mode & 0o7777)
+    os.utime(dest, (member.mtime, member.mtime))
+    if dest != member.name:
+        os.replace(dest, member.name)
+
+
+def _remove_siblings(path):
+    '''
+    Remove the compressed siblings of the static asset path, which
+    precompress_assets() writes again for its new content
+    The staging tree only holds links to them, the previous release
+    keeps its own
+    '''
+    if os.path.splitext(path)[1][1:] not in wp_precompress['types']:
+        return
+    for suffix, compress in _encoders.values():
+        try:
+            os.remove('%s.%s' % (path, suffix))
+        except FileNotFoundError:
+            pass
+
+
+def _sync_member(member, data, entry, gid=None):
+    '''
+    Write member unless its manifest entry shows that the same content
+    is already on disk
+    Returns the new manifest entry and whether the file was written
+    '''
+    digest = hashlib.sha1(data).hexdigest()
+    # Releases restamp every file, so the content decides whether
+    # a file changed and the mtime whether it was modified locally
+    if entry and entry[0] == member.size and entry[2] == digest \
+            and _unchanged_on_disk(member.name, entry):
+        return entry, False
+    _write_member(member, data, gid)
+    # Never serve the compressed body of the previous content
+    _remove_siblings(member.name)
+    return [member.size, member.mtime, digest], True
+
+
+def _open_tarball(tarball):
+    '''
+    Open the tarball for sequential reading, through the first external
+    gzip decompressor available
+    Returns the TarFile and the decompressor process, if any
+    '''
+    for command in wp_extract['gzip']:
+        if shutil.which(command[0]):
+            gunzip = subprocess.Popen(command + [tarball],
+                                      stdout=subprocess.PIPE)
+            try:
+                return tarfile.open(fileobj=gunzip.stdout, mode='r|'), gunzip
+            except tarfile.TarError:
+                gunzip.kill()
+                gunzip.wait()
+                raise
+    return tarfile.open(tarball, 'r'), None
+
+
+def _extract_into(root, manifest):
+    '''
+    Bring the root directory in line with the tarball, only writing
+    the files that are new or changed according to the manifest of the
+    previous extraction, and removing the files it lists that are gone
+    from the release. Files absent from the manifest are left alone
+    Returns the new manifest, the written/skipped/removed counts along
+    with the bytes written and the WordPress version found in the tarball
+    '''
+    version_regex = re.compile(r"\$wp_version\s*=\s*'([^']+)'")
+    new_manifest = {}
+    release_dirs = set([''])
+    counts = {'written': 0, 'skipped': 0, 'removed': 0, 'bytes': 0}
+    version = None
+    # Set the group right away when we can, setup_wp_source_tree() will
+    # then have nothing left to do
+    gid = wp_extract['gid'] if _can_chgrp(wp_extract['gid']) else None
+
+    def collect(futures):
+        for future in futures:
+            name = pending.pop(future)
+            new_manifest[name], written = future.result()
+            counts['written' if written else 'skipped'] += 1
+            if written:
+                counts['bytes'] += new_manifest[name][0]
+
+    gunzip = None
+    try:
+        new_wp, gunzip = _open_tarball(wp_latest['file'])
+        # Decompression stays in this thread, hashing and writing the
+        # files is fanned out to the pool
+        with ThreadPoolExecutor(wp_extract['workers']) as pool:
+            pending = {}
+            for member in new_wp:
+                name = _member_path(member)
+                if name is None:
+                    continue
+                if member.isdir():
+                    release_dirs.add(name)
+                    os.makedirs(os.path.join(root, name), exist_ok=True)
+                    continue
+                if not member.isfile():
+                    member.name = name
+                    new_wp.extract(member, root)
+                    continue
+
+                data = new_wp.extractfile(member).read()
+                if name == 'wp-includes/version.php':
+                    found = version_regex.search(data.decode('UTF-8',
+                                                             'replace'))
+                    version = found.group(1) if found else None
+                parent = os.path.dirname(name)
+                if parent not in release_dirs:
+                    os.makedirs(os.path.join(root, parent), exist_ok=True)
+                    release_dirs.add(parent)
+                member.name = os.path.join(root, name)
+                future = pool.submit(_sync_member, member, data,
+                                     manifest.get(name), gid)
+                pending[future] = name
+                # Bound the amount of decompressed data held in memory
+                if len(pending) >= wp_extract['workers'] * 4:
+                    collect(wait(pending, return_when=FIRST_COMPLETED)[0])
+            collect(list(pending))
         new_wp.close()
-        return True
+        if gunzip and gunzip.wait():
+            raise tarfile.ReadError('%s exited with status %d' % (
+                gunzip.args[0], gunzip.returncode))
 
-    except tarfile.TarError as tarerr:
-        print('\nUnable to extract the tarball : %s' % tarerr)
-        return False
+    finally:
+        if gunzip and gunzip.poll() is None:
+            gunzip.kill()
+            gunzip.wait()
 
+    # Only files we extracted ourselves are candidates for removal
+    for name in set(manifest) - set(new_manifest):
+        if os.path.lexists(os.path.join(root, name)):
+            os.remove(os.path.join(root, name))
+            counts['removed'] += 1
+        _remove_siblings(os.path.join(root, name))
+        parent = os.path.dirname(name)
+        while parent not in release_dirs:
+            try:
+                os.rmdir(os.path.join(root, parent))
+            except OSError:
+                break
+            parent = os.path.dirname(parent)
 
-def setup_wp_source_tree():
-    home = os.getcwd()
-    wp_root = '%s/wordpress' % home
-    client = docker.from_env()
-    print('Setting up source tree permissions', end='')
-    client.containers.run('ubuntu:latest',
-                          volumes={wp_root: {'bind': '/app'}},
-                          command=['chown', '-R', ':daemon', '/app/'])
-    return True
+    return new_manifest, counts, version
+
+
+def _clone_tree(src, dest):
+    '''
+    Copy the src tree to dest using hardlinks instead of file copies
+    '''
+    for top, dirs, files in os.walk(src):
+        target = os.path.normpath(os.path.join(dest,
+                                               os.path.relpath(top, src)))
+        os.mkdir(target)
+        shutil.copymode(top, target)
+        for name in list(dirs) + files:
+            path = os.path.join(top, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+                if name in dirs:
+                    dirs.remove(name)
+            elif name in files:
+                os.link(path, os.path.join(target, name))
+
+
+def _carry_local_files(current, release, tracked):
+    '''
+    Make the files of release that are not part of a WordPress release
+    (uploads, plugins, rendered configuration) match current again, as
+    they may have been added, replaced or removed in current since
+    release was cloned from it
+    tracked holds the paths of both releases, those and their compressed
+    siblings are left to the extraction and precompress_assets()
+    '''
+    suffixes = tuple('.%s' % suffix for suffix, _ in _encoders.values())
 
+    def local(name):
+        return (name not in tracked and
+                not (name.endswith(suffixes) and
+                     os.path.splitext(name)[0] in tracked))
 
-def create_php_fpm_image(wants_network=False):
-    bitnami_url = 'https://github.com/bitnami/bitnami-docker-php-fpm.git'
-    bitnami_repo = 'bitnami-docker-php-fpm'
-    php_fpm_version = '5.6'
-    custom_files = ['php-fpm_entrypoint.sh', 'wp_automate.php']
-    bitnami_dockerfile = '%s/%s' % (bitnami_repo, php_fpm_version)
+    def files(root):
+        for top, dirs, names in os.walk(root):
+            for name in list(dirs) + names:
+                path = os.path.join(top, name)
+                if name in dirs and not os.path.islink(path):
+                    continue
+                name = os.path.relpath(path, root)
+                if local(name):
+                    yield name
 
-    # First we cleanup the old repository
+    for name in files(current):
+        src, dest = os.path.join(current, name), os.path.join(release, name)
+        stat = os.lstat(src)
+        try:
+            if os.path.samestat(stat, os.lstat(dest)):
+                continue
+            os.remove(dest)
+        except FileNotFoundError:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if os.path.islink(src):
+            os.symlink(os.readlink(src), dest)
+        else:
+            os.link(src, dest)
+    for name in list(files(release)):
+        if not os.path.lexists(os.path.join(current, name)):
+            os.remove(os.path.join(release, name))
+
+
+def _release_manifest(release):
+    return '%s.manifest' % release
+
+
+def _current_release():
+    '''
+    Returns the path of the release the current symlink points to
+    A wordpress directory left by an older version of this script is
+    moved in the releases directory and becomes the current release
+    '''
+    current = os.path.join(wp_latest['releases'], 'current')
+    if os.path.islink(current):
+        return os.path.join(wp_latest['releases'], os.readlink(current))
+
+    if os.path.isdir(wp_latest['dir']) and \
+            not os.path.islink(wp_latest['dir']):
+        release = os.path.join(wp_latest['releases'], 'wordpress-previous')
+        os.rename(wp_latest['dir'], release)
+        # Its manifest listed paths from the project directory
+        old_manifest = '%s.manifest' % os.path.normpath(wp_latest['dir'])
+        prefix = '%s/' % os.path.basename(os.path.normpath(wp_latest['dir']))
+        manifest = dict((name[len(prefix):], entry) for name, entry in
+                        _load_manifest(old_manifest).items()
+                        if name.startswith(prefix))
+        _save_manifest(_release_manifest(release), manifest)
+        if os.path.exists(old_manifest):
+            os.remove(old_manifest)
+        _switch_release(release)
+        return release
+
+    return None
+
+
+def _switch_release(release):
+    '''
+    Atomically point the current symlink at release, and make sure the
+    wordpress path goes through it
+    '''
+    current = os.path.join(wp_latest['releases'], 'current')
+    tmp = '%s.tmp' % current
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    os.symlink(os.path.basename(release), tmp)
+    os.replace(tmp, current)
+
+    if not os.path.islink(wp_latest['dir']):
+        os.symlink(os.path.relpath(current,
+                                   os.path.dirname(wp_latest['dir'])),
+                   wp_latest['dir'])
+
+
+def _prune_releases(keep):
+    '''
+    Remove all but the keep most recent releases, never the current one
+    '''
+    releases = wp_latest['releases']
+    current = os.path.realpath(os.path.join(releases, 'current'))
+    candidates = [os.path.join(releases, name)
+                  for name in os.listdir(releases)
+                  if name.startswith('wordpress-') and
+                  os.path.isdir(os.path.join(releases, name))]
+    candidates.sort(key=os.path.getmtime, reverse=True)
+    for release in candidates[keep:]:
+        if os.path.realpath(release) == current:
+            continue
+        shutil.rmtree(release)
+        if os.path.exists(_release_manifest(release)):
+            os.remove(_release_manifest(release))
+
+
+def extract_wp_tarball():
+    '''
+    Extract the tarball in a new release directory and atomically switch
+    the current symlink to it once it is complete, so that the running
+    containers never see a partial tree
+    The new release starts as a hardlinked copy of the current one: only
+    new or changed files are written and files added locally (uploads,
+    plugins, rendered configuration) are carried over, again right
+    before the switch for the ones changed during the extraction
+    '''
+    staging = os.path.join(wp_latest['releases'], '.staging')
     try:
-        if os.path.exists(bitnami_repo):
-            shutil.rmtree(bitnami_repo)
+        os.makedirs(wp_latest['releases'], exist_ok=True)
+        current = _current_release()
+        if os.path.lexists(staging):
+            shutil.rmtree(staging)
+        if current:
+            _clone_tree(current, staging)
+            manifest = _load_manifest(_release_manifest(current))
+        else:
+            os.mkdir(staging)
+            manifest = {}
 
-    except PermissionError as err:
-        print('Unable to remove old git repository : %s' % err)
+    except OSError as err:
+        print('Unable to prepare a new release in %s : %s' % (
+            wp_latest['releases'], err))
         return False
 
     try:
-        print('Cloning bitnami\'s php-fpm image repository')
-        subprocess.check_call(['git', 'clone', '%s' % bitnami_url],
-                              stdout=subprocess.PIPE,
-                              stderr=subprocess.PIPE)
-    except subprocess.CalledProcessError as err:
-        print('Unable to clone php-fpm git repository : %s' % err)
+        print('Extracting new tarball', end='')
+        new_manifest, counts, version = _extract_into(staging, manifest)
+        print(' (%(written)d written, %(skipped)d unchanged, '
+              '%(removed)d removed)' % counts, end='')
+        _record(files_written=counts['written'],
+                files_unchanged=counts['skipped'],
+                files_removed=counts['removed'], bytes_written=counts['bytes'])
+
+        if current and not counts['written'] and not counts['removed']:
+            # Keep serving the same paths, opcache keys on them
+            shutil.rmtree(staging)
+            _save_manifest(_release_manifest(current), new_manifest)
+            return True
+
+        name = os.path.join(wp_latest['releases'], 'wordpress-%s-%s' % (
+            version or 'unknown', time.strftime('%Y%m%d%H%M%S')))
+        release, suffix = name, 1
+        while os.path.lexists(release):
+            suffix += 1
+            release = '%s-%d' % (name, suffix)
+        if current:
+            _carry_local_files(current, staging,
+                               set(manifest) | set(new_manifest))
+        os.rename(staging, release)
+        _save_manifest(_release_manifest(release), new_manifest)
+        _switch_release(release)
+
+    except tarfile.TarError as tarerr:
+        print('\nUnable to extract the tarball : %s' % tarerr)
+        shutil.rmtree(staging, ignore_errors=True)
         return False
 
-    if wants_network:
-        custom_files += ['wp_enable_network']
+    except OSError as err:
+        print('\nUnable to update %s : %s' % (wp_latest['dir'], err))
+        shutil.rmtree(staging, ignore_errors=True)
+        return False
 
     try:
-        for file in custom_files:
-            shutil.copy(file, '%s/%s/rootfs/%s' % (bitnami_repo,
-                                                   php_fpm_version,
-                                                   file))
+        _prune_releases(wp_latest['keep'])
     except OSError as err:
-        print('Unable to copy custom files in repository : %s' % err)
-        return False
+        print('\nUnable to remove old releases : %s' % err)
+    return True
 
-    print('Building new docker custom php-fpm image', end='')
 
-    version_regex = re.compile(r'BITNAMI_IMAGE_VERSION')
-    entrypoint_regex = re.compile(r'^ENTRYPOINT')
+def _fix_group(root, gid):
+    '''
+    Give every entry of the root tree that is not in the gid group to it
+    Raises PermissionError on the first entry we are not allowed to change
+    Returns the number of entries changed
+    '''
+    changed = 0
+    for top, dirs, files in os.walk(root):
+        # Symlinks to directories are listed in dirs but never walked
+        names = files + [d for d in dirs if os.path.islink(
+            os.path.join(top, d))]
+        for path in [top] + [os.path.join(top, name) for name in names]:
+            if os.lstat(path).st_gid != gid:
+                os.lchown(path, -1, gid)
+                changed += 1
+    return changed
+
 
+def setup_wp_source_tree():
+    '''
+    Give the source tree to the group the bitnami images run as
+    Only the entries in the wrong group are changed, from this process
+    when we are allowed to, with a single container run otherwise
+    '''
+    wp_root = os.path.realpath(wp_latest['dir'])
+    gid = wp_extract['gid']
+    print('Setting up source tree permissions', end='')
+    start = time.perf_counter()
     try:
-        os.rename('%s/Dockerfile' % bitnami_dockerfile,
-                  '%s/Dockerfile.old' % bitnami_dockerfile)
-        with open('%s/Dockerfile.old' % bitnami_dockerfile, 'r') as dfile:
-            lines = dfile.readlines()
+        changed = _fix_group(wp_root, gid)
+        _record(files_changed=changed)
+        changed = '%d entries changed' % changed
 
-        with open('%s/Dockerfile' % bitnami_dockerfile, 'w') as newfile:
-            for line in lines:
-                image_version = version_regex.search(line)
-                entrypoint = entrypoint_regex.search(line)
-                if entrypoint:
-                    newfile.write('ENTRYPOINT ["/php-fpm_entrypoint.sh"]\n')
-                    continue
-                elif image_version:
-                    full_image_version = image_version.string.split('"')[1]
-                newfile.write(line)
+    except PermissionError:
+        client = docker.from_env()
+        client.containers.run('ubuntu:latest',
+                              volumes={wp_root: {'bind': '/app'}},
+                              command=['find', '/app', '!', '-group',
+                                       str(gid), '-exec', 'chgrp', '-h',
+                                       str(gid), '{}', '+'],
+                              remove=True)
+        changed = 'changed in a container'
 
     except OSError as err:
-        print('\nUnable to find image version in Dockerfile.')
-        print('Will use high level %s version' % php_fpm_version)
-        print('the docker-compose.yml will need to be changed with :')
-        print('php-fpm:\n  image: php-fpm:%s-custom' % php_fpm_version)
-        full_image_version = php_fpm_version
+        print('\nUnable to setup %s permissions : %s' % (wp_root, err))
+        return False
 
-    client = docker.from_env()
-    client.images.build(path=bitnami_dockerfile,
-                        tag='php-fpm:%s-custom' % full_image_version)
+    print(' (%s in %.2fs)' % (changed, time.perf_counter() - start), end='')
     return True
 
 
-def _getvars(compose_file):
+# File suffix and compression function of each precompressed encoding
+_encoders = {
+    'br': ('br', lambda data: brotli.compress(data)),
+    'gzip': ('gz', lambda data: gzip.compress(data, 9, mtime=0)),
+    }
 
-    regex = re.compile(r'MARIADB_.*|WP_.*')
-
-    with open(compose_file, 'r') as compose:
-        lines = compose.read()
-
-    project_vars = regex.findall(lines)
-    project_dict = {
-            'mariadb_root_password': 'root-password',
-            'mariadb_database': 'wordpress',
-            'mariadb_user': 'wordpress',
-            'mariadb_password': 'my-password',
-            'wp_user': 'wordpress',
-            'wp_password': 'wordpress',
-            'wp_email': 'you@example.com',
-            'wp_site_name': 'My Bitnami Project',
-            }
-    for v in project_vars:
-        [key, item] = v.split('=')
-        project_dict[key.lower()] = item
-    return project_dict
 
+def _precompress_encodings():
+    '''
+    Encodings of wp_precompress that can be written here, mapped to
+    their file suffix
+    '''
+    return dict((encoding, _encoders[encoding][0])
+                for encoding in wp_precompress['encodings']
+                if encoding != 'br' or brotli is not None)
 
-def render_templates(wants_multisite=False, wants_subdomain=False):
-    env = Environment(loader=FileSystemLoader('.'),
-                      lstrip_blocks=True, trim_blocks=True)
 
-    templates = {
+def _precompress_file(path, encodings):
+    '''
+    Write the compressed siblings of path that are missing or stale
+    They get the mtime of path, a sibling with another mtime is stale
+    Siblings are replaced, never modified, as the releases share them
+    through hardlinks
+    Returns the number of siblings written and their size
+    '''
+    st = os.stat(path)
+    if st.st_size < wp_precompress['min_size']:
+        return 0, 0
+    stale = []
+    for encoding in encodings:
+        try:
+            if os.stat('%s.%s' % (path, _encoders[encoding][0])) \
+                    .st_mtime_ns == st.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+        stale.append(_encoders[encoding])
+    if not stale:
+        return 0, 0
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    size = 0
+    for suffix, compress in stale:
+        dest = '%s.%s' % (path, suffix)
+        tmp = '%s.%d.%d.tmp' % (dest, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            size += f.write(compress(data))
+        os.chmod(tmp, st.st_mode & 0o7777)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dest)
+    return len(stale), size
+
+
+def precompress_assets():
+    '''
+    Write compressed siblings of the static assets of the current release
+    for Apache to serve instead of compressing them on every request
+    Siblings whose asset is gone are removed
+    '''
+    root = os.path.realpath(wp_latest['dir'])
+    encodings = _precompress_encodings()
+    suffixes = set(_encoders[encoding][0] for encoding in _encoders)
+    types = wp_precompress['types']
+    print('Precompressing static assets', end='')
+    try:
+        assets = []
+        removed = 0
+        for top, dirs, files in os.walk(root):
+            for name in files:
+                base, ext = os.path.splitext(name)
+                if ext[1:] in suffixes:
+                    if os.path.splitext(base)[1][1:] in types and \
+                            base not in files:
+                        os.remove(os.path.join(top, name))
+                        removed += 1
+                elif ext[1:] in types:
+                    assets.append(os.path.join(top, name))
+
+        written = size = 0
+        with ThreadPoolExecutor(wp_precompress['workers']) as pool:
+            for count, length in pool.map(lambda path: _precompress_file(
+                    path, encodings), assets):
+                written += count
+                size += length
+
+    except OSError as err:
+        print('\nUnable to precompress the assets of %s : %s' % (root, err))
+        return False
+
+    print(' (%s, %d written, %d removed)' % (
+        '/'.join(sorted(encodings)) or 'no encoding', written, removed),
+        end='')
+    _record(files_written=written, files_removed=removed, bytes_written=size)
+    return True
+
+
+def _git(*args):
+    subprocess.check_call(['git'] + list(args),
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+
+def update_mirror(url, mirror):
+    '''
+    Create the bare mirror of url or fetch what changed since the last run
+    A failed fetch keeps the mirror as it is so that builds still work
+    offline, returns False when there is no mirror to build from
+    '''
+    if os.path.exists(mirror):
+        try:
+            _git('--git-dir', mirror, 'fetch', '--prune', 'origin')
+        except subprocess.CalledProcessError as err:
+            print('Unable to update %s, using it as is : %s' % (mirror, err))
+        return True
+
+    try:
+        _git('clone', '--mirror', url, mirror)
+    except subprocess.CalledProcessError as err:
+        print('Unable to mirror %s : %s' % (url, err))
+        return False
+    return True
+
+
+@contextlib.contextmanager
+def _locked(path):
+    '''
+    Hold an exclusive lock on path for the duration of the block
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        yield
+
+
+def checkout_php_fpm(dest):
+    '''
+    Shallow and sparse checkout in dest of the image directory at the
+    pinned ref of the php-fpm mirror
+    Returns the commit checked out, None without a mirror to check out
+    '''
+    mirror = php_fpm['mirror']
+    # Projects built in parallel share the mirror
+    with _locked('%s.lock' % os.path.abspath(mirror)):
+        if ((php_fpm['update'] or not os.path.exists(mirror)) and
+                not update_mirror(php_fpm['url'], mirror)):
+            return None
+        commit = subprocess.check_output(['git', '--git-dir', mirror,
+                                          'rev-parse', '--verify',
+                                          '%s^{commit}' % php_fpm['ref']],
+                                         stderr=subprocess.PIPE)
+        commit = commit.decode('UTF-8').strip()
+
+        _git('init', dest)
+        _git('-C', dest, 'sparse-checkout', 'set', php_fpm['version'])
+        # Through a file:// url, --depth is ignored for plain paths
+        _git('-C', dest, 'fetch', '--depth', '1',
+             'file://%s' % os.path.abspath(mirror), commit)
+    _git('-C', dest, 'checkout', 'FETCH_HEAD')
+    return commit
+
+
+def _image_inputs_digest(commit, dockerfile, files):
+    '''
+    Hash the upstream commit, the Dockerfile and the custom files
+    that make up the custom php-fpm image
+    '''
+    checksum = hashlib.sha256()
+    checksum.update(commit.encode('UTF-8'))
+    for path in [dockerfile] + files:
+        checksum.update(b'\0%s\0' % os.path.basename(path).encode('UTF-8'))
+        _hash_file(path, checksum)
+    return checksum.hexdigest()
+
+
+def _dockerfile_sources(dockerfile):
+    '''
+    Paths of the build context read by the COPY and ADD instructions
+    of dockerfile, relative to the context, '.' for all of it
+    '''
+    with open(dockerfile, 'r') as f:
+        lines = f.read().replace('\\\n', ' ').splitlines()
+    sources = []
+    for line in lines:
+        words = line.strip().split(None, 1)
+        if len(words) < 2 or words[0].upper() not in ('COPY', 'ADD'):
+            continue
+        if words[1].lstrip().startswith('['):
+            args = json.loads(words[1])
+        else:
+            args = words[1].split()
+        # Copied from another stage or image, not from the context
+        if any(arg.startswith('--from') for arg in args):
+            continue
+        args = [arg for arg in args if not arg.startswith('--')]
+        for source in args[:-1]:
+            if not re.match(r'^\w+://', source):
+                sources.append(os.path.normpath(source.lstrip('/')) or '.')
+    return sources
+
+
+def _dockerignore(names):
+    '''
+    .dockerignore leaving out everything but names
+    '''
+    header = '# Generated by build_project.py, only the files the ' \
+        'Dockerfile copies are sent\n'
+    if '.' in names:
+        return header
+    return ''.join([header, '*\n'] + ['!%s\n' % name for name in names])
+
+
+class _ContextBuffer(object):
+    '''
+    Build context being written, kept in memory until it outgrows limit
+    bytes and moved to a temporary file then
+    file is what to send, a BytesIO unless it outgrew the limit, as
+    requests asks the fileno() of a SpooledTemporaryFile to size the
+    body, which moves it to disk whatever its size
+    '''
+    def __init__(self, limit):
+        self.limit = limit
+        self.file = io.BytesIO()
+
+    def write(self, data):
+        if isinstance(self.file, io.BytesIO) and \
+                self.file.tell() + len(data) > self.limit:
+            spilled = tempfile.TemporaryFile()
+            spilled.write(self.file.getvalue())
+            self.file = spilled
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+def build_context(root, sources, files, fileobj, compress=False):
+    '''
+    Write to fileobj the tar build context of the sources of root, the
+    Dockerfile and .dockerignore, and the files given by name in the
+    context, gzipped with compress
+    A source inside another one is only sent once
+    Returns the number of files and the size of the context
+    '''
+    if '.' in sources:
+        sources = os.listdir(root)
+    paths = set()
+    for source in sources:
+        matches = glob.glob(os.path.join(root, source))
+        if not matches and source not in files:
+            raise OSError('%s not found in %s' % (source, root))
+        paths.update(os.path.relpath(match, root) for match in matches)
+    paths.update(['Dockerfile', '.dockerignore'])
+    paths.difference_update(files)
+
+    counts = [0]
+
+    def normalize(info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = ''
+        if info.isfile():
+            counts[0] += 1
+        return info
+
+    added = []
+    options = {'mode': 'w:gz', 'compresslevel': 6} if compress else \
+        {'mode': 'w'}
+    with tarfile.open(fileobj=fileobj, **options) as tar:
+        for path in sorted(paths):
+            if any(path.startswith('%s/' % parent) for parent in added):
+                continue
+            tar.add(os.path.join(root, path), path, filter=normalize)
+            added.append(path)
+        for name, path in sorted(files.items()):
+            tar.add(path, name, filter=normalize)
+    return counts[0], fileobj.tell()
+
+
+def _remote_daemon(client):
+    '''
+    Whether the docker daemon is reached through the network, where
+    compressing the build context is worth its CPU time
+    '''
+    base_url = getattr(getattr(client, 'api', None), 'base_url', None)
+    return isinstance(base_url, str) and not base_url.startswith(
+        ('http+docker://localhost', 'http+docker://localnpipe'))
+
+
+def _image_up_to_date(client, tag, digest):
+    '''
+    Check whether the image tag was built from the same inputs
+    '''
+    try:
+        image = client.images.get(tag)
+    except docker.errors.ImageNotFound:
+        return False
+    return (image.labels or {}).get(IMAGE_INPUTS_LABEL) == digest
+
+
+def _set_env(name, value, env_file='.env'):
+    '''
+    Set name in the env_file read by docker-compose, keeping the other
+    variables defined there
+    '''
+    try:
+        with open(env_file, 'r') as env:
+            lines = env.read().splitlines()
+    except FileNotFoundError:
+        lines = []
+    entry = '%s=%s' % (name, value)
+    others = [line for line in lines if not line.startswith('%s=' % name)]
+    if others + [entry] == lines:
+        return
+    with open('%s.tmp' % env_file, 'w') as env:
+        env.write(''.join('%s\n' % line for line in others + [entry]))
+    os.replace('%s.tmp' % env_file, env_file)
+
+
+def _read_cgroup(name):
+    try:
+        with open(os.path.join(CGROUP_ROOT, name), 'r') as f:
+            return f.read().split()
+    except OSError:
+        return None
+
+
+def host_resources():
+    '''
+    Returns the CPUs and the memory in MB we may use, within the limits
+    of our cgroup (v2 or v1)
+    '''
+    cpus = len(os.sched_getaffinity(0))
+    quota = _read_cgroup('cpu.max')
+    if quota is None:
+        quota = (_read_cgroup('cpu/cpu.cfs_quota_us') or ['-1']) + \
+            (_read_cgroup('cpu/cpu.cfs_period_us') or ['100000'])
+    if quota[0] not in ('max', '-1'):
+        cpus = min(cpus, max(1, -(-int(quota[0]) // int(quota[1]))))
+
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    limit = _read_cgroup('memory.max') or \
+        _read_cgroup('memory/memory.limit_in_bytes')
+    # v1 reports no limit as a huge number, v2 as max
+    if limit and limit[0].isdigit():
+        memory = min(memory, int(limit[0]))
+    return cpus, memory // (1024 * 1024)
+
+
+def _wordpress_php_files():
+    '''
+    Number of PHP files of the current release, 0 before the first one
+    '''
+    current = os.path.join(wp_latest['releases'], 'current')
+    if not os.path.islink(current):
+        return 0
+    release = os.path.join(wp_latest['releases'], os.readlink(current))
+    manifest = _load_manifest(_release_manifest(release))
+    return sum(1 for name in manifest if name.endswith('.php'))
+
+
+def php_fpm_profile(cpus, memory, php_files):
+    '''
+    Process manager and opcache settings for cpus and memory MB
+    The children get the memory left once opcache and a tenth for the
+    rest of the container are set aside
+    '''
+    opcache_memory = min(512, max(64, memory // 16))
+    available = memory - opcache_memory - memory // 10
+    max_children = max(2, min(available // php_fpm_tuning['child_memory'],
+                              cpus * 16))
+    min_spare = max(1, min(cpus, max_children // 4))
+    max_spare = max(min_spare, min(cpus * 4, max_children // 2))
+    # Room for the plugins and themes added after the extraction
+    wanted = php_files * 2
+    max_files = next((prime for prime in OPCACHE_PRIMES if prime >= wanted),
+                     OPCACHE_PRIMES[-1])
+    return {
+        'pm': 'dynamic',
+        'max_children': max_children,
+        'start_servers': (min_spare + max_spare) // 2,
+        'min_spare_servers': min_spare,
+        'max_spare_servers': max_spare,
+        'max_requests': php_fpm_tuning['max_requests'],
+        'opcache_memory': opcache_memory,
+        'opcache_max_files': max_files,
+        'validate_timestamps': int(php_fpm_tuning['validate_timestamps']),
+        }
+
+
+def mariadb_profile(memory, max_children):
+    '''
+    InnoDB and connection settings for memory MB and php-fpm
+    max_children, each child holding one connection at most
+    The buffer pool gets three quarters of what the connections leave
+    '''
+    max_connections = max_children + mariadb_tuning['extra_connections']
+    available = memory - max_connections * \
+        mariadb_tuning['connection_memory']
+    # The pool grows by chunks of 8MB
+    buffer_pool = max(32, available * 3 // 4 // 8 * 8)
+    return {
+        'memory': memory,
+        'max_connections': max_connections,
+        'buffer_pool_size': buffer_pool,
+        'buffer_pool_instances': max(1, min(8, buffer_pool // 1024)),
+        # The two redo logs hold half of the pool, so that the pages
+        # of a burst of writes are flushed in the background
+        'log_file_size': max(48, min(1024, buffer_pool // 4)),
+        'flush_method': 'O_DIRECT',
+        'query_cache_size': mariadb_tuning['query_cache_size'],
+        'tmp_table_size': max(16, min(64, memory // 32)),
+        }
+
+
+def render_php_fpm_tuning(cpus=None, memory=None):
+    '''
+    Render php-fpm-pool.conf and opcache.ini for the given budget, the
+    missing parts of which are detected
+    Returns the profile they were rendered from
+    '''
+    detected_cpus, detected_memory = host_resources()
+    profile = php_fpm_profile(cpus or detected_cpus,
+                              memory or detected_memory,
+                              _wordpress_php_files())
+    env = _template_env('.')
+    for output, template in (('php-fpm-pool.conf', 'php-fpm-pool.template'),
+                             ('opcache.ini', 'opcache.template')):
+        _write_if_changed(output, env.get_template(template).render(profile))
+    return profile
+
+
+def _php_fpm_custom_files(wants_network=False):
+    '''
+    Files of the project copied on top of the upstream php-fpm image
+    '''
+    # Least often edited first, each of them is copied in its own layer
+    # on top of the upstream image so that editing one of them only
+    # rebuilds the layers that follow it
+    custom_files = ['php-fpm_entrypoint.sh', 'php-fpm-pool.conf',
+                    'opcache.ini', 'wp_automate.php']
+    if wants_network:
+        custom_files.insert(3, 'wp_enable_network')
+    return custom_files
+
+
+def _image_version(dockerfile):
+    '''
+    Upstream image version from BITNAMI_IMAGE_VERSION in dockerfile,
+    None when it is not set there
+    '''
+    with open(dockerfile, 'r') as dfile:
+        for line in dfile:
+            if 'BITNAMI_IMAGE_VERSION' in line and '"' in line:
+                return line.split('"')[1]
+    return None
+
+
+def checkout_php_fpm_image(wants_network=False):
+    '''
+    Check out the php-fpm image repository and point its Dockerfile at
+    the custom files, which do not need to exist yet
+    '''
+    php_fpm_version = php_fpm['version']
+    destinations = {
+        'php-fpm-pool.conf': php_fpm_tuning['pool_conf'],
+        'opcache.ini': php_fpm_tuning['opcache_ini'],
+        }
+    bitnami_dockerfile = '%s/%s' % (BITNAMI_REPO, php_fpm_version)
+
+    # First we cleanup the old repository
+    try:
+        if os.path.exists(BITNAMI_REPO):
+            shutil.rmtree(BITNAMI_REPO)
+
+    except PermissionError as err:
+        print('Unable to remove old git repository : %s' % err)
+        return False
+
+    try:
+        commit = checkout_php_fpm(BITNAMI_REPO)
+    except (OSError, subprocess.CalledProcessError) as err:
+        print('Unable to clone php-fpm git repository : %s' % err)
+        return False
+    if commit is None:
+        return False
+    print('Checked out bitnami\'s php-fpm image repository at %s (%s)' %
+          (php_fpm['ref'], commit[:12]), end='')
+
+    entrypoint_regex = re.compile(r'^ENTRYPOINT')
+
+    try:
+        os.rename('%s/Dockerfile' % bitnami_dockerfile,
+                  '%s/Dockerfile.old' % bitnami_dockerfile)
+        with open('%s/Dockerfile.old' % bitnami_dockerfile, 'r') as dfile:
+            lines = dfile.readlines()
+
+        with open('%s/Dockerfile' % bitnami_dockerfile, 'w') as newfile:
+            for line in lines:
+                if entrypoint_regex.search(line):
+                    newfile.write('ENTRYPOINT ["/php-fpm_entrypoint.sh"]\n')
+                    continue
+                newfile.write(line)
+            for file in _php_fpm_custom_files(wants_network):
+                newfile.write('COPY %s %s\n' % (
+                    file, destinations.get(file, '/%s' % file)))
+
+    except OSError as err:
+        print('\nUnable to rewrite the Dockerfile : %s' % err)
+        return False
+    return True
+
+
+def create_php_fpm_image(wants_network=False, unique_tag=False):
+    '''
+    Build the custom php-fpm image from the checkout unless it is up to
+    date
+    With unique_tag the tag ends with the hash of the inputs, so that
+    projects with different scripts get their own image
+    The tag is recorded as PHP_FPM_IMAGE in .env for docker-compose
+    '''
+    php_fpm_version = php_fpm['version']
+    custom_files = _php_fpm_custom_files(wants_network)
+    bitnami_dockerfile = '%s/%s' % (BITNAMI_REPO, php_fpm_version)
+
+    try:
+        commit = subprocess.check_output(['git', '-C', BITNAMI_REPO,
+                                          'rev-parse', 'HEAD'],
+                                         stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as err:
+        print('Unable to read the php-fpm checkout : %s' % err)
+        return False
+    commit = commit.decode('UTF-8').strip()
+
+    try:
+        profile = render_php_fpm_tuning(php_fpm_tuning['cpus'],
+                                        php_fpm_tuning['memory'])
+    except (OSError, exceptions.TemplateNotFound) as err:
+        print('Unable to render the php-fpm tuning : %s' % err)
+        return False
+
+    print('Building new docker custom php-fpm image (%d children, '
+          '%dMB opcache)' % (profile['max_children'],
+                             profile['opcache_memory']), end='')
+
+    try:
+        full_image_version = _image_version('%s/Dockerfile' %
+                                            bitnami_dockerfile)
+    except OSError:
+        full_image_version = None
+    if full_image_version is None:
+        print('\nUnable to find image version in Dockerfile.')
+        print('Will use high level %s version' % php_fpm_version)
+        print('the docker-compose.yml will need to be changed with :')
+        print('php-fpm:\n  image: php-fpm:%s-custom' % php_fpm_version)
+        full_image_version = php_fpm_version
+
+    tag = 'php-fpm:%s-custom' % full_image_version
+    try:
+        digest = _image_inputs_digest(commit,
+                                      '%s/Dockerfile' % bitnami_dockerfile,
+                                      custom_files)
+    except OSError as err:
+        print('\nUnable to hash the image inputs : %s' % err)
+        return False
+    if unique_tag:
+        tag = '%s-%s' % (tag, digest[:12])
+
+    client = docker.from_env()
+    # Projects with the same inputs wait for the first one to build
+    with _locked('%s.%s.lock' % (os.path.abspath(php_fpm['mirror']),
+                                 digest[:12])):
+        if _image_up_to_date(client, tag, digest):
+            print(' (up to date)', end='')
+        else:
+            # Only what the Dockerfile copies is sent, the custom files
+            # straight from the project. They stay out of rootfs, it is
+            # copied before the packages are installed and would
+            # invalidate all those layers
+            remote = _remote_daemon(client)
+            try:
+                sources = _dockerfile_sources('%s/Dockerfile' %
+                                              bitnami_dockerfile)
+                with open('%s/.dockerignore' % bitnami_dockerfile,
+                          'w') as ignore:
+                    ignore.write(_dockerignore(sorted(set(sources) |
+                                                      set(custom_files))))
+                context = _ContextBuffer(CONTEXT_MEMORY)
+                try:
+                    count, size = build_context(
+                        bitnami_dockerfile, sources,
+                        dict((file, file) for file in custom_files),
+                        context, compress=remote)
+                    print(' (context of %d files, %.1fKB%s)' % (
+                        count, size / 1024, ' gzipped' if remote else ''),
+                        end='')
+                    _record(context_bytes=size)
+                    context.file.seek(0)
+                    # nocache stays off so that the upstream layers are
+                    # reused
+                    client.images.build(fileobj=context.file,
+                                        custom_context=True,
+                                        encoding='gzip' if remote else None,
+                                        tag=tag, rm=True,
+                                        labels={IMAGE_INPUTS_LABEL: digest})
+                finally:
+                    context.close()
+            except (OSError, ValueError) as err:
+                print('\nUnable to assemble the build context : %s' % err)
+                return False
+            _record(images_built=1)
+    _set_env('PHP_FPM_IMAGE', tag)
+    return True
+
+
+class ProjectConfig(object):
+    '''
+    Settings of a project, read from the environment of the services
+    of its compose file
+    '''
+    # Type and default of every setting, set by the upper case variable
+    fields = {
+        'mariadb_root_password': (str, 'root-password'),
+        'mariadb_database': (str, 'wordpress'),
+        'mariadb_user': (str, 'wordpress'),
+        'mariadb_password': (str, 'my-password'),
+        'wp_user': (str, 'wordpress'),
+        'wp_password': (str, 'wordpress'),
+        'wp_email': (str, 'you@example.com'),
+        'wp_site_name': (str, 'My Bitnami Project'),
+        # Users, and sites once the network is enabled, created by
+        # wp_automate.php on top of the admin
+        'wp_seed_users': (int, 0),
+        'wp_seed_sites': (int, 0),
+        # Memory budget of mariadb in MB, 0 gives it a share of the
+        # memory available here, see mariadb_tuning
+        'mariadb_memory': (int, 0),
+        }
+    # Other MARIADB_* and WP_* variables, by lower case name
+    __slots__ = tuple(fields) + ('extra',)
+
+    def __init__(self, environment=None):
+        environment = environment or {}
+        for field, (kind, default) in self.fields.items():
+            value = environment.get(field.upper(), default)
+            try:
+                setattr(self, field, kind(value))
+            except (TypeError, ValueError):
+                raise ValueError('Invalid %s value : %r' % (field.upper(),
+                                                            value))
+        self.extra = dict((name.lower(), str(value))
+                          for name, value in environment.items()
+                          if name.startswith(('MARIADB_', 'WP_')) and
+                          name.lower() not in self.fields)
+
+    def as_dict(self):
+        values = dict(self.extra)
+        for field in self.fields:
+            values[field] = getattr(self, field)
+        return values
+
+    @classmethod
+    def from_compose(cls, compose_file):
+        '''
+        Parse compose_file along with the env files of its services
+        Returns the config and the state of every file it was read from
+        '''
+        sources = {}
+
+        def read(path):
+            state = _file_state(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            sources[path] = [state, hashlib.sha1(data).hexdigest()]
+            return data.decode('UTF-8')
+
+        try:
+            compose = yaml.safe_load(read(compose_file))
+        except yaml.YAMLError as err:
+            raise ValueError('Unable to parse %s : %s' % (compose_file, err))
+        services = compose.get('services') if isinstance(compose,
+                                                         dict) else None
+        if not isinstance(services, dict):
+            raise ValueError('No services in %s' % compose_file)
+
+        environment = {}
+        root = os.path.dirname(compose_file)
+        for service in services.values():
+            service = service or {}
+            env_files = service.get('env_file') or []
+            if isinstance(env_files, str):
+                env_files = [env_files]
+            for env_file in env_files:
+                lines = read(os.path.join(root, env_file)).splitlines()
+                environment.update(_environment(
+                    line for line in lines
+                    if line.strip() and not line.lstrip().startswith('#')))
+            # Set after the env files, which it overrides like compose does
+            environment.update(_environment(service.get('environment')))
+        return cls(environment), sources
+
+
+def _environment(entries):
+    '''
+    Dict of an environment: block, either a mapping or a list of
+    NAME=value entries
+    Variables without a value are taken from our own environment
+    '''
+    if not entries:
+        return {}
+    if isinstance(entries, dict):
+        entries = entries.items()
+    else:
+        entries = [str(entry).strip().split('=', 1) + [None]
+                   for entry in entries]
+    environment = {}
+    for entry in entries:
+        name, value = entry[0], entry[1]
+        if value is None:
+            value = os.environ.get(name)
+        if value is not None:
+            environment[name] = value
+    return environment
+
+
+def _file_state(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _sources_unchanged(sources):
+    '''
+    Check the files a config was read from, by mtime and size, then by
+    content when they were touched
+    '''
+    for path, source in sources.items():
+        try:
+            state = _file_state(path)
+            if state == source[0]:
+                continue
+            checksum = hashlib.sha1()
+            _hash_file(path, checksum)
+        except OSError:
+            return False
+        if checksum.hexdigest() != source[1]:
+            return False
+        source[0] = state
+    return True
+
+
+# Parsed configs by compose file path, with the files they come from
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def load_config(compose_file):
+    '''
+    ProjectConfig of compose_file, only parsed again once the compose
+    file or one of its env files changed
+    Raises ValueError when the file is not a valid compose file
+    '''
+    path = os.path.abspath(compose_file)
+    # The stages rendering the templates look it up at the same time
+    with _configs_lock:
+        cached = _configs.get(path)
+        if cached is not None and _sources_unchanged(cached[1]):
+            return cached[0]
+        config, sources = ProjectConfig.from_compose(path)
+        _configs[path] = (config, sources)
+        return config
+
+
+def _getvars(compose_file):
+    return load_config(compose_file).as_dict()
+
+
+class TemplateBytecodeCache(FileSystemBytecodeCache):
+    '''
+    Compiled templates named after the name and the source of their
+    template rather than its path, so that the projects of the build
+    host share them whatever their directory
+    Only the max_files most recently used ones are kept
+    '''
+    def __init__(self, directory, max_files):
+        super().__init__(directory)
+        self.max_files = max_files
+
+    def get_bucket(self, environment, name, filename, source):
+        checksum = self.get_source_checksum(source)
+        bucket = Bucket(environment,
+                        self.get_cache_key('%s:%s' % (name, checksum)),
+                        checksum)
+        self.load_bytecode(bucket)
+        return bucket
+
+    def load_bytecode(self, bucket):
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            # The modification time orders the eviction
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket):
+        super().dump_bytecode(bucket)
+        self.evict()
+
+    def evict(self):
+        '''
+        Remove the least recently used compiled templates above max_files
+        '''
+        files = []
+        for path in glob.glob(os.path.join(self.directory,
+                                           self.pattern % '*')):
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        for mtime, path in sorted(files, reverse=True)[self.max_files:]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Jinja2 environments by template directory, see _template_env()
+_template_envs = {}
+_template_envs_lock = threading.Lock()
+
+
+def _template_env(root):
+    '''
+    Jinja2 environment for the templates of root, kept for the next
+    renders so that a template is only compiled once per process
+    The compiled templates are also stored in the shared cache, see
+    TemplateBytecodeCache
+    '''
+    root = os.path.abspath(root)
+    cache_dir = None
+    if wp_cache['dir']:
+        cache_dir = os.path.join(wp_cache['dir'], 'templates')
+    with _template_envs_lock:
+        env = _template_envs.get((root, cache_dir))
+        if env is None:
+            bytecode_cache = None
+            if cache_dir:
+                try:
+                    os.makedirs(cache_dir, exist_ok=True)
+                    bytecode_cache = TemplateBytecodeCache(
+                        cache_dir, wp_cache['max_templates'])
+                except OSError as err:
+                    print('Not caching compiled templates : %s' % err)
+            # auto_reload picks up templates edited since they were loaded
+            env = Environment(loader=FileSystemLoader(root),
+                              lstrip_blocks=True, trim_blocks=True,
+                              bytecode_cache=bytecode_cache)
+            env.filters['shell_quote'] = shlex.quote
+            _template_envs[(root, cache_dir)] = env
+    return env
+
+
+def _write_if_changed(path, content, mode=None):
+    '''
+    Write content to path unless it already holds it, so that unchanged
+    outputs keep their mtime and inode
+    Returns True when path was written
+    '''
+    data = content.encode('UTF-8')
+    try:
+        with open(path, 'rb') as f:
+            changed = (hashlib.sha1(f.read()).digest() !=
+                       hashlib.sha1(data).digest())
+        if mode is None:
+            mode = os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        changed = True
+
+    if changed:
+        tmp = '%s.tmp' % path
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, path)
+    elif mode is not None and os.stat(path).st_mode & 0o7777 != mode:
+        os.chmod(path, mode)
+    return changed
+
+
+def render_templates(wants_multisite=False, wants_subdomain=False,
+                     target=None, compose_file='docker-compose.yml'):
+    '''
+    Render the templates, only the ones written in the target directory
+    when one is given
+    Outputs whose content did not change are left untouched
+    '''
+    env = _template_env('.')
+
+    templates = {
             'wp-config.php': 'wordpress',
             'wp_automate.php': '.',
+            'php-fpm_entrypoint.sh': '.',
+            'docker-compose.override.yml': '.',
+            'mariadb.cnf': '.',
+            'wordpress.conf': 'apache-vhost',
             }
-    context = _getvars('docker-compose.yml')
+    modes = {'php-fpm_entrypoint.sh': 0o755, 'wp_enable_network': 0o750}
+    context = _getvars(compose_file)
+    context['vhost'] = apache_vhost
+    context['startup'] = php_fpm_startup
+    # One connection per php-fpm child, as many as the image runs
+    cpus, memory = host_resources()
+    children = php_fpm_profile(php_fpm_tuning['cpus'] or cpus,
+                               php_fpm_tuning['memory'] or memory,
+                               0)['max_children']
+    context['mariadb'] = mariadb_profile(
+        context['mariadb_memory'] or
+        int(memory * mariadb_tuning['memory_share']), children)
+    context['mariadb_tuning'] = mariadb_tuning
+    context['precompress'] = {'encodings': _precompress_encodings(),
+                              'types': wp_precompress['types']}
 
     if wants_multisite:
         context['multisite'] = True
@@ -223,26 +2100,923 @@ def render_templates(wants_multisite=False, wants_subdomain=False):
     else:
         context['subdomain'] = False
 
+    written = unchanged = 0
     for template in templates.keys():
+        if target is not None and templates[template] != target:
+            continue
         try:
-            tmpl_name = template.rstrip('.php')
+            tmpl_name = template[:-4] if template.endswith('.php') \
+                else template
             t = env.get_template('%s.template' % tmpl_name)
             config = t.render(context)
-            with open('%s/%s' % (templates[template],
-                                 template), 'w') as conf:
-                conf.write(config)
-            if template == 'wp_enable_network':
-                os.chmod('%s/%s' % (templates[template], template), 0o750)
+            if _write_if_changed('%s/%s' % (templates[template], template),
+                                 config, modes.get(template)):
+                written += 1
+                _record(bytes_written=len(config.encode('UTF-8')))
+            else:
+                unchanged += 1
 
         except exceptions.TemplateNotFound as e:
             print('Could not load %s.template. ' % tmpl_name)
             return False
-    print('Custom files setup', end='')
+    print('Custom files setup (%d written, %d unchanged)' % (written,
+                                                            unchanged),
+          end='')
+    _record(files_written=written, files_unchanged=unchanged)
+    return True
+
+
+def _compose_image(compose_file, service, env_file='.env'):
+    '''
+    Image of service in compose_file, with the ${NAME} and
+    ${NAME:-default} variables expanded from the environment and
+    env_file like docker-compose does
+    '''
+    with open(compose_file, 'r') as f:
+        compose = yaml.safe_load(f)
+    try:
+        image = compose['services'][service]['image']
+    except (KeyError, TypeError):
+        raise ValueError('No %s image in %s' % (service, compose_file))
+    try:
+        with open(env_file, 'r') as env:
+            variables = _environment(line for line in env.read().splitlines()
+                                     if line.strip() and
+                                     not line.lstrip().startswith('#'))
+    except FileNotFoundError:
+        variables = {}
+    variables.update(os.environ)
+    return re.sub(r'\$\{(\w+)(?::?-([^}]*))?\}',
+                  lambda m: variables.get(m.group(1)) or m.group(2) or '',
+                  image)
+
+
+def _snapshot_key(compose_file):
+    '''
+    Digest of what the installed database depends on : the WordPress
+    release, the rendered scripts and configuration, the images and the
+    mariadb settings
+    '''
+    release = _current_release()
+    manifest = _load_manifest(_release_manifest(release)) if release else {}
+    if 'wp-includes/version.php' not in manifest:
+        raise ValueError('No WordPress release extracted')
+    checksum = hashlib.sha256()
+    checksum.update(json.dumps([
+        manifest['wp-includes/version.php'][2],
+        _compose_image(compose_file, 'mariadb'),
+        _compose_image(compose_file, 'php-fpm'),
+        sorted(load_config(compose_file).as_dict().items()),
+        ]).encode('UTF-8'))
+    for name in ('php-fpm_entrypoint.sh', 'wp_automate.php', 'mariadb.cnf',
+                 os.path.join(wp_latest['dir'], 'wp-config.php')):
+        _hash_file(name, checksum)
+    return checksum.hexdigest()
+
+
+def _capture_snapshot(client, compose_file, snapshot):
+    '''
+    Install WordPress with the php-fpm entrypoint in a throwaway stack
+    and archive the resulting mariadb data directory in snapshot
+    '''
+    name = 'bitnami-project-snapshot-%d' % os.getpid()
+    config = load_config(compose_file).as_dict()
+    environment = dict((key.upper(), value) for key, value in config.items()
+                       if key.startswith('mariadb_'))
+    network = client.networks.create(name)
+    containers = []
+    try:
+        mariadb = client.containers.create(
+            _compose_image(compose_file, 'mariadb'), name='%s-db' % name,
+            environment=environment,
+            volumes={os.path.abspath('mariadb.cnf'): {
+                'bind': mariadb_tuning['conf'], 'mode': 'ro'}})
+        containers.append(mariadb)
+        network.connect(mariadb, aliases=['mariadb'])
+        mariadb.start()
+
+        volumes = {os.path.realpath(wp_latest['releases']): {'bind': '/app'}}
+        for script in ('php-fpm_entrypoint.sh', 'wp_automate.php'):
+            volumes[os.path.abspath(script)] = {'bind': '/%s' % script,
+                                                'mode': 'ro'}
+        php_fpm = client.containers.create(
+            _compose_image(compose_file, 'php-fpm'), name='%s-php' % name,
+            entrypoint=['/php-fpm_entrypoint.sh', '--install'],
+            volumes=volumes)
+        containers.append(php_fpm)
+        network.connect(php_fpm)
+        php_fpm.start()
+        status = php_fpm.wait(timeout=db_snapshot['timeout'])
+        if status.get('StatusCode'):
+            raise RuntimeError('WordPress install failed : %s' % (
+                php_fpm.logs(tail=5).decode('UTF-8', 'replace').strip()))
+
+        # Let mariadb flush its tables before archiving them
+        mariadb.stop(timeout=60)
+        stream, stat = mariadb.get_archive('/bitnami/mariadb')
+        with open('%s.tmp' % snapshot, 'wb') as f:
+            for chunk in stream:
+                f.write(chunk)
+        os.replace('%s.tmp' % snapshot, snapshot)
+    finally:
+        for container in containers:
+            container.remove(v=True, force=True)
+        network.remove()
+
+
+def _seed_data_dir(snapshot, data_dir):
+    '''
+    Extract the snapshot in data_dir, owners included, as the mariadb
+    image expects them
+    Returns the number of entries extracted
+    '''
+    count = 0
+    with tarfile.open(snapshot, 'r') as tar:
+        for member in tar:
+            name = _member_path(member)
+            if not name:
+                continue
+            member.name = name
+            tar.extract(member, data_dir, numeric_owner=True)
+            count += 1
+    return count
+
+
+def snapshot_database(compose_file='docker-compose.yml'):
+    '''
+    Seed an empty mariadb data directory with a snapshot of the database
+    as wp_automate.php leaves it, so that new stacks skip the WordPress
+    install. The snapshot is made once per WordPress release and
+    configuration, in a throwaway stack, and kept in the artifact cache
+    '''
+    data_dir = db_snapshot['data_dir']
+    if os.path.isdir(data_dir) and os.listdir(data_dir):
+        print('Database already initialized, not seeding it', end='')
+        return True
+
+    try:
+        key = _snapshot_key(compose_file)
+        snapshots = os.path.join(wp_cache['dir'], 'snapshots') \
+            if wp_cache['dir'] else db_snapshot['dir']
+        snapshot = os.path.join(snapshots, '%s.tar' % key)
+        print('Seeding the database from snapshot %s' % key[:12], end='')
+        os.makedirs(snapshots, exist_ok=True)
+        with _locked('%s.lock' % snapshot):
+            if os.path.exists(snapshot):
+                print(' (cached)', end='')
+            else:
+                print(' (installing WordPress in a throwaway stack)', end='')
+                _capture_snapshot(docker.from_env(), compose_file, snapshot)
+        start = time.perf_counter()
+        count = _seed_data_dir(snapshot, data_dir)
+        _record(files_written=count)
+
+    except (OSError, ValueError, RuntimeError, tarfile.TarError,
+            docker.errors.DockerException) as err:
+        print('\nUnable to seed %s : %s' % (data_dir, err))
+        return False
+
+    print(' (%d entries copied in %.2fs)' % (count,
+                                             time.perf_counter() - start),
+          end='')
+    return True
+
+
+class Stage(object):
+    '''
+    Step of the build, run as soon as the stages it needs succeeded
+    The function returns True on success like the other steps
+    '''
+    def __init__(self, name, function, needs=()):
+        self.name = name
+        self.function = function
+        self.needs = list(needs)
+        # pending, running, done, failed or skipped
+        self.status = 'pending'
+        self.start = None
+        self.end = None
+        self.output = ''
+        # Values of STAGE_METRICS measured while it ran
+        self.metrics = {}
+
+    @property
+    def duration(self):
+        if self.start is None or self.end is None:
+            return None
+        return self.end - self.start
+
+
+class _StageOutput(object):
+    '''
+    Stand-in for sys.stdout keeping what each stage prints in its own
+    buffer so that stages running together do not mix their progress
+    '''
+    def __init__(self, stdout):
+        self.stdout = stdout
+        self.local = threading.local()
+
+    def write(self, text):
+        buffer = getattr(self.local, 'buffer', None)
+        if buffer is None:
+            return self.stdout.write(text)
+        buffer.append(text)
+        return len(text)
+
+    def flush(self):
+        self.stdout.flush()
+
+
+def _run_stage(stage, output):
+    output.local.buffer = []
+    stage.start = time.perf_counter()
+    with _measure(stage.metrics):
+        try:
+            ok = stage.function()
+        except Exception as err:
+            print('\nStage %s raised %s : %s' % (stage.name,
+                                                 type(err).__name__, err))
+            ok = False
+    stage.end = time.perf_counter()
+    stage.output = ''.join(output.local.buffer)
+    output.local.buffer = None
+    stage.status = 'done' if ok else 'failed'
+
+
+def critical_path(stages):
+    '''
+    Chain of stages, following the latest of their needs, that ends with
+    the stage which completed last
+    '''
+    by_name = dict((stage.name, stage) for stage in stages)
+    ran = [stage for stage in stages if stage.end is not None]
+    if not ran:
+        return []
+    stage = max(ran, key=lambda s: s.end)
+    path = [stage]
+    while stage.needs:
+        stage = max((by_name[name] for name in stage.needs),
+                    key=lambda s: s.end or 0)
+        path.insert(0, stage)
+    return path
+
+
+def print_timings(stages, origin):
+    path = critical_path(stages)
+    print('')
+    print('%-12s %-8s %9s %9s' % ('stage', 'status', 'start', 'duration'))
+    for stage in stages:
+        if stage.start is None:
+            print('%-12s %-8s %9s %9s' % (stage.name, stage.status, '-', '-'))
+            continue
+        print('%-12s %-8s %8.2fs %8.2fs%s' % (stage.name, stage.status,
+                                              stage.start - origin,
+                                              stage.duration,
+                                              ' *' if stage in path else ''))
+    if path:
+        print('Critical path (*) : %s, %.2fs' % (
+            ' > '.join(stage.name for stage in path),
+            path[-1].end - origin))
+
+
+def run_pipeline(stages):
+    '''
+    Run the stages in a thread pool, each one once all its needs are done
+    Nothing new starts after a failure, the stages already running are
+    waited for and the remaining ones are skipped
+    Prints the output of every stage as it completes, then the timings
+    Returns True when all the stages succeeded
+    '''
+    by_name = dict((stage.name, stage) for stage in stages)
+    for stage in stages:
+        for name in stage.needs:
+            if name not in by_name:
+                raise ValueError('Stage %s needs unknown stage %s' %
+                                 (stage.name, name))
+
+    stdout = sys.stdout
+    output = _StageOutput(stdout)
+    sys.stdout = output
+    origin = time.perf_counter()
+    pending = list(stages)
+    running = {}
+    failed = False
+    try:
+        with ThreadPoolExecutor(max_workers=len(stages) or 1) as pool:
+            while pending or running:
+                ready = [stage for stage in pending
+                         if not failed and
+                         all(by_name[name].status == 'done'
+                             for name in stage.needs)]
+                for stage in ready:
+                    pending.remove(stage)
+                    stage.status = 'running'
+                    running[pool.submit(_run_stage, stage, output)] = stage
+                if not running:
+                    # Failed before or needs that can never be met
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage = running.pop(future)
+                    print(stage.output, end='')
+                    if stage.status == 'done':
+                        print('...Done.')
+                    else:
+                        failed = True
+                        print('\n%s failed' % stage.name)
+    finally:
+        sys.stdout = stdout
+
+    for stage in pending:
+        stage.status = 'skipped'
+    print_timings(stages, origin)
+    return not failed and not pending
+
+
+def stage_records(stages, project):
+    '''
+    One dict per stage that ran, with its metrics, for write_metrics()
+    '''
+    now = int(time.time())
+    records = []
+    for stage in stages:
+        if stage.start is None:
+            continue
+        record = {'time': now, 'project': project, 'stage': stage.name,
+                  'status': stage.status}
+        record.update(stage.metrics)
+        records.append(record)
+    return records
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"') \
+        .replace('\n', '\\n')
+
+
+def write_metrics(path, records):
+    '''
+    Append the records to path as JSON lines, or replace path by a
+    Prometheus textfile when its name ends with .prom
+    '''
+    try:
+        if not path.endswith('.prom'):
+            with open(path, 'a') as f:
+                f.write(''.join('%s\n' % json.dumps(record, sort_keys=True)
+                                for record in records))
+            return True
+
+        lines = ['# HELP bitnami_project_stage_success Whether the stage '
+                 'succeeded',
+                 '# TYPE bitnami_project_stage_success gauge']
+        lines.extend('bitnami_project_stage_success{project="%s",stage="%s"}'
+                     ' %d' % (_label(record['project']), record['stage'],
+                              record['status'] == 'done')
+                     for record in records)
+        for name, description in sorted(STAGE_METRICS.items()):
+            metric = 'bitnami_project_stage_%s' % name
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s gauge' % metric)
+            lines.extend('%s{project="%s",stage="%s"} %s' % (
+                metric, _label(record['project']), record['stage'],
+                record.get(name, 0)) for record in records)
+        with open('%s.tmp' % path, 'w') as f:
+            f.write(''.join('%s\n' % line for line in lines))
+        # The textfile collector must never read a partial file
+        os.replace('%s.tmp' % path, path)
+    except OSError as err:
+        print('Unable to write the metrics to %s : %s' % (path, err))
+        return False
+    return True
+
+
+def project_stages(args, compose_file='docker-compose.yml', batch=False):
+    '''
+    Stages building the project in the current directory, the tarball
+    is downloaded beforehand in batch mode
+    '''
+    # The php-fpm repository is checked out while the tarball is being
+    # downloaded, the image only waits for the scripts rendered next to
+    # this file and the size of the release to tune opcache, it is
+    # built while the WordPress tree is being set up
+    stages = [
+        Stage('extract', extract_wp_tarball, [] if batch else ['download']),
+        Stage('compress', precompress_assets, ['extract']),
+        Stage('permissions', setup_wp_source_tree, ['compress']),
+        Stage('scripts', lambda: render_templates(args.multisite,
+                                                  args.subdomain,
+                                                  target='.',
+                                                  compose_file=compose_file)),
+        Stage('vhost', lambda: render_templates(args.multisite,
+                                                args.subdomain,
+                                                target='apache-vhost',
+                                                compose_file=compose_file)),
+        Stage('config', lambda: render_templates(args.multisite,
+                                                 args.subdomain,
+                                                 target='wordpress',
+                                                 compose_file=compose_file),
+              ['permissions']),
+        ]
+    if not batch:
+        stages.insert(0, Stage('download', get_latest_wp))
+    if not args.alternate:
+        stages += [
+            Stage('checkout', lambda: checkout_php_fpm_image(args.multisite)),
+            Stage('image', lambda: create_php_fpm_image(args.multisite,
+                                                        unique_tag=batch),
+                  ['checkout', 'scripts', 'extract']),
+            ]
+    if args.db_snapshot and not args.alternate:
+        stages.append(Stage('database',
+                            lambda: snapshot_database(compose_file),
+                            ['scripts', 'config', 'image']))
+    return stages
+
+
+def _print_usage(compose_file='docker-compose.yml'):
+    print('Project creation completed')
+    print('Use the following command to start the service :')
+    print('    docker-compose up')
+    print('')
+    vars = _getvars(compose_file)
+    print('You can connect to wordpress with :')
+    print('   username : %s' % vars['wp_user'])
+    print('   password : %s' % vars['wp_password'])
+
+
+def _project_path(path):
+    '''
+    Project directory and compose file name of a batch entry, which is
+    either a project directory or its compose file
+    '''
+    if os.path.isdir(path):
+        return os.path.abspath(path), 'docker-compose.yml'
+    return (os.path.dirname(os.path.abspath(path)),
+            os.path.basename(path))
+
+
+def _build_project(project, compose_file, args, settings):
+    '''
+    Build one project of a batch, in a process of its own as the build
+    works in the current directory
+    Returns whether it succeeded along with what it printed and the
+    metrics of its stages
+    '''
+    for config, values in zip((wp_latest, wp_extract, php_fpm,
+                               php_fpm_tuning, wp_cache), settings):
+        config.update(values)
+
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    stages = []
+    try:
+        os.chdir(project)
+        stages = project_stages(args, compose_file, batch=True)
+        ok = run_pipeline(stages)
+        if ok:
+            _print_usage(compose_file)
+    except (OSError, ValueError) as err:
+        print('Unable to build %s : %s' % (project, err))
+        ok = False
+    finally:
+        output, sys.stdout = sys.stdout.getvalue(), stdout
+    return ok, output, stage_records(stages, project)
+
+
+def build_projects(args):
+    '''
+    Build all the projects of args.projects, the tarball is downloaded
+    and the php-fpm mirror updated once for all of them, then the
+    projects are built by a pool of args.jobs processes
+    The php-fpm image is built once per set of scripts, projects with
+    the same credentials share it
+    '''
+    start = time.perf_counter()
+    projects = [_project_path(path) for path in args.projects]
+    for project, compose_file in projects:
+        if not os.path.isfile(os.path.join(project, compose_file)):
+            print('No %s in %s' % (compose_file, project))
+            return False
+
+    download = Stage('download', get_latest_wp)
+    with _measure(download.metrics):
+        download.start = time.perf_counter()
+        ok = download.function()
+    download.status = 'done' if ok else 'failed'
+    records = stage_records([download], '')
+    if not ok:
+        print('Giving up')
+        return False
+    print('...Done.')
+
+    if not args.alternate:
+        print('Updating bitnami\'s php-fpm image mirror', end='')
+        with _locked('%s.lock' % os.path.abspath(php_fpm['mirror'])):
+            if not update_mirror(php_fpm['url'], php_fpm['mirror']):
+                print('Giving up')
+                return False
+        print('...Done.')
+
+    # The workers may not share the memory of this process
+    settings = (dict(wp_latest, file=os.path.abspath(wp_latest['file'])),
+                dict(wp_extract),
+                dict(php_fpm, update=False,
+                     mirror=os.path.abspath(php_fpm['mirror'])),
+                dict(php_fpm_tuning),
+                dict(wp_cache, dir=wp_cache['dir'] and
+                     os.path.abspath(wp_cache['dir'])))
+    failed = []
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = dict((pool.submit(_build_project, project, compose_file,
+                                    args, settings), project)
+                       for project, compose_file in projects)
+        for future in as_completed(futures):
+            project = futures[future]
+            ok, output, project_records = future.result()
+            records.extend(project_records)
+            print('\n[%s]' % project)
+            print(output, end='')
+            if not ok:
+                failed.append(project)
+
+    print('\n%d of %d projects built in %.2fs' % (
+        len(projects) - len(failed), len(projects),
+        time.perf_counter() - start))
+    for project in failed:
+        print('Failed : %s' % project)
+    if args.metrics:
+        write_metrics(args.metrics, records)
+    return not failed
+
+
+async def _http_get(reader, writer, host, path):
+    '''
+    Send a GET request for path on an open connection and read the whole
+    response, as Content-Length, chunks or up to the end of the stream
+    Returns its status, the size of its body and whether the connection
+    may be reused
+    '''
+    writer.write(('GET %s HTTP/1.1\r\nHost: %s\r\n'
+                  'Accept-Encoding: br, gzip\r\n'
+                  'User-Agent: build_project.py loadtest\r\n\r\n' % (
+                      path, host)).encode('latin-1'))
+    await writer.drain()
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('Connection closed by the server')
+    version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip().lower()
+
+    keep_alive = headers.get('connection') != 'close' and \
+        (version == b'HTTP/1.1' or headers.get('connection') == 'keep-alive')
+    size = 0
+    if headers.get('transfer-encoding') == 'chunked':
+        while True:
+            chunk = int((await reader.readline()).split(b';')[0], 16)
+            if chunk == 0:
+                # Trailers end with an empty line
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            size += len(await reader.readexactly(chunk))
+            await reader.readline()
+    elif 'content-length' in headers:
+        size = len(await reader.readexactly(int(headers['content-length'])))
+    else:
+        size = len(await reader.read())
+        keep_alive = False
+    return int(status), size, keep_alive
+
+
+async def _loadtest_client(target, host, requests, weights, start, deadline,
+                           results):
+    '''
+    Send requests picked from the mix over a single connection, opened
+    again whenever the server or an error closed it, until deadline
+    Only the requests sent after start are recorded
+    '''
+    rand = random.Random()
+    loop = asyncio.get_running_loop()
+    reader = writer = None
+    while loop.time() < deadline:
+        kind, path = rand.choices(requests, weights)[0]
+        sent = loop.time()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*target), loadtest['timeout'])
+            status, size, keep_alive = await asyncio.wait_for(
+                _http_get(reader, writer, host, path), loadtest['timeout'])
+            failed = status >= 400
+        except (OSError, ValueError, EOFError, asyncio.TimeoutError):
+            failed, keep_alive = True, False
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+        if sent >= start:
+            result = results.setdefault(kind, {'latencies': [],
+                                               'errors': 0})
+            result['latencies'].append(loop.time() - sent)
+            result['errors'] += failed
+    if writer is not None:
+        writer.close()
+
+
+async def _loadtest(target, host, mix, duration, warmup, concurrency):
+    loop = asyncio.get_running_loop()
+    requests, weights = [], []
+    for kind, weight in sorted(mix.items()):
+        paths = loadtest['paths'][kind]
+        for path in paths:
+            requests.append((kind, path))
+            weights.append(weight / len(paths))
+    start = loop.time() + warmup
+    results = {}
+    await asyncio.gather(*[
+        _loadtest_client(target, host, requests, weights, start,
+                         start + duration, results)
+        for client in range(concurrency)])
+    return results
+
+
+def run_loadtest(url, host, mix, duration, warmup, concurrency):
+    '''
+    Drive the mix of requests at url with concurrency clients for
+    warmup then duration seconds
+    Returns the latencies and the number of errors of each kind of
+    request sent during duration
+    '''
+    parts = urlsplit(url)
+    target = (parts.hostname, parts.port or 80)
+    return asyncio.run(_loadtest(target, host or parts.netloc, mix,
+                                 duration, warmup, concurrency))
+
+
+def _percentile(values, percent):
+    '''
+    Nearest-rank percentile of sorted values
+    '''
+    if not values:
+        return 0
+    return values[max(0, -(-len(values) * percent // 100) - 1)]
+
+
+def loadtest_summary(results, duration):
+    '''
+    Requests per second, p50/p95/p99 latency in ms and error rate of
+    each kind of request and of all of them as 'total'
+    '''
+    summary = {}
+    everything = {'latencies': [], 'errors': 0}
+    for kind, result in results.items():
+        everything['latencies'].extend(result['latencies'])
+        everything['errors'] += result['errors']
+    for kind, result in list(results.items()) + [('total', everything)]:
+        latencies = sorted(result['latencies'])
+        summary[kind] = {
+            'requests': len(latencies),
+            'rps': len(latencies) / duration,
+            'p50_ms': _percentile(latencies, 50) * 1000,
+            'p95_ms': _percentile(latencies, 95) * 1000,
+            'p99_ms': _percentile(latencies, 99) * 1000,
+            'errors': result['errors'],
+            'error_rate': result['errors'] / max(1, len(latencies)),
+            }
+    return summary
+
+
+def print_loadtest(summary, first_column='request'):
+    print('%-10s %9s %9s %9s %9s %9s %8s' % (
+        first_column, 'requests', 'rps', 'p50 ms', 'p95 ms', 'p99 ms',
+        'errors'))
+    for name, row in summary:
+        print('%-10s %9d %9.1f %9.1f %9.1f %9.1f %7.2f%%' % (
+            name, row['requests'], row['rps'], row['p50_ms'],
+            row['p95_ms'], row['p99_ms'], row['error_rate'] * 100))
+
+
+def _compose_container(client, service):
+    '''
+    Running container of service in the docker-compose project of the
+    current directory
+    '''
+    project = os.environ.get('COMPOSE_PROJECT_NAME') or \
+        re.sub(r'[^a-z0-9]', '', os.path.basename(os.getcwd()).lower())
+    containers = client.containers.list(filters={'label': [
+        'com.docker.compose.project=%s' % project,
+        'com.docker.compose.service=%s' % service]})
+    if not containers:
+        raise ValueError('No %s container running in project %s, start it '
+                         'with docker-compose up' % (service, project))
+    return containers[0]
+
+
+def _wait_healthy(container, timeout):
+    '''
+    Wait for the healthcheck of docker-compose.override.yml to pass,
+    or only for the container to run when it has no healthcheck
+    '''
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        container.reload()
+        state = container.attrs['State']
+        if state.get('Status') != 'running':
+            raise RuntimeError('%s is %s' % (container.name,
+                                             state.get('Status')))
+        if state.get('Health', {}).get('Status', 'healthy') == 'healthy':
+            return
+        time.sleep(1)
+    raise RuntimeError('%s not healthy after %ds' % (container.name,
+                                                     timeout))
+
+
+def _install_pool_conf(container, content):
+    '''
+    Replace the pool configuration of the php-fpm container and restart
+    it, the image is left as it is
+    '''
+    data = content.encode('UTF-8')
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        info = tarfile.TarInfo(os.path.basename(php_fpm_tuning['pool_conf']))
+        info.size = len(data)
+        info.mode = 0o644
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(data))
+    if not container.put_archive(
+            os.path.dirname(php_fpm_tuning['pool_conf']),
+            archive.getvalue()):
+        raise RuntimeError('Unable to copy the pool configuration in %s' %
+                           container.name)
+    container.restart()
+    _wait_healthy(container, php_fpm_startup['deadline'])
+
+
+def pool_conf(max_children):
+    '''
+    php-fpm-pool.conf of the tuning profile with max_children children,
+    the spare servers are kept within the new limit
+    '''
+    cpus, memory = host_resources()
+    profile = php_fpm_profile(php_fpm_tuning['cpus'] or cpus,
+                              php_fpm_tuning['memory'] or memory,
+                              _wordpress_php_files())
+    profile['max_children'] = max_children
+    for name in ('min_spare_servers', 'max_spare_servers'):
+        profile[name] = min(profile[name], max_children)
+    profile['start_servers'] = (profile['min_spare_servers'] +
+                                profile['max_spare_servers']) // 2
+    return _template_env('.').get_template('php-fpm-pool.template') \
+        .render(profile)
+
+
+def _parse_mix(value):
+    mix = {}
+    for entry in value.split(','):
+        kind, _, weight = entry.partition('=')
+        if kind not in loadtest['paths']:
+            raise argparse.ArgumentTypeError(
+                'unknown request %s, use one of %s' % (
+                    kind, ', '.join(sorted(loadtest['paths']))))
+        try:
+            mix[kind] = float(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError('invalid weight %s' % weight)
+    return mix
+
+
+def _parse_sizes(value):
+    try:
+        sizes = [int(size) for size in value.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid pool sizes %s' % value)
+    if min(sizes) < 1:
+        raise argparse.ArgumentTypeError('pool sizes must be positive')
+    return sizes
+
+
+def loadtest_main(argv):
+    '''
+    The loadtest subcommand : measure the stack started by
+    docker-compose up, optionally once per php-fpm pool size
+    '''
+    parser = argparse.ArgumentParser(
+        prog='build_project.py loadtest',
+        description='Measure the throughput and latency of the stack '
+        'started with docker-compose up')
+    parser.add_argument('--url', default=loadtest['url'],
+                        help='Where apache listens (default: %(default)s)')
+    parser.add_argument('--host', default=apache_vhost['server_name'],
+                        help='Host header of the requests (default: '
+                        '%(default)s)')
+    parser.add_argument('-d', '--duration', type=float,
+                        default=loadtest['duration'],
+                        help='Seconds measured (default: %(default)s)')
+    parser.add_argument('-w', '--warmup', type=float,
+                        default=loadtest['warmup'],
+                        help='Seconds of requests sent before measuring '
+                        '(default: %(default)s)')
+    parser.add_argument('-c', '--concurrency', type=int,
+                        default=loadtest['concurrency'],
+                        help='Clients sending requests at the same time '
+                        '(default: %(default)s)')
+    parser.add_argument('--mix', type=_parse_mix,
+                        default=loadtest['mix'],
+                        help='Weight of each kind of request, like '
+                        'home=4,login=1,static=4,rest=1')
+    parser.add_argument('--pool-sizes', type=_parse_sizes,
+                        metavar='N,N,...',
+                        help='Restart php-fpm with each of these '
+                        'pm.max_children and measure them one after '
+                        'the other')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Append the results to FILE as JSON lines')
+    args = parser.parse_args(argv)
+
+    print('Load testing %s as %s with %d clients (%gs + %gs warmup)' % (
+        args.url, args.host, args.concurrency, args.duration, args.warmup))
+    steps = [None]
+    if args.pool_sizes:
+        try:
+            client = docker.from_env()
+            container = _compose_container(client, 'php-fpm')
+        except (ValueError, docker.errors.DockerException) as err:
+            print('Unable to find php-fpm : %s' % err)
+            return False
+        steps = args.pool_sizes
+
+    sweep = []
+    records = []
+    try:
+        for size in steps:
+            if size is not None:
+                print('php-fpm with %d children' % size, end='')
+                _install_pool_conf(container, pool_conf(size))
+                print('...Done.')
+            summary = loadtest_summary(
+                run_loadtest(args.url, args.host, args.mix, args.duration,
+                             args.warmup, args.concurrency),
+                args.duration)
+            print_loadtest(sorted(summary.items(),
+                                  key=lambda item: (item[0] == 'total',
+                                                    item[0])))
+            sweep.append((size, summary['total']))
+            now = int(time.time())
+            for kind, row in summary.items():
+                record = {'time': now, 'url': args.url, 'request': kind,
+                          'concurrency': args.concurrency,
+                          'max_children': size}
+                record.update(row)
+                records.append(record)
+    except (OSError, ValueError, RuntimeError, exceptions.TemplateNotFound,
+            docker.errors.DockerException) as err:
+        print('\nUnable to run the load test : %s' % err)
+        return False
+    finally:
+        if args.pool_sizes and os.path.exists('php-fpm-pool.conf'):
+            # Back to the configuration of the image
+            print('Restoring the php-fpm pool configuration', end='')
+            try:
+                with open('php-fpm-pool.conf', 'r') as f:
+                    _install_pool_conf(container, f.read())
+                print('...Done.')
+            except (OSError, RuntimeError,
+                    docker.errors.DockerException) as err:
+                print('\nUnable to restore the pool configuration : %s' %
+                      err)
+
+    if args.metrics:
+        with open(args.metrics, 'a') as f:
+            f.write(''.join('%s\n' % json.dumps(record, sort_keys=True)
+                            for record in records))
+    if args.pool_sizes:
+        print_loadtest([('%d' % size, row) for size, row in sweep],
+                       first_column='children')
+        usable = [(row['rps'], size) for size, row in sweep
+                  if row['error_rate'] <= loadtest['max_error_rate']]
+        if not usable:
+            print('Every pool size failed more than %g%% of the requests' %
+                  (loadtest['max_error_rate'] * 100))
+            return False
+        rps, size = max(usable)
+        print('Best : %d children (%.1f requests/s)' % (size, rps))
     return True
 
 
 def main():
-    parser = argparse.ArgumentParser()
+    # The build takes a list of projects, which leaves no room for
+    # argparse subcommands
+    if sys.argv[1:2] == ['loadtest']:
+        return loadtest_main(sys.argv[2:])
+
+    parser = argparse.ArgumentParser(
+        epilog='Run %(prog)s loadtest --help to measure the stack once '
+        'started')
     parser.add_argument('-a', '--alternate',
                         help='Use alternate deployment method',
                         action='store_true', default=False)
@@ -252,30 +3026,62 @@ def main():
     parser.add_argument('-s', '--subdomain',
                         help='Enable Wordpress multisite in subdomain mode',
                         action='store_true', default=False)
+    parser.add_argument('--cache-dir',
+                        help='Shared WordPress tarball cache directory '
+                        '(default: %s)' % wp_cache['dir'])
+    parser.add_argument('--no-cache',
+                        help='Do not use the shared tarball cache',
+                        action='store_true', default=False)
+    parser.add_argument('--cpus', type=int,
+                        help='CPUs php-fpm is tuned for (default: the '
+                        'CPUs available here)')
+    parser.add_argument('--memory', type=int,
+                        help='Memory in MB php-fpm is tuned for (default: '
+                        'the memory available here)')
+    parser.add_argument('--db-snapshot',
+                        help='Seed an empty database with a snapshot of '
+                        'an installed WordPress, made once per release '
+                        'and configuration',
+                        action='store_true',
+                        default=db_snapshot['enabled'])
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write the wall time, CPU time, peak RSS, '
+                        'bytes and files of every stage to FILE, as JSON '
+                        'lines or as a Prometheus textfile when it ends '
+                        'with .prom')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=os.cpu_count() or 1,
+                        help='Projects built at the same time in batch '
+                        'mode (default: %(default)s)')
+    parser.add_argument('projects', nargs='*', metavar='PROJECT',
+                        help='Build these project directories or compose '
+                        'files in batch instead of the current directory')
     args = parser.parse_args()
+    # The snapshot is installed with the custom php-fpm image
+    if args.alternate and args.db_snapshot:
+        parser.error('--db-snapshot needs the custom php-fpm image, it '
+                     'cannot be used with --alternate')
 
-    if get_latest_wp():
-        print('...Done.')
-        if extract_wp_tarball():
-            print('...Done.')
-            if setup_wp_source_tree():
-                print('...Done.')
-                if render_templates(args.multisite, args.subdomain):
-                    print('...Done.')
-                    if not args.alternate:
-                        create_php_fpm_image(args.multisite)
-                        print('...Done')
-                    print('Project creation completed')
-                    print('Use the following command to start the service :')
-                    print('    docker-compose up')
-                    print('')
-                    vars = _getvars('docker-compose.yml')
-                    print('You can connect to wordpress with :')
-                    print('   username : %s' % vars['wp_user'])
-                    print('   password : %s' % vars['wp_password'])
-                    return True
-    print('Giving up')
-    return False
+    if args.no_cache:
+        wp_cache['dir'] = None
+    elif args.cache_dir:
+        wp_cache['dir'] = args.cache_dir
+    php_fpm_tuning['cpus'] = args.cpus
+    php_fpm_tuning['memory'] = args.memory
+
+    if args.projects:
+        return build_projects(args)
+
+    stages = project_stages(args)
+    ok = run_pipeline(stages)
+    if args.metrics:
+        write_metrics(args.metrics, stage_records(stages, os.getcwd()))
+    if not ok:
+        print('Giving up')
+        return False
+
+    _print_usage()
+    return True
 
 
 if __name__ == '__main__':
@@ -1,23 +1,65 @@
 #!/bin/bash
-# init.sh script
-
-# Install WordPress
-STOPPED=1
-COUNTER=10
-TIMEOUT=5
-while [ $STOPPED -ne 0 ] && [ $COUNTER -ne 0 ]; do
-    COUNTER=`expr $COUNTER - 1`
-    sleep $TIMEOUT
-    #nc -z mariadb 3306 -w 1
-    /opt/bitnami/php/bin/php -r 'mysqli_connect("mariadb", "wordpress", "my-password", null, 3306) or exit(1);'
-    STOPPED=$?
-    if [ $STOPPED -ne 0 ]; then
-    	echo "mariadb: not started yet"
+# Rendered by build_project.py from php-fpm_entrypoint.sh.template
+
+MARKER=/tmp/php-fpm.ready
+
+# Healthcheck of docker-compose.override.yml
+if [ "$1" = "--ready" ]; then
+    [ -f "$MARKER" ] && (exec 3<>/dev/tcp/127.0.0.1/9000) 2> /dev/null
+    exit
+fi
+
+rm -f "$MARKER"
+DB_USER=wordpress
+DB_PASSWORD=my-password
+DEADLINE=$((SECONDS + 120))
+START=$(date +%s%3N)
+
+# Probe mariadb with exponential backoff, the port first as it is cheap
+# to check, then the credentials, which needs a PHP interpreter
+probe() {
+    local delay=20
+    until "$@"; do
+        if [ $SECONDS -ge $DEADLINE ]; then
+            return 1
+        fi
+        sleep $(printf '%d.%03d' $((delay / 1000)) $((delay % 1000)))
+        delay=$((delay * 2))
+        if [ $delay -gt 250 ]; then
+            delay=250
+        fi
+    done
+}
+
+port_open() {
+    (exec 3<>/dev/tcp/mariadb/3306) 2> /dev/null
+}
+
+can_connect() {
+    /opt/bitnami/php/bin/php -r \
+        '@mysqli_connect("mariadb", $argv[1], $argv[2], null, 3306) or exit(1);' \
+        -- "$DB_USER" "$DB_PASSWORD"
+}
+
+INSTALLED=1
+if probe port_open && probe can_connect; then
+    echo "mariadb: ready after $(($(date +%s%3N) - START))ms"
+    # Install WordPress
+    INSTALLED=0
+    if [ -f /wp_automate.php ]; then
+        /opt/bitnami/php/bin/php /wp_automate.php 2> /dev/null
+        INSTALLED=$?
     fi
-done
+    if [ $INSTALLED -eq 0 ]; then
+        touch "$MARKER"
+    fi
+else
+    echo "mariadb: not ready after 120s, WordPress not installed"
+fi
 
-if [ -f /wp_automate.php ]; then
-    /opt/bitnami/php/bin/php /wp_automate.php 2> /dev/null
+# The database snapshot stage of build_project.py only installs WordPress
+if [ "$1" = "--install" ]; then
+    exit $INSTALLED
 fi
 
-exec /app-entrypoint.sh "$@"
+exec /app-entrypoint.sh "$@"
\ No newline at end of file
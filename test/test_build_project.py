@@ -7,7 +7,34 @@ import tarfile
 import subprocess
 import tempfile
 import argparse
+import glob
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import multiprocessing
+import threading
+import requests
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from unittest.mock import patch, MagicMock
+from bench.standins import LocalServer, KeepAliveHandler, \
+    make_fake_tarball
+
+# Keep every test away from the shared artifact cache of the user, and
+# from the compiled templates stored there, the tests needing a cache
+# set their own
+_wp_cache = patch.dict(build_project.wp_cache, {'dir': None})
+
+
+def setUpModule():
+    _wp_cache.start()
+
+
+def tearDownModule():
+    _wp_cache.stop()
 
 
 class BuildProjectTests(unittest.TestCase):
@@ -22,8 +49,14 @@ class BuildProjectTests(unittest.TestCase):
         self.fake_md5_query.add_spec('read')
         self.fake_tarfile = MagicMock()
         self.fake_docker = MagicMock()
+        self.md5 = hashlib.md5(b'abc').hexdigest()
         self.workdir = tempfile.mkdtemp()
-        os.makedirs('%s/bitnami-docker-php-fpm/5.6' % self.workdir)
+        build_project.php_fpm['mirror'] = os.path.join(self.workdir,
+                                                       'mirror.git')
+        os.makedirs('%s/bitnami-docker-php-fpm/5.6/rootfs' % self.workdir)
+        with open('%s/bitnami-docker-php-fpm/5.6/rootfs/run.sh' %
+                  self.workdir, 'w') as script:
+            script.write('exec php-fpm\n')
         self.Dockerfile = os.path.join(self.workdir,
                                        'bitnami-docker-php-fpm/5.6',
                                        'Dockerfile')
@@ -31,13 +64,31 @@ class BuildProjectTests(unittest.TestCase):
             dfile.write('COPY rootfs /\n')
             dfile.write('    BITNAMI_IMAGE_VERSION="5.6.31-r0" \\\n')
             dfile.write('ENTRYPOINT ["/php-fpm_entrypoint.sh"]\n')
+        for name in ('php-fpm_entrypoint.sh', 'wp_automate.php',
+                     'wp_enable_network'):
+            with open(os.path.join(self.workdir, name), 'w') as custom:
+                custom.write('%s\n' % name)
+        for name in ('php-fpm-pool.template', 'opcache.template',
+                     'wordpress.conf.template',
+                     'php-fpm_entrypoint.sh.template',
+                     'docker-compose.override.yml.template',
+                     'mariadb.cnf.template'):
+            shutil.copy(name, self.workdir)
+        os.mkdir(os.path.join(self.workdir, 'apache-vhost'))
         self.compose = os.path.join(self.workdir, 'docker-compose.yml')
         with open(self.compose, 'w') as cfile:
-            cfile.write('start\nMARIADB_USER=0xdead\nMARIADB_PASSWORD=0xbeef\n'
-                        'MARIADB_ROOT_PASSWORD=root\nMARIADB_DATABASE=db\n'
-                        'WP_USER=hello\nWP_PASSWORD=world\n'
-                        'WP_EMAIL=root@localhost\nWP_SITE_NAME=One Project\n'
-                        'end\n')
+            cfile.write('services:\n'
+                        '  mariadb:\n'
+                        '    environment:\n'
+                        '      - MARIADB_USER=0xdead\n'
+                        '      - MARIADB_PASSWORD=0xbeef\n'
+                        '      - MARIADB_ROOT_PASSWORD=root\n'
+                        '      - MARIADB_DATABASE=db\n'
+                        '      # - WP_USER=commented\n'
+                        '      - WP_USER=hello\n'
+                        '      - WP_PASSWORD=world\n'
+                        '      - WP_EMAIL=root@localhost\n'
+                        '      - WP_SITE_NAME=One Project\n')
 
     @classmethod
     def tearDownClass(self):
@@ -45,8 +96,13 @@ class BuildProjectTests(unittest.TestCase):
 
     def tearDown(self):
         os.chdir(self.root)
-        if os.path.exists(os.path.join(self.workdir, 'wordpress')):
-            shutil.rmtree(os.path.join(self.workdir, 'wordpress'))
+        wordpress = os.path.join(self.workdir, 'wordpress')
+        if os.path.islink(wordpress):
+            os.remove(wordpress)
+        elif os.path.exists(wordpress):
+            shutil.rmtree(wordpress)
+        if os.path.exists(os.path.join(self.workdir, 'releases')):
+            shutil.rmtree(os.path.join(self.workdir, 'releases'))
 
     @patch('builtins.open')
     @patch('build_project.hashlib.md5')
@@ -55,6 +111,7 @@ class BuildProjectTests(unittest.TestCase):
         Check test with same MD5
         '''
         m_open.return_value = self.fake_file
+        self.fake_file.__enter__.return_value.read.side_effect = [b'a', b'']
         self.fake_md5_hash.hexdigest.return_value = 'a'
         m_md5.return_value = self.fake_md5_hash
         ret = build_project.check_md5_ok(None, 'a')
@@ -67,6 +124,7 @@ class BuildProjectTests(unittest.TestCase):
         Check test with different MD5
         '''
         m_open.return_value = self.fake_file
+        self.fake_file.__enter__.return_value.read.side_effect = [b'a', b'']
         self.fake_md5_hash.hexdigest.return_value = 'b'
         m_md5.return_value = self.fake_md5_hash
         ret = build_project.check_md5_ok(None, 'a')
@@ -80,37 +138,65 @@ class BuildProjectTests(unittest.TestCase):
         '''
         Check latest when file exist and has same md5
         '''
-        self.fake_md5_query.read.return_value = b'abc'
+        os.chdir(self.workdir)
+        self.fake_md5_query.read.return_value = self.md5.encode()
+        self.fake_md5_query.headers = {}
         m_urlopen.return_value = self.fake_md5_query
         ret = build_project.get_latest_wp()
         self.assertTrue(ret)
 
     @patch('build_project.urlopen')
     @patch('build_project.os.path.exists', return_value=True)
-    @patch('build_project.check_md5_ok', side_effect=(False, True))
-    @patch('builtins.open')
-    def test_get_latest_has_file_diff_md5(self, m_open, m_md5_ok,
+    @patch('build_project.check_md5_ok', return_value=False)
+    @patch('build_project.download_tarball', return_value=True)
+    def test_get_latest_has_file_diff_md5(self, m_download, m_md5_ok,
                                           m_path_exists, m_urlopen):
         '''
         Check latest when file exist and has different md5
         '''
-        m_open.return_value = self.fake_file
+        os.chdir(self.workdir)
+        self.fake_md5_query.read.return_value = self.md5.encode()
+        self.fake_md5_query.headers = {}
+        m_urlopen.return_value = self.fake_md5_query
         ret = build_project.get_latest_wp()
         self.assertTrue(ret)
+        m_download.assert_called_once_with(self.wp_latest['url'],
+                                           self.wp_latest['file'], self.md5)
 
     @patch('build_project.urlopen')
     @patch('build_project.os.path.exists', return_value=True)
-    @patch('build_project.check_md5_ok', side_effect=(False, False))
-    @patch('builtins.open')
-    def test_get_latest_has_file_diff_md5_twice(self, m_open, m_md5_ok,
+    @patch('build_project.check_md5_ok', return_value=False)
+    @patch('build_project.download_tarball', return_value=False)
+    def test_get_latest_has_file_diff_md5_twice(self, m_download, m_md5_ok,
                                                 m_path_exists, m_urlopen):
         '''
         Check latest when file exist and has different md5 twice
         '''
-        m_open.return_value = self.fake_file
+        os.chdir(self.workdir)
+        self.fake_md5_query.read.return_value = self.md5.encode()
+        self.fake_md5_query.headers = {}
+        m_urlopen.return_value = self.fake_md5_query
         ret = build_project.get_latest_wp()
         self.assertFalse(ret)
 
+    def test_stream_to_file(self):
+        '''
+        Check the tarball is written and hashed chunk by chunk
+        '''
+        dest = os.path.join(self.workdir, 'stream.tar.gz')
+        data = os.urandom(build_project.CHUNK_SIZE * 3 + 17)
+        response = MagicMock()
+        response.read.side_effect = io.BytesIO(data).read
+        checksum = hashlib.md5()
+        ret = build_project.stream_to_file(response, dest, checksum)
+        self.assertEqual(ret, len(data))
+        self.assertEqual(checksum.hexdigest(), hashlib.md5(data).hexdigest())
+        response.read.assert_called_with(build_project.CHUNK_SIZE)
+        self.assertEqual(response.read.call_count, 5)
+        self.assertTrue(build_project.check_md5_ok(dest,
+                                                   checksum.hexdigest()))
+        os.remove(dest)
+
     @patch('build_project.urlopen', side_effect=ConnectionResetError)
     def test_get_latest_exception(self, m_urlopen):
         '''
@@ -119,50 +205,96 @@ class BuildProjectTests(unittest.TestCase):
         ret = build_project.get_latest_wp()
         self.assertFalse(ret)
 
+    @patch.dict('build_project.wp_extract', {'gzip': []})
     @patch('build_project.tarfile.open')
-    @patch('build_project.os.path.exists', return_value=True)
-    @patch('build_project.shutil.rmtree')
-    def test_extract_wp_tarball(self, m_rmtree, m_exists, m_tarfile):
+    def test_extract_wp_tarball(self, m_tarfile):
         '''
-        Test tarball cleanup and extraction
+        Test tarball extraction
         '''
+        os.chdir(self.workdir)
         m_tarfile.return_value = self.fake_tarfile
         ret = build_project.extract_wp_tarball()
-        m_rmtree.assert_called_once_with(self.wp_latest['dir'])
+        self.assertTrue(ret)
         m_tarfile.assert_called_once_with(self.wp_latest['file'], 'r')
-        self.fake_tarfile.extractall.assert_called_once_with()
+        self.fake_tarfile.extractall.assert_not_called()
         self.fake_tarfile.close.assert_called_once_with()
+        self.assertTrue(os.path.islink('wordpress'))
+        self.assertTrue(os.path.isdir('releases/current'))
 
-    @patch('build_project.os.path.exists', return_value=True)
-    @patch('build_project.shutil.rmtree', side_effect=PermissionError)
-    def test_extract_wp_tarball_cleanup_error(self, m_rmtree, m_exists):
+    @patch('build_project.tarfile.open')
+    @patch('build_project.os.remove', side_effect=PermissionError)
+    def test_extract_wp_tarball_cleanup_error(self, m_remove, m_tarfile):
         '''
         Test cleanup exception handling
         '''
+        os.chdir(self.workdir)
+        os.mkdir('wordpress')
+        open('wordpress/gone.php', 'w').close()
+        with open('wordpress.manifest', 'w') as manifest:
+            json.dump({'wordpress/gone.php': [0, 0, '']}, manifest)
         ret = build_project.extract_wp_tarball()
         self.assertFalse(ret)
+        self.assertFalse(os.path.exists('releases/.staging'))
 
+    @patch.dict('build_project.wp_extract', {'gzip': []})
     @patch('build_project.tarfile.open', side_effect=tarfile.TarError)
     @patch('build_project.os.path.exists', return_value=False)
     def test_extract_wp_tarball_tar_exception(self, m_exists, m_tarfile):
         '''
         Test tarball cleanup and extraction
         '''
+        os.chdir(self.workdir)
         ret = build_project.extract_wp_tarball()
         self.assertFalse(ret)
         output = sys.stdout.getvalue().strip()
         self.assertEquals(output, 'Extracting new tarball\n'
                           'Unable to extract the tarball :')
 
-    @patch('build_project.os.getcwd', return_value='/home')
+    def make_source_tree(self):
+        os.chdir(self.workdir)
+        os.makedirs('wordpress/wp-includes')
+        open('wordpress/index.php', 'w').close()
+        open('wordpress/wp-includes/version.php', 'w').close()
+        os.symlink('wp-includes', 'wordpress/link')
+        return os.stat('wordpress/index.php').st_gid
+
+    @patch('build_project.os.lchown', side_effect=PermissionError)
     @patch('build_project.docker.from_env')
-    def test_setup_wp_tree(self, m_docker, m_cwd):
+    def test_setup_wp_tree(self, m_docker, m_lchown):
         '''
-        Test wp source tree setup
+        Test wp source tree setup falls back to a single container run
         '''
+        gid = self.make_source_tree()
         m_docker.return_value = self.fake_docker
-        ret = build_project.setup_wp_source_tree()
+        self.fake_docker.reset_mock()
+        with patch.dict(build_project.wp_extract, {'gid': gid + 1}):
+            ret = build_project.setup_wp_source_tree()
+        self.assertTrue(ret)
         self.assertEquals(self.fake_docker.containers.run.call_count, 1)
+        kwargs = self.fake_docker.containers.run.call_args[1]
+        self.assertEqual(kwargs['volumes'],
+                         {os.path.join(self.workdir, 'wordpress'):
+                          {'bind': '/app'}})
+        self.assertEqual(kwargs['command'][:4],
+                         ['find', '/app', '!', '-group'])
+
+    @patch('build_project.os.lchown')
+    @patch('build_project.docker.from_env')
+    def test_setup_wp_tree_in_process(self, m_docker, m_lchown):
+        '''
+        Test wp source tree setup only changes entries in the wrong group
+        '''
+        gid = self.make_source_tree()
+        with patch.dict(build_project.wp_extract, {'gid': gid}):
+            self.assertTrue(build_project.setup_wp_source_tree())
+        m_lchown.assert_not_called()
+        with patch.dict(build_project.wp_extract, {'gid': gid + 1}):
+            self.assertTrue(build_project.setup_wp_source_tree())
+        self.assertEqual(m_lchown.call_count, 5)
+        m_lchown.assert_any_call(os.path.join(self.workdir, 'wordpress',
+                                              'link'), -1, gid + 1)
+        m_docker.assert_not_called()
+        self.assertRegex(sys.stdout.getvalue(), r'5 entries changed in')
 
     @patch('build_project.os.path.exists', return_value=True)
     @patch('build_project.shutil.rmtree', side_effect=PermissionError)
@@ -170,7 +302,7 @@ class BuildProjectTests(unittest.TestCase):
         '''
         Test git repo cleanup with exception handling
         '''
-        ret = build_project.create_php_fpm_image()
+        ret = build_project.checkout_php_fpm_image()
         self.assertFalse(ret)
 
     @patch('build_project.os.path.exists', return_value=False)
@@ -180,47 +312,285 @@ class BuildProjectTests(unittest.TestCase):
         '''
         Test git repo cleanup with exception handling
         '''
-        ret = build_project.create_php_fpm_image()
+        ret = build_project.checkout_php_fpm_image()
         self.assertFalse(ret)
 
     @patch('build_project.os.path.exists', return_value=False)
+    @patch('build_project.subprocess.check_output', return_value=b'abc\n')
     @patch('build_project.subprocess.check_call')
-    @patch('build_project.shutil.copy', side_effect=OSError)
-    def test_git_repo_customfile_copy_with_exception(self,
-                                                     m_copy, m_sub, m_exists):
+    @patch('build_project.build_context', side_effect=OSError('No space'))
+    @patch('build_project.docker.from_env')
+    def test_git_repo_context_with_exception(self, m_docker, m_context,
+                                             m_sub, m_rev, m_exists):
         '''
-        Test git repo creation, custom file copy with exception
+        Test git repo creation, build context assembly with exception
         '''
+        os.chdir(self.workdir)
+        m_docker.return_value = self.fake_docker
+        self.assertTrue(build_project.checkout_php_fpm_image())
         ret = build_project.create_php_fpm_image()
         self.assertFalse(ret)
+        self.assertIn('Unable to assemble the build context : No space',
+                      sys.stdout.getvalue())
 
     @patch('build_project.os.path.exists', return_value=False)
+    @patch('build_project.subprocess.check_output', return_value=b'abc\n')
     @patch('build_project.subprocess.check_call')
     @patch('build_project.shutil.copy')
     @patch('build_project.docker.from_env')
     def test_git_repo_dockerfile_fix_with_exception(self, m_docker, m_copy,
-                                                    m_sub, m_exists):
+                                                    m_sub, m_rev, m_exists):
         '''
         Test Dockerfile modification in git repo with exception
         '''
         os.chdir(self.workdir)
+        self.checkout_dockerfile()
         m_docker.return_value = self.fake_docker
+        self.assertTrue(build_project.checkout_php_fpm_image())
         ret = build_project.create_php_fpm_image()
         self.assertEquals(self.fake_docker.images.build.call_args[1]['tag'],
                           'php-fpm:5.6.31-r0-custom')
 
-    @patch('build_project.os.path.exists', return_value=False)
-    @patch('build_project.subprocess.check_call')
-    @patch('build_project.shutil.copy')
-    @patch('build_project.docker.from_env')
-    def test_git_repo_custom_files_with_multisite(self, m_docker, m_copy,
-                                                  m_sub, m_exists):
+    def test_git_repo_custom_files_with_multisite(self):
         '''
-        Test custom files copy with multisite enabled and exception
+        Test custom files sent with multisite enabled
+        '''
+        self.build_image()
+        names = tarfile.open(fileobj=io.BytesIO(self.contexts[-1])) \
+            .getnames()
+        for name in ('php-fpm_entrypoint.sh', 'php-fpm-pool.conf',
+                     'opcache.ini', 'wp_enable_network', 'wp_automate.php'):
+            self.assertIn(name, names)
+
+    def checkout_dockerfile(self):
+        '''
+        Dockerfile as the checkout, which the mocked git leaves alone,
+        would bring it
+        '''
+        with open(self.Dockerfile, 'w') as dfile:
+            dfile.write('COPY rootfs /\n')
+            dfile.write('    BITNAMI_IMAGE_VERSION="5.6.31-r0" \\\n')
+            dfile.write('ENTRYPOINT ["/app-entrypoint.sh"]\n')
+
+    def build_image(self, labels=None, commit=b'abc\n', unique_tag=False,
+                    base_url='http+docker://localhost'):
+        '''
+        Check out and build the image against the Dockerfile fixture with
+        an existing image carrying labels
         '''
         os.chdir(self.workdir)
-        ret = build_project.create_php_fpm_image(True)
-        self.assertEquals(m_copy.call_count, 3)
+        self.checkout_dockerfile()
+        client = MagicMock()
+        client.api.base_url = base_url
+        client.images.get.return_value.labels = labels or {}
+        # The context is gone once the build returns
+        self.contexts = []
+        self.context_files = []
+
+        def build(fileobj, **kwargs):
+            # requests sizes the body it streams this way
+            self.context_files.append((fileobj,
+                                       requests.utils.super_len(fileobj)))
+            self.contexts.append(fileobj.read())
+        client.images.build.side_effect = build
+        with patch('build_project.os.path.exists', return_value=False), \
+                patch('build_project.subprocess.check_call'), \
+                patch('build_project.subprocess.check_output',
+                      return_value=commit), \
+                patch('build_project.shutil.copy'), \
+                patch('build_project.docker.from_env', return_value=client):
+            self.assertTrue(build_project.checkout_php_fpm_image(True))
+            self.assertTrue(build_project.create_php_fpm_image(
+                True, unique_tag=unique_tag))
+        return client
+
+    def test_php_fpm_image_layers(self):
+        '''
+        Test the custom files are copied last, wp_automate.php on top
+        '''
+        client = self.build_image()
+        with open(self.Dockerfile) as dfile:
+            lines = dfile.read().splitlines()
+        self.assertEqual(lines[2:], [
+            'ENTRYPOINT ["/php-fpm_entrypoint.sh"]',
+            'COPY php-fpm_entrypoint.sh /php-fpm_entrypoint.sh',
+            'COPY php-fpm-pool.conf %s' % build_project.php_fpm_tuning[
+                'pool_conf'],
+            'COPY opcache.ini %s' % build_project.php_fpm_tuning[
+                'opcache_ini'],
+            'COPY wp_enable_network /wp_enable_network',
+            'COPY wp_automate.php /wp_automate.php'])
+        kwargs = client.images.build.call_args[1]
+        self.assertNotIn('nocache', kwargs)
+        self.assertIn(build_project.IMAGE_INPUTS_LABEL, kwargs['labels'])
+
+    def test_php_fpm_image_context(self):
+        '''
+        Test only what the Dockerfile copies is sent, gzipped to a
+        remote daemon
+        '''
+        client = self.build_image()
+        kwargs = client.images.build.call_args[1]
+        self.assertTrue(kwargs['custom_context'])
+        self.assertIsNone(kwargs['encoding'])
+        with tarfile.open(fileobj=io.BytesIO(self.contexts[-1])) as tar:
+            names = tar.getnames()
+            self.assertEqual(tar.getmember('wp_automate.php').uid, 0)
+        self.assertEqual(sorted(names), [
+            '.dockerignore', 'Dockerfile', 'opcache.ini',
+            'php-fpm-pool.conf', 'php-fpm_entrypoint.sh', 'rootfs',
+            'rootfs/run.sh', 'wp_automate.php', 'wp_enable_network'])
+        self.assertIn('(context of 8 files, ', sys.stdout.getvalue())
+        with open(os.path.join(os.path.dirname(self.Dockerfile),
+                               '.dockerignore')) as ignore:
+            lines = ignore.read().splitlines()
+        self.assertEqual(lines[1:4], ['*', '!opcache.ini',
+                                      '!php-fpm-pool.conf'])
+        self.assertIn('!rootfs', lines)
+
+        client = self.build_image(base_url='http://10.0.0.1:2375')
+        self.assertEqual(client.images.build.call_args[1]['encoding'],
+                         'gzip')
+        with tarfile.open(fileobj=io.BytesIO(self.contexts[-1]),
+                          mode='r:gz') as tar:
+            self.assertIn('rootfs/run.sh', tar.getnames())
+        self.assertIn('KB gzipped)', sys.stdout.getvalue())
+
+    def test_php_fpm_image_context_memory(self):
+        '''
+        Test the context stays in memory once requests sized it, and
+        only goes to a temporary file above CONTEXT_MEMORY
+        '''
+        self.build_image()
+        fileobj, length = self.context_files[-1]
+        self.assertIsInstance(fileobj, io.BytesIO)
+        self.assertEqual(length, len(self.contexts[-1]))
+
+        with patch('build_project.CONTEXT_MEMORY', 4096):
+            self.build_image()
+        fileobj, length = self.context_files[-1]
+        self.assertNotIsInstance(fileobj, io.BytesIO)
+        self.assertGreater(length, 4096)
+        self.assertEqual(length, len(self.contexts[-1]))
+        self.assertIn('rootfs/run.sh', tarfile.open(
+            fileobj=io.BytesIO(self.contexts[-1])).getnames())
+
+    def test_dockerfile_sources(self):
+        '''
+        Test the COPY and ADD sources are read in every form
+        '''
+        os.chdir(self.workdir)
+        with open('Dockerfile.sources', 'w') as dfile:
+            dfile.write('FROM bitnami/minideb\n'
+                        'COPY rootfs /\n'
+                        'ADD ["./conf/a b.ini", "/etc/"]\n'
+                        'COPY --chown=1001 app \\\n    /app\n'
+                        'COPY --from=builder /usr/bin/php /usr/bin/\n'
+                        'ADD https://example.com/x.tar.gz /tmp/\n'
+                        'RUN cp rootfs/a /b\n')
+        self.assertEqual(build_project._dockerfile_sources(
+            'Dockerfile.sources'), ['rootfs', 'conf/a b.ini', 'app'])
+        os.remove('Dockerfile.sources')
+
+    def test_php_fpm_image_up_to_date(self):
+        '''
+        Test the image is only rebuilt when one of its inputs changed
+        '''
+        client = self.build_image()
+        labels = client.images.build.call_args[1]['labels']
+        client = self.build_image(labels)
+        client.images.build.assert_not_called()
+        self.assertIn('(up to date)', sys.stdout.getvalue())
+        client = self.build_image(labels, commit=b'def\n')
+        client.images.build.assert_called_once()
+        with open(os.path.join(self.workdir, 'wp_automate.php'), 'a') as f:
+            f.write('edited\n')
+        client = self.build_image(labels)
+        client.images.build.assert_called_once()
+
+    def test_php_fpm_image_unique_tag(self):
+        '''
+        Test the batch tag holds the inputs hash and lands in .env
+        '''
+        os.chdir(self.workdir)
+        with open('.env', 'w') as env:
+            env.write('COMPOSE_PROJECT_NAME=one\nPHP_FPM_IMAGE=old\n')
+        client = self.build_image()
+        kwargs = client.images.build.call_args[1]
+        digest = kwargs['labels'][build_project.IMAGE_INPUTS_LABEL]
+        tag = 'php-fpm:5.6.31-r0-custom-%s' % digest[:12]
+        self.assertEqual(kwargs['tag'], 'php-fpm:5.6.31-r0-custom')
+        client = self.build_image(unique_tag=True)
+        self.assertEqual(client.images.build.call_args[1]['tag'], tag)
+        with open('.env') as env:
+            self.assertEqual(env.read(), 'COMPOSE_PROJECT_NAME=one\n'
+                             'PHP_FPM_IMAGE=%s\n' % tag)
+        os.remove('.env')
+
+    def test_load_config(self):
+        '''
+        Test dict environments, env files and values holding =
+        '''
+        os.chdir(self.workdir)
+        with open('project.env', 'w') as env:
+            env.write('# WP_USER=commented\nWP_USER=from-env-file\n'
+                      'WP_PASSWORD=a=b\n\nWP_EMAIL\n')
+        with open('compose.yml', 'w') as cfile:
+            cfile.write('services:\n'
+                        '  mariadb:\n'
+                        '    env_file: project.env\n'
+                        '    environment:\n'
+                        '      MARIADB_USER: user  # inline comment\n'
+                        '      MARIADB_PASSWORD: 1234\n'
+                        '      MARIADB_PORT_NUMBER: 3306\n'
+                        '      WP_SITE_NAME:\n'
+                        '  php-fpm:\n'
+                        '    image: php-fpm\n')
+        with patch.dict(os.environ, {'WP_EMAIL': 'shell@localhost'}):
+            config = build_project.load_config('compose.yml')
+        self.assertEqual(config.mariadb_user, 'user')
+        self.assertEqual(config.mariadb_password, '1234')
+        self.assertEqual(config.wp_user, 'from-env-file')
+        self.assertEqual(config.wp_password, 'a=b')
+        self.assertEqual(config.wp_email, 'shell@localhost')
+        self.assertEqual(config.wp_site_name, 'My Bitnami Project')
+        self.assertEqual(config.as_dict()['mariadb_port_number'], '3306')
+        with self.assertRaises(AttributeError):
+            config.unknown = True
+
+    def test_load_config_cache(self):
+        '''
+        Test the config is only parsed again when a file changed
+        '''
+        os.chdir(self.workdir)
+        with open('compose.yml', 'w') as cfile:
+            cfile.write('services:\n  mariadb:\n    env_file: [cache.env]\n')
+        with open('cache.env', 'w') as env:
+            env.write('WP_USER=one\n')
+        with patch('build_project.yaml.safe_load',
+                   side_effect=build_project.yaml.safe_load) as m_load:
+            config = build_project.load_config('compose.yml')
+            self.assertIs(build_project.load_config('compose.yml'), config)
+            os.utime('compose.yml', ns=(0, 0))
+            self.assertIs(build_project.load_config('compose.yml'), config)
+            self.assertEqual(m_load.call_count, 1)
+            with open('cache.env', 'w') as env:
+                env.write('WP_USER=two\n')
+            os.utime('cache.env', ns=(0, 0))
+            self.assertEqual(build_project.load_config('compose.yml').wp_user,
+                             'two')
+            self.assertEqual(m_load.call_count, 2)
+
+    def test_load_config_invalid(self):
+        '''
+        Test a file which is not a compose file is rejected
+        '''
+        os.chdir(self.workdir)
+        for content in ('services: [\n', 'MARIADB_USER=user\n'):
+            with open('invalid.yml', 'w') as cfile:
+                cfile.write(content)
+            with self.assertRaises(ValueError):
+                build_project.load_config('invalid.yml')
 
     def test_getvars(self):
         '''
@@ -316,6 +686,212 @@ class BuildProjectTests(unittest.TestCase):
         self.assertRegex(lines, r'MULTISITE')
         self.assertRegex(lines, r"SUBDOMAIN_INSTALL', true")
 
+    def test_template_rendering_target(self):
+        '''
+        Test only the templates of the target directory are rendered
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        os.chdir(self.workdir)
+        os.remove('wp_automate.php')
+        ret = build_project.render_templates(target='.')
+        self.assertTrue(ret)
+        self.assertTrue(os.path.exists('wp_automate.php'))
+        self.assertFalse(os.path.exists('wordpress'))
+
+    def test_template_rendering_unchanged(self):
+        '''
+        Test outputs are only rewritten when their content changes
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        shutil.copy('wp_enable_network.template', self.workdir)
+        os.chdir(self.workdir)
+        self.assertTrue(build_project.render_templates(True, target='.'))
+        os.chmod('wp_enable_network', 0o644)
+        os.utime('wp_automate.php', ns=(0, 0))
+        inode = os.stat('wp_automate.php').st_ino
+        self.assertTrue(build_project.render_templates(True, target='.'))
+        self.assertIn('(0 written, 5 unchanged)', sys.stdout.getvalue())
+        self.assertEqual(os.stat('wp_automate.php').st_mtime_ns, 0)
+        self.assertEqual(os.stat('wp_automate.php').st_ino, inode)
+        self.assertEqual(os.stat('wp_enable_network').st_mode & 0o777, 0o750)
+
+        context = build_project._getvars('docker-compose.yml')
+        context['wp_user'] = 'other'
+        with patch('build_project._getvars', return_value=context):
+            self.assertTrue(build_project.render_templates(True, target='.'))
+        self.assertIn('(1 written, 4 unchanged)', sys.stdout.getvalue())
+        self.assertNotEqual(os.stat('wp_automate.php').st_mtime_ns, 0)
+
+    def test_template_rendering_automate(self):
+        '''
+        Test the provisioning settings reach wp_automate.php as JSON
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        os.chdir(self.workdir)
+        context = build_project._getvars('docker-compose.yml')
+        context.update({'wp_password': 'it\'s "quoted" \\',
+                        'wp_seed_users': 5})
+        with patch('build_project._getvars', return_value=context):
+            self.assertTrue(build_project.render_templates(target='.'))
+        with open('wp_automate.php') as automate:
+            lines = automate.read()
+        settings = json.loads(lines.split("<<<'JSON'\n")[1].split(
+            '\nJSON\n')[0])
+        self.assertEqual(settings['password'], 'it\'s "quoted" \\')
+        self.assertEqual(settings['db_user'], '0xdead')
+        self.assertEqual(settings['seed_users'], 5)
+        self.assertEqual(settings['seed_sites'], 0)
+        self.assertEqual(settings['url'], 'http://wordpress.example.com')
+        self.assertNotIn('MD5(', lines)
+
+    def test_template_rendering_entrypoint(self):
+        '''
+        Test the entrypoint gets the credentials and its healthcheck
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        os.chdir(self.workdir)
+        context = build_project._getvars('docker-compose.yml')
+        context['mariadb_password'] = "it's secret"
+        marker = os.path.join(self.workdir, 'ready')
+        with patch('build_project._getvars', return_value=context), \
+                patch.dict(build_project.php_fpm_startup,
+                           {'marker': marker}):
+            self.assertTrue(build_project.render_templates(target='.'))
+        with open('php-fpm_entrypoint.sh') as entrypoint:
+            lines = entrypoint.read()
+        self.assertIn("DB_USER=0xdead\n", lines)
+        self.assertIn("DB_PASSWORD='it'\"'\"'s secret'\n", lines)
+        self.assertIn('DEADLINE=$((SECONDS + 120))', lines)
+        self.assertEqual(os.stat('php-fpm_entrypoint.sh').st_mode & 0o777,
+                         0o755)
+        # Not ready as long as the marker is missing
+        self.assertNotEqual(subprocess.call(['bash', 'php-fpm_entrypoint.sh',
+                                             '--ready']), 0)
+
+        with open('docker-compose.override.yml') as override:
+            healthcheck = yaml.safe_load(override)['services']['php-fpm'][
+                'healthcheck']
+        self.assertEqual(healthcheck['test'], ['CMD', '/php-fpm_entrypoint.sh',
+                                               '--ready'])
+        self.assertEqual(healthcheck['retries'], 3)
+
+    def test_template_rendering_mariadb(self):
+        '''
+        Test mariadb.cnf is sized from the budget and mounted, and the
+        indexes reach wp_automate.php
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        os.chdir(self.workdir)
+        context = build_project._getvars('docker-compose.yml')
+        context['mariadb_memory'] = 1024
+        with patch('build_project._getvars', return_value=context), \
+                patch.dict(build_project.php_fpm_tuning,
+                           {'cpus': 2, 'memory': 2048}):
+            self.assertTrue(build_project.render_templates(target='.'))
+        with open('mariadb.cnf') as cnf:
+            lines = cnf.read()
+        self.assertIn('max_connections = 36\n', lines)
+        self.assertIn('innodb_buffer_pool_size = 656M\n', lines)
+        self.assertIn('innodb_log_file_size = 164M\n', lines)
+        self.assertIn('innodb_flush_method = O_DIRECT\n', lines)
+        self.assertIn('query_cache_type = 0\n', lines)
+
+        with open('docker-compose.override.yml') as override:
+            volumes = yaml.safe_load(override)['services']['mariadb'][
+                'volumes']
+        self.assertEqual(volumes, ['./mariadb.cnf:/bitnami/mariadb/conf/'
+                                   'my_custom.cnf:ro'])
+        # docker-compose does not merge the override with -f
+        with open(os.path.join(self.root,
+                               'docker-compose-alternate.yml')) as alternate:
+            self.assertIn(volumes[0], yaml.safe_load(alternate)[
+                'services']['mariadb']['volumes'])
+        with open('wp_automate.php') as automate:
+            settings = json.loads(automate.read().split("<<<'JSON'\n")[1]
+                                  .split('\nJSON\n')[0])
+        self.assertEqual(settings['indexes']['options'],
+                         {'autoload': 'autoload'})
+        self.assertIn('post_id_meta_key', settings['indexes']['postmeta'])
+
+    def test_template_bytecode_cache(self):
+        '''
+        Test compiled templates are shared through the artifact cache
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        os.chdir(self.workdir)
+        cache = os.path.join(self.workdir, 'cache')
+        with patch.dict(build_project.wp_cache, {'dir': cache}):
+            env = build_project._template_env('.')
+            self.assertIs(build_project._template_env('.'), env)
+            self.assertTrue(build_project.render_templates(target='.'))
+            self.assertTrue(os.listdir(os.path.join(cache, 'templates')))
+            # A new process only loads the bytecode
+            with patch.dict(build_project._template_envs, clear=True), \
+                    patch.object(build_project.Environment, 'compile',
+                                 side_effect=AssertionError):
+                self.assertTrue(build_project.render_templates(target='.'))
+        shutil.rmtree(cache)
+
+    def test_template_bytecode_cache_projects(self):
+        '''
+        Test projects in other directories load the compiled templates
+        and only the most recently used ones are kept
+        '''
+        shutil.copy('wp_automate.template', self.workdir)
+        cache = os.path.join(self.workdir, 'cache')
+        for project in ('one', 'two'):
+            os.makedirs(os.path.join(self.workdir, project))
+            for name in glob.glob(os.path.join(self.workdir, '*.template')) \
+                    + [self.compose]:
+                shutil.copy(name, os.path.join(self.workdir, project))
+        with patch.dict(build_project.wp_cache, {'dir': cache}), \
+                patch.dict(build_project._template_envs, clear=True):
+            os.chdir(os.path.join(self.workdir, 'one'))
+            self.assertTrue(build_project.render_templates(target='.'))
+            compiled = sorted(os.listdir(os.path.join(cache, 'templates')))
+            self.assertTrue(compiled)
+            os.chdir(os.path.join(self.workdir, 'two'))
+            with patch.object(build_project.Environment, 'compile',
+                              side_effect=AssertionError):
+                self.assertTrue(build_project.render_templates(target='.'))
+            self.assertEqual(sorted(os.listdir(os.path.join(cache,
+                                                            'templates'))),
+                             compiled)
+            # An edited template is compiled again
+            with open('wp_automate.template', 'a') as template:
+                template.write('\n')
+            with patch.object(build_project._template_env('.').bytecode_cache,
+                              'max_files', 1):
+                self.assertTrue(build_project.render_templates(target='.'))
+            self.assertEqual(len(os.listdir(os.path.join(cache,
+                                                         'templates'))), 1)
+            self.assertNotIn(os.listdir(os.path.join(cache, 'templates'))[0],
+                             compiled)
+        shutil.rmtree(cache)
+
+    def test_template_rendering_vhost(self):
+        '''
+        Test the vhost compression, caching and FastCGI pool settings
+        '''
+        os.chdir(self.workdir)
+        with patch.dict(build_project.apache_vhost, {'brotli': True,
+                                                     'fcgi_max': 8}), \
+                patch.dict(build_project.wp_precompress,
+                           {'encodings': ['gzip']}):
+            ret = build_project.render_templates(target='apache-vhost')
+        self.assertTrue(ret)
+        with open('apache-vhost/wordpress.conf') as vhost:
+            lines = vhost.read()
+        self.assertIn('ProxySet enablereuse=on max=8 connectiontimeout=5 '
+                      'timeout=300\n', lines)
+        self.assertIn('SetHandler "proxy:fcgi://php-fpm:9000"', lines)
+        self.assertRegex(lines, r'AddOutputFilterByType '
+                         r'BROTLI_COMPRESS;DEFLATE text/html ')
+        self.assertIn('ExpiresDefault "access plus 31536000 seconds"', lines)
+        self.assertIn('RewriteRule "\\.css\\.(gz)$" "-" [T=text/css,', lines)
+        self.assertIn('Header set Content-Encoding gzip', lines)
+        self.assertNotIn('{{', lines)
+
     def test_missing_rendering_templates(self):
         '''
         Test missing template error handling
@@ -326,35 +902,50 @@ class BuildProjectTests(unittest.TestCase):
 
     @patch('build_project.get_latest_wp', return_value=True)
     @patch('build_project.extract_wp_tarball', return_value=True)
+    @patch('build_project.precompress_assets', return_value=True)
     @patch('build_project.setup_wp_source_tree', return_value=True)
     @patch('build_project.render_templates', return_value=True)
+    @patch('build_project.checkout_php_fpm_image', return_value=True)
     @patch('build_project.create_php_fpm_image', return_value=True)
     @patch('build_project._getvars', return_value={'wp_user': 'a',
                                                    'wp_password': 'b'})
-    def test_main(self, m_getvars, m_image, m_templates, m_source,
-                  m_tarball, m_latest):
+    def test_main(self, m_getvars, m_image, m_checkout, m_templates,
+                  m_source, m_compress, m_tarball, m_latest):
         '''
         Test main execution logic
         '''
         build_project.sys.argv = ['main', ]
         ret = build_project.main()
         m_getvars.assert_called_once_with('docker-compose.yml')
-        m_image.assert_called_once_with(False)
-        m_templates.assert_called_once_with(False, False)
+        m_checkout.assert_called_once_with(False)
+        m_image.assert_called_once_with(False, unique_tag=False)
+        self.assertEqual(m_templates.call_count, 3)
+        m_templates.assert_any_call(
+            False, False, target='.', compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            False, False, target='apache-vhost',
+            compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            False, False, target='wordpress',
+            compose_file='docker-compose.yml')
         m_source.assert_called_once_with()
+        m_compress.assert_called_once_with()
         m_tarball.assert_called_once_with()
         m_latest.assert_called_once_with()
 
     @patch('argparse.ArgumentParser.parse_args')
     @patch('build_project.get_latest_wp', return_value=True)
     @patch('build_project.extract_wp_tarball', return_value=True)
+    @patch('build_project.precompress_assets', return_value=True)
     @patch('build_project.setup_wp_source_tree', return_value=True)
     @patch('build_project.render_templates', return_value=True)
+    @patch('build_project.checkout_php_fpm_image', return_value=True)
     @patch('build_project.create_php_fpm_image', return_value=True)
     @patch('build_project._getvars', return_value={'wp_user': 'a',
                                                    'wp_password': 'b'})
-    def test_main_alt(self, m_getvars, m_image, m_templates, m_source,
-                      m_tarball, m_latest, m_argparse):
+    def test_main_alt(self, m_getvars, m_image, m_checkout, m_templates,
+                      m_source, m_compress, m_tarball, m_latest,
+                      m_argparse):
         '''
         Test main execution logic with alternate on
         '''
@@ -363,32 +954,1360 @@ class BuildProjectTests(unittest.TestCase):
         args.alternate = True
         args.multisite = False
         args.subdomain = False
+        args.cache_dir = None
+        args.no_cache = False
+        args.jobs = 1
+        args.cpus = None
+        args.memory = None
+        args.db_snapshot = False
+        args.metrics = None
+        args.projects = []
         m_argparse.return_value = args
         ret = build_project.main()
         m_getvars.assert_called_once_with('docker-compose.yml')
-        m_image.assert_not_called
-        m_templates.assert_called_once_with(False, False)
+        m_checkout.assert_not_called()
+        m_image.assert_not_called()
+        self.assertEqual(m_templates.call_count, 3)
+        m_templates.assert_any_call(
+            False, False, target='.', compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            False, False, target='apache-vhost',
+            compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            False, False, target='wordpress',
+            compose_file='docker-compose.yml')
         m_source.assert_called_once_with()
+        m_compress.assert_called_once_with()
         m_tarball.assert_called_once_with()
         m_latest.assert_called_once_with()
 
     @patch('build_project.get_latest_wp', return_value=True)
     @patch('build_project.extract_wp_tarball', return_value=True)
+    @patch('build_project.precompress_assets', return_value=True)
     @patch('build_project.setup_wp_source_tree', return_value=True)
     @patch('build_project.render_templates', return_value=True)
+    @patch('build_project.checkout_php_fpm_image', return_value=True)
     @patch('build_project.create_php_fpm_image', return_value=True)
     @patch('build_project._getvars', return_value={'wp_user': 'a',
                                                    'wp_password': 'b'})
-    def test_main_multisite(self, m_getvars, m_image, m_templates, m_source,
-                            m_tarball, m_latest):
+    def test_main_multisite(self, m_getvars, m_image, m_checkout,
+                            m_templates, m_source, m_compress, m_tarball,
+                            m_latest):
         '''
         Test main execution logic with multisite on
         '''
         build_project.sys.argv = ['main', '-m']
         ret = build_project.main()
         m_getvars.assert_called_once_with('docker-compose.yml')
-        m_image.assert_called_once_with(True)
-        m_templates.assert_called_once_with(True, False)
+        m_checkout.assert_called_once_with(True)
+        m_image.assert_called_once_with(True, unique_tag=False)
+        self.assertEqual(m_templates.call_count, 3)
+        m_templates.assert_any_call(
+            True, False, target='.', compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            True, False, target='apache-vhost',
+            compose_file='docker-compose.yml')
+        m_templates.assert_any_call(
+            True, False, target='wordpress',
+            compose_file='docker-compose.yml')
         m_source.assert_called_once_with()
+        m_compress.assert_called_once_with()
         m_tarball.assert_called_once_with()
         m_latest.assert_called_once_with()
+
+
+class DownloadTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(self):
+        self.srvdir = tempfile.mkdtemp()
+        self.md5 = make_fake_tarball(self.srvdir, 300 * 1024,
+                                     name='latest.tar.gz')
+        with open(os.path.join(self.srvdir, 'latest.tar.gz'), 'rb') as f:
+            self.data = f.read()
+        self.server = LocalServer(self.srvdir).__enter__()
+        self.url = self.server.url('latest.tar.gz')
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.__exit__()
+        shutil.rmtree(self.srvdir)
+
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        self.dest = os.path.join(self.workdir, 'latest.tar.gz')
+        self.partial = '%s.partial' % self.dest
+        del self.server.ranges[:]
+        del self.server.cuts[:]
+
+    def tearDown(self):
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def test_download_tarball(self):
+        '''
+        Test a plain download ends up renamed and verified
+        '''
+        ret = build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertTrue(ret)
+        self.assertEqual(self.server.ranges, [None])
+        self.assertFalse(os.path.exists(self.partial))
+        self.assertTrue(build_project.check_md5_ok(self.dest, self.md5))
+
+    def test_download_tarball_resume_partial(self):
+        '''
+        Test a partial file left by a previous run is resumed
+        '''
+        with open(self.partial, 'wb') as f:
+            f.write(self.data[:1000])
+        ret = build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertTrue(ret)
+        self.assertEqual(self.server.ranges, ['bytes=1000-'])
+        self.assertTrue(build_project.check_md5_ok(self.dest, self.md5))
+
+    def test_download_tarball_complete_partial(self):
+        '''
+        Test a partial file holding everything is only renamed
+        '''
+        with open(self.partial, 'wb') as f:
+            f.write(self.data)
+        ret = build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertTrue(ret)
+        self.assertEqual(self.server.ranges, ['bytes=%d-' % len(self.data)])
+        self.assertFalse(os.path.exists(self.partial))
+
+    def test_download_tarball_dropped_connection(self):
+        '''
+        Test transfers dropped halfway are resumed where they stopped
+        '''
+        self.server.cuts.extend([100000, 50000])
+        ret = build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertTrue(ret)
+        self.assertEqual(self.server.ranges,
+                         [None, 'bytes=100000-', 'bytes=150000-'])
+        self.assertTrue(build_project.check_md5_ok(self.dest, self.md5))
+
+    def test_download_tarball_too_many_drops(self):
+        '''
+        Test the partial file is kept when the transfer keeps dropping
+        '''
+        self.server.cuts.extend([1000] * build_project.DOWNLOAD_ATTEMPTS)
+        with self.assertRaises(http.client.IncompleteRead):
+            build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertEqual(os.path.getsize(self.partial),
+                         1000 * build_project.DOWNLOAD_ATTEMPTS)
+
+    def test_download_tarball_stale_partial(self):
+        '''
+        Test a partial file from another release is thrown away
+        '''
+        with open(self.partial, 'wb') as f:
+            f.write(b'x' * 1000)
+        ret = build_project.download_tarball(self.url, self.dest, self.md5)
+        self.assertTrue(ret)
+        self.assertEqual(self.server.ranges, ['bytes=1000-', None])
+        self.assertTrue(build_project.check_md5_ok(self.dest, self.md5))
+
+    @patch('build_project.download_tarball',
+           wraps=build_project.download_tarball)
+    def test_get_latest_not_modified(self, m_download):
+        '''
+        Test a warm run only does a conditional request for the MD5
+        '''
+        os.chdir(self.workdir)
+        # Without the artifact cache, which would serve the third run
+        with patch.dict(build_project.wp_latest,
+                        {'url': self.url,
+                         'md5': self.server.url('latest.tar.gz.md5'),
+                         'file': self.dest}), \
+                patch.dict(build_project.wp_cache, {'dir': None}):
+            self.assertTrue(build_project.get_latest_wp())
+            with open('%s.meta' % self.dest) as f:
+                meta = json.load(f)
+            self.assertEqual(meta['md5'], self.md5)
+            self.assertIsNotNone(meta['last_modified'])
+
+            with patch('build_project._hash_file') as m_hash:
+                self.assertTrue(build_project.get_latest_wp())
+                m_hash.assert_not_called()
+            self.assertEqual(m_download.call_count, 1)
+            self.assertRegex(sys.stdout.getvalue(), r'not modified')
+
+            # A tarball changed behind our back is checked again
+            with open(self.dest, 'ab') as f:
+                f.write(b'garbage')
+            self.assertTrue(build_project.get_latest_wp())
+            self.assertEqual(m_download.call_count, 2)
+            self.assertTrue(build_project.check_md5_ok(self.dest, self.md5))
+
+    def test_download_tarball_bad_md5(self):
+        '''
+        Test nothing is left behind when the MD5 does not match
+        '''
+        ret = build_project.download_tarball(self.url, self.dest, 'abc')
+        self.assertFalse(ret)
+        self.assertFalse(os.path.exists(self.dest))
+        self.assertFalse(os.path.exists(self.partial))
+
+
+class TuningTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def cgroup(self, files):
+        for name, content in files.items():
+            os.makedirs(os.path.dirname(os.path.join('cgroup', name)),
+                        exist_ok=True)
+            with open(os.path.join('cgroup', name), 'w') as f:
+                f.write(content)
+        return patch('build_project.CGROUP_ROOT',
+                     os.path.join(self.workdir, 'cgroup'))
+
+    @patch('build_project.os.sched_getaffinity', return_value=set(range(8)))
+    def test_host_resources(self, m_affinity):
+        '''
+        Test the cgroup v2 and v1 limits are applied
+        '''
+        with self.cgroup({'cpu.max': '150000 100000\n',
+                          'memory.max': '%d\n' % (512 * 1024 * 1024)}):
+            self.assertEqual(build_project.host_resources(), (2, 512))
+        shutil.rmtree('cgroup')
+        with self.cgroup({'cpu/cpu.cfs_quota_us': '300000\n',
+                          'cpu/cpu.cfs_period_us': '100000\n',
+                          'memory/memory.limit_in_bytes':
+                          '%d\n' % (1024 * 1024 * 1024)}):
+            self.assertEqual(build_project.host_resources(), (3, 1024))
+        shutil.rmtree('cgroup')
+        with self.cgroup({'cpu.max': 'max 100000\n', 'memory.max': 'max\n'}):
+            cpus, memory = build_project.host_resources()
+        self.assertEqual(cpus, 8)
+        self.assertGreater(memory, 0)
+
+    def test_php_fpm_profile(self):
+        '''
+        Test the pool always satisfies the php-fpm constraints
+        '''
+        for cpus in (1, 2, 8, 64):
+            for memory in (128, 512, 2048, 65536):
+                profile = build_project.php_fpm_profile(cpus, memory, 1000)
+                self.assertGreaterEqual(profile['max_children'], 2)
+                self.assertLessEqual(profile['min_spare_servers'],
+                                     profile['start_servers'])
+                self.assertLessEqual(profile['start_servers'],
+                                     profile['max_spare_servers'])
+                self.assertLessEqual(profile['max_spare_servers'],
+                                     profile['max_children'])
+        profile = build_project.php_fpm_profile(2, 2048, 1000)
+        self.assertEqual(profile['max_children'], 26)
+        self.assertEqual(profile['opcache_memory'], 128)
+        self.assertEqual(profile['opcache_max_files'], 3907)
+        self.assertEqual(profile['validate_timestamps'], 1)
+
+    def test_mariadb_profile(self):
+        '''
+        Test the buffer pool gets what the connections leave
+        '''
+        for memory in (128, 512, 4096, 65536):
+            for children in (2, 26, 128):
+                profile = build_project.mariadb_profile(memory, children)
+                self.assertEqual(profile['max_connections'], children + 10)
+                self.assertEqual(profile['buffer_pool_size'] % 8, 0)
+                self.assertGreaterEqual(profile['buffer_pool_size'], 32)
+                self.assertLessEqual(profile['log_file_size'], 1024)
+        profile = build_project.mariadb_profile(4096, 26)
+        self.assertEqual(profile['buffer_pool_size'], 2960)
+        self.assertEqual(profile['buffer_pool_instances'], 2)
+        self.assertEqual(profile['log_file_size'], 740)
+        self.assertEqual(profile['tmp_table_size'], 64)
+
+    def test_render_php_fpm_tuning(self):
+        '''
+        Test the pool and opcache settings are rendered for the release
+        '''
+        for name in ('php-fpm-pool.template', 'opcache.template'):
+            shutil.copy(os.path.join(self.root, name), self.workdir)
+        os.makedirs('releases/wordpress-4.8.1')
+        os.symlink('wordpress-4.8.1', 'releases/current')
+        manifest = dict(('file%d.php' % i, [1, 1, 'x']) for i in range(600))
+        manifest['readme.html'] = [1, 1, 'x']
+        with open('releases/wordpress-4.8.1.manifest', 'w') as f:
+            json.dump(manifest, f)
+        build_project.render_php_fpm_tuning(cpus=4, memory=4096)
+        with open('php-fpm-pool.conf') as f:
+            pool = f.read()
+        self.assertIn('pm.max_children = 53\n', pool)
+        self.assertIn('pm.max_spare_servers = 16\n', pool)
+        with open('opcache.ini') as f:
+            opcache = f.read()
+        self.assertIn('opcache.memory_consumption = 256\n', opcache)
+        self.assertIn('opcache.max_accelerated_files = 1979\n', opcache)
+
+
+class BatchTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        with tarfile.open('latest.tar.gz', 'w:gz') as tar:
+            content = b"<?php\n$wp_version = '4.8.1';\n"
+            info = tarfile.TarInfo('wordpress/wp-includes/version.php')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        self.settings = patch.dict(build_project.wp_extract,
+                                   {'gid': os.getgid()})
+        self.settings.start()
+
+    def tearDown(self):
+        self.settings.stop()
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def make_project(self, name, user, templates=True):
+        os.mkdir(name)
+        with open(os.path.join(name, 'docker-compose.yml'), 'w') as cfile:
+            cfile.write('services:\n  mariadb:\n    environment:\n'
+                        '      MARIADB_USER: %s\n      WP_USER: %s\n' %
+                        (user, user))
+        if templates:
+            for template in ('wp-config.template', 'wp_automate.template',
+                             'php-fpm_entrypoint.sh.template',
+                             'docker-compose.override.yml.template',
+                             'mariadb.cnf.template',
+                             'wordpress.conf.template'):
+                shutil.copy(os.path.join(self.root, template), name)
+            os.mkdir(os.path.join(name, 'apache-vhost'))
+        return os.path.join(self.workdir, name)
+
+    def build(self, projects, metrics=None):
+        args = argparse.Namespace(alternate=True, multisite=False,
+                                  subdomain=False, jobs=2,
+                                  db_snapshot=False, metrics=metrics,
+                                  projects=projects)
+        with patch('build_project.get_latest_wp', return_value=True) as m:
+            ret = build_project.build_projects(args)
+        m.assert_called_once_with()
+        return ret
+
+    def test_batch(self):
+        '''
+        Test every project gets its own tree rendered from its compose file
+        '''
+        one = self.make_project('one', 'alice')
+        two = self.make_project('two', 'bob')
+        self.assertTrue(self.build([one, os.path.join(two,
+                                                      'docker-compose.yml')],
+                                   metrics='metrics.jsonl'))
+        for project, user in ((one, 'alice'), (two, 'bob')):
+            with open(os.path.join(project, 'wordpress',
+                                   'wp-config.php')) as config:
+                self.assertIn(user, config.read())
+            self.assertTrue(os.path.exists(os.path.join(project,
+                                                        'wp_automate.php')))
+        output = sys.stdout.getvalue()
+        self.assertIn('[%s]' % one, output)
+        self.assertIn('username : bob', output)
+        self.assertIn('2 of 2 projects built', output)
+        with open('metrics.jsonl') as metrics:
+            records = [json.loads(line) for line in metrics]
+        stages = [(r['project'], r['stage']) for r in records]
+        self.assertEqual(stages[0], ('', 'download'))
+        self.assertIn((one, 'extract'), stages)
+        self.assertIn((two, 'config'), stages)
+        extract = records[stages.index((one, 'extract'))]
+        self.assertEqual(extract['files_written'], 1)
+        self.assertEqual(extract['status'], 'done')
+
+    def test_batch_spawn(self):
+        '''
+        Test workers not forked from this process use its artifact cache
+        '''
+        one = self.make_project('one', 'alice')
+        spawn = partial(ProcessPoolExecutor,
+                        mp_context=multiprocessing.get_context('spawn'))
+        with patch.dict(build_project.wp_cache, {'dir': 'cache'}), \
+                patch('build_project.ProcessPoolExecutor', spawn):
+            self.assertTrue(self.build([one]))
+        self.assertTrue(os.path.isdir(os.path.join(self.workdir, 'cache',
+                                                   'templates')))
+        self.assertFalse(os.path.exists(os.path.join(one, 'cache')))
+
+    def test_batch_failure(self):
+        '''
+        Test a failed project does not stop the others
+        '''
+        one = self.make_project('one', 'alice')
+        two = self.make_project('two', 'bob', templates=False)
+        self.assertFalse(self.build([one, two]))
+        self.assertTrue(os.path.exists(os.path.join(one, 'wordpress',
+                                                    'wp-config.php')))
+        self.assertIn('Failed : %s' % two, sys.stdout.getvalue())
+
+    def test_batch_missing_project(self):
+        '''
+        Test nothing is built when a project has no compose file
+        '''
+        with patch('build_project.get_latest_wp') as m_latest:
+            args = argparse.Namespace(alternate=True, projects=['missing'])
+            self.assertFalse(build_project.build_projects(args))
+        m_latest.assert_not_called()
+
+
+class PipelineTests(unittest.TestCase):
+    def stage(self, name, needs=(), ret=True, calls=None, wait=None,
+              event=None):
+        '''
+        Stage setting event, waiting for the wait event, then recording
+        its call and returning ret
+        '''
+        def function():
+            if event is not None:
+                event.set()
+            if wait is not None and not wait.wait(5):
+                return False
+            if calls is not None:
+                calls.append(name)
+            print('%s output' % name, end='')
+            if isinstance(ret, Exception):
+                raise ret
+            return ret
+        return build_project.Stage(name, function, needs)
+
+    def test_pipeline_order(self):
+        '''
+        Test every stage runs after its needs
+        '''
+        calls = []
+        stages = [self.stage('c', ['b'], calls=calls),
+                  self.stage('a', calls=calls),
+                  self.stage('b', ['a'], calls=calls)]
+        self.assertTrue(build_project.run_pipeline(stages))
+        self.assertEqual(calls, ['a', 'b', 'c'])
+        self.assertEqual([s.status for s in stages], ['done'] * 3)
+        output = sys.stdout.getvalue()
+        self.assertIn('a output...Done.\n', output)
+        self.assertRegex(output, r'Critical path \(\*\) : a > b > c')
+
+    def test_pipeline_overlap(self):
+        '''
+        Test independent stages run at the same time
+        '''
+        first, second = threading.Event(), threading.Event()
+        # Each one only completes once the other one started
+        stages = [self.stage('a', wait=second, event=first),
+                  self.stage('b', wait=first, event=second)]
+        self.assertTrue(build_project.run_pipeline(stages))
+
+    def test_pipeline_failure(self):
+        '''
+        Test a failed stage skips the stages that need it
+        '''
+        calls = []
+        stages = [self.stage('a', ret=False, calls=calls),
+                  self.stage('b', ['a'], calls=calls)]
+        self.assertFalse(build_project.run_pipeline(stages))
+        self.assertEqual(calls, ['a'])
+        self.assertEqual([s.status for s in stages], ['failed', 'skipped'])
+        self.assertRegex(sys.stdout.getvalue(), r'a failed\n')
+        self.assertRegex(sys.stdout.getvalue(), r'b +skipped')
+
+    def test_pipeline_exception(self):
+        '''
+        Test an exception in a stage is reported as a failure
+        '''
+        stages = [self.stage('a', ret=OSError('boom'))]
+        self.assertFalse(build_project.run_pipeline(stages))
+        self.assertIn('Stage a raised OSError : boom',
+                      sys.stdout.getvalue())
+
+    def test_pipeline_metrics(self):
+        '''
+        Test the resources and counters of every stage are measured
+        '''
+        def function():
+            build_project._record(files_written=2, bytes_written=10)
+            build_project._record(files_written=1)
+            return True
+        stages = [build_project.Stage('a', function),
+                  self.stage('b', ['a'], ret=False), self.stage('c', ['b'])]
+        self.assertFalse(build_project.run_pipeline(stages))
+        metrics = stages[0].metrics
+        self.assertEqual(metrics['files_written'], 3)
+        self.assertEqual(metrics['bytes_written'], 10)
+        for name in ('wall_seconds', 'cpu_seconds', 'peak_rss_bytes'):
+            self.assertIn(name, metrics)
+        self.assertGreater(metrics['peak_rss_bytes'], 0)
+        # Nothing is recorded outside of a stage
+        build_project._record(files_written=1)
+
+        records = build_project.stage_records(stages, '/srv/"blog"')
+        self.assertEqual([r['stage'] for r in records], ['a', 'b'])
+        self.assertEqual(records[1]['status'], 'failed')
+        workdir = tempfile.mkdtemp()
+        jsonl = os.path.join(workdir, 'metrics.jsonl')
+        self.assertTrue(build_project.write_metrics(jsonl, records))
+        self.assertTrue(build_project.write_metrics(jsonl, records))
+        with open(jsonl) as f:
+            self.assertEqual([json.loads(line) for line in f], records * 2)
+
+        prom = os.path.join(workdir, 'build.prom')
+        self.assertTrue(build_project.write_metrics(prom, records))
+        with open(prom) as f:
+            lines = f.read()
+        self.assertIn('bitnami_project_stage_files_written{project='
+                      '"/srv/\\"blog\\"",stage="a"} 3\n', lines)
+        self.assertIn('bitnami_project_stage_success{project='
+                      '"/srv/\\"blog\\"",stage="b"} 0\n', lines)
+        self.assertIn('# TYPE bitnami_project_stage_wall_seconds gauge\n',
+                      lines)
+        # No temporary file left behind
+        self.assertEqual(sorted(os.listdir(workdir)),
+                         ['build.prom', 'metrics.jsonl'])
+        shutil.rmtree(workdir)
+
+    def test_pipeline_unknown_need(self):
+        '''
+        Test a stage needing a missing stage is rejected
+        '''
+        with self.assertRaises(ValueError):
+            build_project.run_pipeline([self.stage('a', ['z'])])
+
+
+class GitMirrorTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        self.upstream = os.path.join(self.workdir, 'upstream')
+        for version in ('5.6', '7.0'):
+            os.makedirs(os.path.join(self.upstream, version))
+        self.git('init', '-q')
+        self.commit('one')
+        self.git('tag', 'pinned')
+        self.settings = patch.dict(build_project.php_fpm, {
+            'url': 'file://%s' % self.upstream,
+            'mirror': os.path.join(self.workdir, 'cache', 'mirror.git'),
+            'ref': 'master',
+            })
+        self.settings.start()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        self.settings.stop()
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def git(self, *args):
+        return subprocess.check_output(
+            ['git', '-C', self.upstream, '-c', 'user.name=test',
+             '-c', 'user.email=test@localhost',
+             '-c', 'init.defaultBranch=master'] +
+            list(args)).decode('UTF-8').strip()
+
+    def commit(self, content):
+        for version in ('5.6', '7.0'):
+            with open(os.path.join(self.upstream, version,
+                                   'Dockerfile'), 'w') as dfile:
+                dfile.write('%s\n' % content)
+        self.git('add', '-A')
+        self.git('commit', '-q', '-m', content)
+        return self.git('rev-parse', 'HEAD')
+
+    def checkout(self):
+        if os.path.exists('checkout'):
+            shutil.rmtree('checkout')
+        return build_project.checkout_php_fpm('checkout')
+
+    def test_sparse_shallow_checkout(self):
+        '''
+        Test only the image directory of the ref is checked out
+        '''
+        head = self.git('rev-parse', 'HEAD')
+        self.assertEqual(self.checkout(), head)
+        self.assertEqual(os.listdir('checkout/5.6'), ['Dockerfile'])
+        self.assertFalse(os.path.exists('checkout/7.0'))
+        self.assertTrue(os.path.exists('checkout/.git/shallow'))
+
+    def test_mirror_fetch(self):
+        '''
+        Test the mirror picks up new commits and the ref stays pinned
+        '''
+        self.checkout()
+        head = self.commit('two')
+        self.assertEqual(self.checkout(), head)
+        with open('checkout/5.6/Dockerfile') as dfile:
+            self.assertEqual(dfile.read(), 'two\n')
+        with patch.dict(build_project.php_fpm, {'ref': 'pinned'}):
+            self.checkout()
+        with open('checkout/5.6/Dockerfile') as dfile:
+            self.assertEqual(dfile.read(), 'one\n')
+
+    def test_mirror_offline(self):
+        '''
+        Test an unreachable upstream falls back on the existing mirror
+        '''
+        head = self.checkout()
+        shutil.rmtree(self.upstream)
+        self.assertEqual(self.checkout(), head)
+        shutil.rmtree(build_project.php_fpm['mirror'])
+        self.assertIsNone(self.checkout())
+
+
+class ArtifactCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        self.cache = build_project.ArtifactCache(
+            os.path.join(self.workdir, 'cache'), 1024 * 1024)
+
+    def tearDown(self):
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def make_tarball(self, name, version, padding=0):
+        '''
+        Build a small WordPress-like tarball, returns its MD5
+        '''
+        path = os.path.join(self.workdir, name)
+        with tarfile.open(path, 'w:gz') as tar:
+            content = ("<?php\n$wp_version = '%s';\n" % version).encode()
+            content += os.urandom(padding)
+            info = tarfile.TarInfo('wordpress/wp-includes/version.php')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        with open(path, 'rb') as f:
+            return hashlib.md5(f.read()).hexdigest()
+
+    def test_tarball_version(self):
+        '''
+        Test the release is read from wp-includes/version.php
+        '''
+        self.make_tarball('latest.tar.gz', '4.8.1')
+        path = os.path.join(self.workdir, 'latest.tar.gz')
+        self.assertEqual(build_project.tarball_version(path), '4.8.1')
+        with open(path, 'wb') as f:
+            f.write(b'not a tarball')
+        self.assertIsNone(build_project.tarball_version(path))
+
+    def test_store_and_fetch(self):
+        '''
+        Test a stored tarball is hardlinked into another project
+        '''
+        md5 = self.make_tarball('latest.tar.gz', '4.8.1')
+        src = os.path.join(self.workdir, 'latest.tar.gz')
+        dest = os.path.join(self.workdir, 'other.tar.gz')
+        self.assertIsNone(self.cache.fetch(md5, dest))
+        self.cache.store(src, md5)
+        entry = self.cache.fetch(md5, dest)
+        self.assertEqual(entry['version'], '4.8.1')
+        self.assertTrue(os.path.samefile(dest, self.cache.blob(md5)))
+        self.assertEqual(self.cache.stats(), (1, 1))
+        with open(self.cache.index_file) as f:
+            index = json.load(f)
+        self.assertEqual(index['releases'], {'4.8.1': md5})
+
+    def test_eviction(self):
+        '''
+        Test least recently used releases go when the cache is full
+        '''
+        digests = [self.make_tarball('%d.tar.gz' % i, '4.8.%d' % i,
+                                     400 * 1024)
+                   for i in range(3)]
+        for i, md5 in enumerate(digests[:2]):
+            self.cache.store(os.path.join(self.workdir, '%d.tar.gz' % i), md5)
+        # Using the oldest one makes the second the least recently used
+        self.cache.fetch(digests[0], os.path.join(self.workdir, 'used'))
+        self.cache.store(os.path.join(self.workdir, '2.tar.gz'), digests[2])
+        self.assertTrue(os.path.exists(self.cache.blob(digests[0])))
+        self.assertFalse(os.path.exists(self.cache.blob(digests[1])))
+        self.assertTrue(os.path.exists(self.cache.blob(digests[2])))
+        with open(self.cache.index_file) as f:
+            index = json.load(f)
+        self.assertNotIn('4.8.1', index['releases'])
+
+    @patch('build_project.urlopen')
+    @patch('build_project.download_tarball')
+    def test_get_latest_from_cache(self, m_download, m_urlopen):
+        '''
+        Test get_latest_wp() uses the cache before downloading
+        '''
+        md5 = self.make_tarball('seed.tar.gz', '4.8.1')
+        self.cache.store(os.path.join(self.workdir, 'seed.tar.gz'), md5)
+        m_urlopen.return_value.read.return_value = md5.encode()
+        m_urlopen.return_value.headers = {}
+        os.chdir(self.workdir)
+        with patch.dict(build_project.wp_cache, {'dir': self.cache.root}):
+            ret = build_project.get_latest_wp()
+        self.assertTrue(ret)
+        m_download.assert_not_called()
+        self.assertTrue(build_project.check_md5_ok('latest.tar.gz', md5))
+
+    @patch('build_project.urlopen')
+    @patch('build_project.download_tarball')
+    def test_get_latest_current_skips_cache(self, m_download, m_urlopen):
+        '''
+        Test a verified local tarball is used without a cache lookup
+        '''
+        os.chdir(self.workdir)
+        md5 = self.make_tarball('latest.tar.gz', '4.8.1')
+        build_project._write_metadata(md5, {})
+        m_urlopen.return_value.read.return_value = md5.encode()
+        m_urlopen.return_value.headers = {}
+        with patch.dict(build_project.wp_cache, {'dir': self.cache.root}):
+            self.assertTrue(build_project.get_latest_wp())
+        m_download.assert_not_called()
+        self.assertFalse(os.path.exists(self.cache.index_file))
+
+    @patch('build_project.urlopen')
+    @patch('build_project.download_tarball')
+    def test_get_latest_invalid_md5(self, m_download, m_urlopen):
+        '''
+        Test an MD5 that is not one never names a cache blob
+        '''
+        os.chdir(self.workdir)
+        m_urlopen.return_value.read.return_value = b'../../../etc/passwd'
+        m_urlopen.return_value.headers = {}
+        with patch.dict(build_project.wp_cache, {'dir': self.cache.root}):
+            self.assertFalse(build_project.get_latest_wp())
+        m_download.assert_not_called()
+        self.assertFalse(os.path.exists(self.cache.root))
+
+
+class ExtractTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+
+    def tearDown(self):
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def make_tarball(self, files, mtime=1500000000):
+        '''
+        Write latest.tar.gz holding files, a dict of name to content
+        '''
+        with tarfile.open('latest.tar.gz', 'w:gz') as tar:
+            info = tarfile.TarInfo('wordpress')
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            tar.addfile(info)
+            for name, content in sorted(files.items()):
+                info = tarfile.TarInfo('wordpress/%s' % name)
+                info.size = len(content)
+                info.mode = 0o644
+                info.mtime = mtime
+                tar.addfile(info, io.BytesIO(content))
+
+    def extract(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            self.assertTrue(build_project.extract_wp_tarball())
+        return out.getvalue()
+
+    def test_extract_incremental(self):
+        '''
+        Test only new or changed files are written on later extractions
+        '''
+        self.make_tarball({'index.php': b'index',
+                           'wp-includes/version.php': b'4.8.0',
+                           'wp-includes/old.php': b'old'})
+        self.assertRegex(self.extract(), r'3 written, 0 unchanged, 0 removed')
+        self.assertEqual(self.extract(), 'Extracting new tarball'
+                         ' (0 written, 3 unchanged, 0 removed)')
+        os.makedirs('wordpress/wp-content/uploads')
+        with open('wordpress/wp-content/uploads/photo.jpg', 'wb') as f:
+            f.write(b'user data')
+        inode = os.stat('wordpress/index.php').st_ino
+
+        self.make_tarball({'index.php': b'index',
+                           'wp-includes/version.php': b'4.8.1',
+                           'wp-admin/new.php': b'new'}, mtime=1500000100)
+        self.assertRegex(self.extract(), r'2 written, 1 unchanged, 1 removed')
+        self.assertEqual(os.stat('wordpress/index.php').st_ino, inode)
+        with open('wordpress/wp-includes/version.php', 'rb') as f:
+            self.assertEqual(f.read(), b'4.8.1')
+        self.assertFalse(os.path.exists('wordpress/wp-includes/old.php'))
+        self.assertTrue(os.path.exists('wordpress/wp-admin/new.php'))
+        self.assertTrue(os.path.exists(
+            'wordpress/wp-content/uploads/photo.jpg'))
+
+    def test_extract_restores_modified_files(self):
+        '''
+        Test files modified or removed locally are extracted again
+        '''
+        self.make_tarball({'index.php': b'index', 'readme.html': b'readme'})
+        self.extract()
+        with open('wordpress/index.php', 'wb') as f:
+            f.write(b'hacked')
+        os.remove('wordpress/readme.html')
+        self.assertRegex(self.extract(), r'2 written, 0 unchanged')
+        with open('wordpress/index.php', 'rb') as f:
+            self.assertEqual(f.read(), b'index')
+
+    def test_extract_prunes_empty_dirs(self):
+        '''
+        Test directories emptied by a release are removed
+        '''
+        self.make_tarball({'index.php': b'index', 'old/dir/a.php': b'a'})
+        self.extract()
+        self.make_tarball({'index.php': b'index'})
+        self.extract()
+        self.assertFalse(os.path.exists('wordpress/old'))
+        self.assertTrue(os.path.exists('wordpress/index.php'))
+
+    @patch.dict('build_project.wp_extract',
+                {'gzip': [['gzip', '-dc']], 'workers': 4})
+    def test_extract_external_gunzip(self):
+        '''
+        Test extraction through an external decompressor and the pool
+        '''
+        files = dict(('wp-content/f%03d.php' % i, os.urandom(i * 10))
+                     for i in range(200))
+        self.make_tarball(files)
+        self.assertRegex(self.extract(), r'200 written, 0 unchanged')
+        for name, content in files.items():
+            with open('wordpress/%s' % name, 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertRegex(self.extract(), r'0 written, 200 unchanged')
+
+    @patch.dict('build_project.wp_extract', {'gzip': [['gzip', '-dc']]})
+    def test_extract_external_gunzip_error(self):
+        '''
+        Test a truncated tarball fails with an external decompressor
+        '''
+        self.make_tarball({'a.php': os.urandom(100000)})
+        with open('latest.tar.gz', 'r+b') as f:
+            f.truncate(50000)
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            self.assertFalse(build_project.extract_wp_tarball())
+        self.assertRegex(out.getvalue(), r'Unable to extract the tarball')
+
+    @patch('build_project._write_member', side_effect=PermissionError)
+    def test_extract_write_error(self, m_write):
+        '''
+        Test errors raised by the writer threads are reported
+        '''
+        self.make_tarball({'a.php': b'a', 'b.php': b'b'})
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            self.assertFalse(build_project.extract_wp_tarball())
+        self.assertRegex(out.getvalue(), r'Unable to update')
+        self.assertFalse(os.path.exists('wordpress.manifest'))
+
+    def releases(self):
+        return sorted(name for name in os.listdir('releases')
+                      if name.startswith('wordpress-') and
+                      not name.endswith('.manifest'))
+
+    def version_tarball(self, version):
+        self.make_tarball({
+            'index.php': b'index',
+            'wp-includes/version.php':
+                ("<?php\n$wp_version = '%s';\n" % version).encode()})
+
+    def test_extract_switches_release(self):
+        '''
+        Test a new release is extracted aside and switched to atomically
+        '''
+        self.version_tarball('4.8.0')
+        self.extract()
+        first = os.readlink('releases/current')
+        self.assertRegex(first, r'^wordpress-4\.8\.0-\d+$')
+        self.assertEqual(os.readlink('wordpress'), 'releases/current')
+        with open('wordpress/wp-content-upload.jpg', 'wb') as f:
+            f.write(b'user data')
+
+        self.version_tarball('4.8.1')
+        self.extract()
+        second = os.readlink('releases/current')
+        self.assertRegex(second, r'^wordpress-4\.8\.1-\d+')
+        self.assertEqual(self.releases(), sorted([first, second]))
+        # The previous release is untouched and ready for a rollback
+        with open('releases/%s/wp-includes/version.php' % first) as f:
+            self.assertRegex(f.read(), r'4\.8\.0')
+        with open('wordpress/wp-includes/version.php') as f:
+            self.assertRegex(f.read(), r'4\.8\.1')
+        # Unchanged and local files are shared with the previous release
+        for name in ('index.php', 'wp-content-upload.jpg'):
+            self.assertTrue(os.path.samefile('wordpress/%s' % name,
+                                             'releases/%s/%s' % (first,
+                                                                 name)))
+
+    def test_extract_carries_late_uploads(self):
+        '''
+        Test local files changed during the extraction reach the release
+        '''
+        self.version_tarball('4.8.0')
+        self.extract()
+        first = os.readlink('releases/current')
+        os.makedirs('wordpress/wp-content/uploads')
+        for name in ('kept.jpg', 'replaced.jpg', 'removed.jpg'):
+            with open('wordpress/wp-content/uploads/%s' % name, 'wb') as f:
+                f.write(b'before')
+        extract_into = build_project._extract_into
+
+        def upload_while_extracting(root, manifest):
+            ret = extract_into(root, manifest)
+            uploads = 'releases/%s/wp-content/uploads' % first
+            os.makedirs('%s/2017' % uploads)
+            with open('%s/2017/new.jpg' % uploads, 'wb') as f:
+                f.write(b'new')
+            with open('%s/replaced.tmp' % uploads, 'wb') as f:
+                f.write(b'after')
+            os.replace('%s/replaced.tmp' % uploads,
+                       '%s/replaced.jpg' % uploads)
+            os.remove('%s/removed.jpg' % uploads)
+            return ret
+
+        self.version_tarball('4.8.1')
+        with patch('build_project._extract_into',
+                   side_effect=upload_while_extracting):
+            self.extract()
+        self.assertNotEqual(os.readlink('releases/current'), first)
+        uploads = 'wordpress/wp-content/uploads'
+        for name, content in (('kept.jpg', b'before'),
+                              ('replaced.jpg', b'after'),
+                              ('2017/new.jpg', b'new')):
+            with open('%s/%s' % (uploads, name), 'rb') as f:
+                self.assertEqual(f.read(), content)
+        self.assertFalse(os.path.exists('%s/removed.jpg' % uploads))
+        with open('wordpress/wp-includes/version.php') as f:
+            self.assertRegex(f.read(), r'4\.8\.1')
+
+    def test_extract_no_change_keeps_release(self):
+        '''
+        Test extracting the same tarball keeps the current release
+        '''
+        self.version_tarball('4.8.0')
+        self.extract()
+        current = os.readlink('releases/current')
+        self.extract()
+        self.assertEqual(os.readlink('releases/current'), current)
+        self.assertEqual(self.releases(), [current])
+        self.assertFalse(os.path.exists('releases/.staging'))
+
+    @patch.dict('build_project.wp_latest', {'keep': 2})
+    def test_extract_prunes_old_releases(self):
+        '''
+        Test only the most recent releases are kept
+        '''
+        names = []
+        for version in ('4.8.0', '4.8.1', '4.8.2'):
+            self.version_tarball(version)
+            self.extract()
+            names.append(os.readlink('releases/current'))
+        self.assertEqual(self.releases(), sorted(names[1:]))
+        self.assertFalse(os.path.exists('releases/%s.manifest' % names[0]))
+
+    def test_extract_migrates_directory(self):
+        '''
+        Test a wordpress directory from an older run becomes a release
+        '''
+        self.version_tarball('4.8.0')
+        os.makedirs('wordpress/wp-includes')
+        with open('wordpress/index.php', 'wb') as f:
+            f.write(b'index')
+        with open('wordpress/gone.php', 'wb') as f:
+            f.write(b'gone')
+        with open('wordpress/uploaded.jpg', 'wb') as f:
+            f.write(b'user data')
+        with open('wordpress.manifest', 'w') as f:
+            json.dump({'wordpress/gone.php': [4, 0, '']}, f)
+        self.assertRegex(self.extract(), r'2 written, 0 unchanged, 1 removed')
+        self.assertTrue(os.path.islink('wordpress'))
+        self.assertFalse(os.path.exists('wordpress.manifest'))
+        self.assertFalse(os.path.exists('wordpress/gone.php'))
+        self.assertTrue(os.path.exists('wordpress/uploaded.jpg'))
+        self.assertTrue(os.path.exists('releases/wordpress-previous'))
+
+    @patch('build_project._can_chgrp', return_value=True)
+    @patch('build_project.os.fchown')
+    def test_extract_sets_group(self, m_fchown, m_can_chgrp):
+        '''
+        Test the group is set on the files we write when allowed to
+        '''
+        self.make_tarball({'index.php': b'index', 'readme.html': b'r'})
+        with patch.dict(build_project.wp_extract, {'gid': 4242}):
+            self.extract()
+        self.assertEqual(m_fchown.call_count, 2)
+        self.assertEqual(m_fchown.call_args[0][1:], (-1, 4242))
+
+    def precompress(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            self.assertTrue(build_project.precompress_assets())
+        return out.getvalue()
+
+    @patch.dict('build_project.wp_precompress', {'encodings': ['gzip']})
+    def test_precompress_assets(self):
+        '''
+        Test compressed siblings are written for the large enough assets
+        '''
+        style = b'body { margin: 0; }\n' * 100
+        self.make_tarball({'index.php': b'<?php\n' * 100,
+                           'wp-includes/css/style.css': style,
+                           'wp-includes/js/tiny.js': b'x'})
+        self.extract()
+        self.assertIn('(gzip, 1 written, 0 removed)', self.precompress())
+        with open('wordpress/wp-includes/css/style.css.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), style)
+        self.assertEqual(
+            os.stat('wordpress/wp-includes/css/style.css.gz').st_mtime,
+            os.stat('wordpress/wp-includes/css/style.css').st_mtime)
+        self.assertFalse(os.path.exists('wordpress/wp-includes/js/tiny.js.gz'))
+        self.assertFalse(os.path.exists('wordpress/index.php.gz'))
+
+    @patch.dict('build_project.wp_precompress', {'encodings': ['gzip']})
+    def test_precompress_incremental(self):
+        '''
+        Test up to date siblings are kept and stale or orphaned ones are
+        replaced or removed without touching the previous release
+        '''
+        self.make_tarball({'a.css': b'a' * 1000, 'b.js': b'b' * 1000,
+                           'c.svg': b'c' * 1000})
+        self.extract()
+        self.precompress()
+        self.assertIn('(gzip, 0 written, 0 removed)', self.precompress())
+
+        previous = os.path.realpath('wordpress')
+        self.make_tarball({'a.css': b'a' * 1000, 'b.js': b'B' * 1000},
+                          mtime=1600000000)
+        self.extract()
+        # The extraction already dropped the siblings of c.svg
+        self.assertFalse(os.path.exists('wordpress/c.svg.gz'))
+        os.remove('wordpress/a.css')
+        self.assertIn('(gzip, 1 written, 1 removed)', self.precompress())
+        self.assertFalse(os.path.exists('wordpress/a.css.gz'))
+        with open('wordpress/b.js.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'B' * 1000)
+        with open(os.path.join(previous, 'b.js.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'b' * 1000)
+
+    @patch.dict('build_project.wp_precompress', {'encodings': ['gzip']})
+    def test_precompress_upgrade(self):
+        '''
+        Test the new release never serves the siblings of the previous
+        content of an asset, even before they are written again
+        '''
+        self.make_tarball({'a.css': b'a' * 1000, 'b.js': b'b' * 1000})
+        self.extract()
+        self.precompress()
+        previous = os.path.realpath('wordpress')
+        # Same mtime, only the content tells the versions apart
+        self.make_tarball({'a.css': b'A' * 1000, 'b.js': b'b' * 1000})
+        self.extract()
+        self.assertNotEqual(os.path.realpath('wordpress'), previous)
+        self.assertFalse(os.path.exists('wordpress/a.css.gz'))
+        self.assertTrue(os.path.exists('wordpress/b.js.gz'))
+        with open(os.path.join(previous, 'a.css.gz'), 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'a' * 1000)
+        self.assertIn('(gzip, 1 written, 0 removed)', self.precompress())
+        with open('wordpress/a.css.gz', 'rb') as f:
+            self.assertEqual(gzip.decompress(f.read()), b'A' * 1000)
+
+    def test_precompress_brotli(self):
+        '''
+        Test brotli siblings are only written when the module is there
+        '''
+        self.make_tarball({'a.css': b'a' * 1000})
+        self.extract()
+        with patch('build_project.brotli', None):
+            self.assertIn('(gzip, 1 written', self.precompress())
+        self.assertFalse(os.path.exists('wordpress/a.css.br'))
+        fake = MagicMock()
+        fake.compress.return_value = b'compressed'
+        with patch('build_project.brotli', fake):
+            self.assertIn('(br/gzip, 1 written', self.precompress())
+        fake.compress.assert_called_once_with(b'a' * 1000)
+        with open('wordpress/a.css.br', 'rb') as f:
+            self.assertEqual(f.read(), b'compressed')
+
+
+class SnapshotTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        with open('docker-compose.yml', 'w') as cfile:
+            cfile.write('services:\n'
+                        '  mariadb:\n'
+                        '    image: bitnami/mariadb:10.1.25-r0\n'
+                        '    environment:\n'
+                        '      - MARIADB_USER=wordpress\n'
+                        '      - WP_USER=hello\n'
+                        '  php-fpm:\n'
+                        '    image: ${PHP_FPM_IMAGE:-php-fpm:default}\n')
+        with open('.env', 'w') as env:
+            env.write('PHP_FPM_IMAGE=php-fpm:custom\n')
+        with tarfile.open('latest.tar.gz', 'w:gz') as tar:
+            content = b"<?php\n$wp_version = '4.8.1';\n"
+            info = tarfile.TarInfo('wordpress/wp-includes/version.php')
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        self.settings = patch.dict(build_project.wp_extract,
+                                   {'gid': os.getgid()})
+        self.settings.start()
+        self.cache = patch.dict(build_project.wp_cache,
+                                {'dir': os.path.join(self.workdir, 'cache')})
+        self.cache.start()
+        with patch('sys.stdout', new_callable=io.StringIO):
+            build_project.extract_wp_tarball()
+        for name in ('php-fpm_entrypoint.sh', 'wp_automate.php',
+                     'mariadb.cnf', 'wordpress/wp-config.php'):
+            with open(name, 'w') as script:
+                script.write('%s\n' % name)
+
+    def tearDown(self):
+        self.cache.stop()
+        self.settings.stop()
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def fake_docker(self, status=0):
+        '''
+        Docker client whose mariadb container archives a data directory
+        '''
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            info = tarfile.TarInfo('mariadb/data/ibdata1')
+            info.size = 4
+            tar.addfile(info, io.BytesIO(b'data'))
+        client = MagicMock()
+        mariadb, php_fpm = MagicMock(), MagicMock()
+        mariadb.get_archive.return_value = (iter([archive.getvalue()]), {})
+        php_fpm.wait.return_value = {'StatusCode': status}
+        php_fpm.logs.return_value = b'Provisioning failed'
+        client.containers.create.side_effect = [mariadb, php_fpm]
+        return client, mariadb, php_fpm
+
+    def seed(self):
+        with patch('sys.stdout', new_callable=io.StringIO) as out:
+            ret = build_project.snapshot_database()
+        return ret, out.getvalue()
+
+    def test_snapshot_capture_and_seed(self):
+        '''
+        Test the snapshot is made in a throwaway stack, then reused
+        '''
+        client, mariadb, php_fpm = self.fake_docker()
+        with patch('build_project.docker.from_env', return_value=client):
+            ret, output = self.seed()
+        self.assertTrue(ret)
+        self.assertIn('throwaway stack', output)
+        with open('mariadb-data/data/ibdata1', 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        images = [c[0][0] for c in client.containers.create.call_args_list]
+        self.assertEqual(images, ['bitnami/mariadb:10.1.25-r0',
+                                  'php-fpm:custom'])
+        self.assertEqual(client.containers.create.call_args[1]['entrypoint'],
+                         ['/php-fpm_entrypoint.sh', '--install'])
+        volumes = client.containers.create.call_args_list[0][1]['volumes']
+        self.assertEqual(volumes[os.path.abspath('mariadb.cnf')]['bind'],
+                         '/bitnami/mariadb/conf/my_custom.cnf')
+        mariadb.stop.assert_called_once_with(timeout=60)
+        mariadb.remove.assert_called_once_with(v=True, force=True)
+        php_fpm.remove.assert_called_once_with(v=True, force=True)
+        client.networks.create.return_value.remove.assert_called_once_with()
+        self.assertEqual(len(os.listdir('cache/snapshots')), 2)
+
+        # A new stack is seeded from the cached snapshot
+        shutil.rmtree('mariadb-data')
+        with patch('build_project.docker.from_env',
+                   side_effect=AssertionError):
+            ret, output = self.seed()
+        self.assertTrue(ret)
+        self.assertIn('(cached)', output)
+        self.assertTrue(os.path.exists('mariadb-data/data/ibdata1'))
+
+        # Another configuration needs its own snapshot
+        key = build_project._snapshot_key('docker-compose.yml')
+        with open('wp_automate.php', 'a') as script:
+            script.write('changed\n')
+        self.assertNotEqual(build_project._snapshot_key('docker-compose.yml'),
+                            key)
+
+    def test_snapshot_existing_database(self):
+        '''
+        Test a database already initialized is left alone
+        '''
+        os.makedirs('mariadb-data/data')
+        with patch('build_project.docker.from_env',
+                   side_effect=AssertionError):
+            ret, output = self.seed()
+        self.assertTrue(ret)
+        self.assertIn('not seeding it', output)
+
+    def test_snapshot_install_failure(self):
+        '''
+        Test a failed install leaves no snapshot and no container behind
+        '''
+        client, mariadb, php_fpm = self.fake_docker(status=1)
+        with patch('build_project.docker.from_env', return_value=client):
+            ret, output = self.seed()
+        self.assertFalse(ret)
+        self.assertIn('Provisioning failed', output)
+        self.assertFalse(os.path.exists('mariadb-data'))
+        self.assertEqual(
+            [n for n in os.listdir('cache/snapshots')
+             if n.endswith('.tar')], [])
+        mariadb.remove.assert_called_once_with(v=True, force=True)
+        php_fpm.remove.assert_called_once_with(v=True, force=True)
+
+    def test_snapshot_stage(self):
+        '''
+        Test the database is seeded once the image and scripts are ready
+        '''
+        args = argparse.Namespace(alternate=False, multisite=False,
+                                  subdomain=False, db_snapshot=True)
+        stages = dict((stage.name, stage)
+                      for stage in build_project.project_stages(args))
+        self.assertEqual(stages['database'].needs,
+                         ['scripts', 'config', 'image'])
+        # The checkout overlaps the download and the extraction
+        self.assertEqual(stages['checkout'].needs, [])
+        self.assertEqual(stages['image'].needs,
+                         ['checkout', 'scripts', 'extract'])
+        args.db_snapshot = False
+        self.assertNotIn('database', [stage.name for stage in
+                                      build_project.project_stages(args)])
+
+    def test_snapshot_alternate(self):
+        '''
+        Test --db-snapshot is refused with the pristine php-fpm image
+        '''
+        with patch('build_project.sys.argv',
+                   ['main', '-a', '--db-snapshot']), \
+                patch('build_project.run_pipeline') as m_pipeline:
+            with self.assertRaises(SystemExit) as exit:
+                build_project.main()
+        self.assertEqual(exit.exception.code, 2)
+        m_pipeline.assert_not_called()
+
+
+class LoadTestTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.getcwd()
+        self.workdir = tempfile.mkdtemp()
+        os.chdir(self.workdir)
+        for path in build_project.loadtest['paths']['static']:
+            os.makedirs(os.path.dirname(path[1:]), exist_ok=True)
+            with open(path[1:], 'w') as asset:
+                asset.write('body { color: red; }\n' * 100)
+
+    def tearDown(self):
+        os.chdir(self.root)
+        shutil.rmtree(self.workdir)
+
+    def run_loadtest(self, server, mix, concurrency=4):
+        results = build_project.run_loadtest(
+            server.url(''), 'wordpress.example.com', mix, 0.5, 0.1,
+            concurrency)
+        return build_project.loadtest_summary(results, 0.5)
+
+    def test_loadtest(self):
+        '''
+        Test every kind of request of the mix is measured
+        '''
+        with LocalServer(self.workdir) as server:
+            summary = self.run_loadtest(server, {'home': 1, 'static': 2,
+                                                 'rest': 1})
+        self.assertEqual(sorted(summary), ['home', 'rest', 'static',
+                                           'total'])
+        total = summary['total']
+        self.assertEqual(total['errors'], 0)
+        self.assertEqual(total['requests'],
+                         sum(summary[kind]['requests']
+                             for kind in ('home', 'rest', 'static')))
+        self.assertGreater(summary['static']['requests'],
+                           summary['home']['requests'])
+        self.assertAlmostEqual(total['rps'], total['requests'] / 0.5)
+        self.assertLessEqual(total['p50_ms'], total['p95_ms'])
+        self.assertLessEqual(total['p95_ms'], total['p99_ms'])
+
+    def test_loadtest_keep_alive(self):
+        '''
+        Test the clients reuse their connection, chunked pages included
+        '''
+        with LocalServer(self.workdir, KeepAliveHandler) as server:
+            summary = self.run_loadtest(server, {'home': 1, 'static': 1},
+                                        concurrency=2)
+            self.assertEqual(server.httpd.connections, 2)
+        self.assertEqual(summary['total']['errors'], 0)
+        self.assertGreater(summary['home']['requests'], 2)
+
+    def test_loadtest_errors(self):
+        '''
+        Test failed requests and refused connections count as errors
+        '''
+        with LocalServer(self.workdir, KeepAliveHandler) as server:
+            summary = self.run_loadtest(server, {'login': 1, 'static': 1})
+            url = server.url('')
+        self.assertEqual(summary['static']['errors'], 0)
+        self.assertEqual(summary['login']['error_rate'], 1)
+        summary = build_project.loadtest_summary(
+            build_project.run_loadtest(url, None, {'home': 1}, 0.2, 0, 1),
+            0.2)
+        self.assertEqual(summary['total']['error_rate'], 1)
+
+    def test_loadtest_summary(self):
+        '''
+        Test the percentiles are taken by nearest rank
+        '''
+        results = {'home': {'latencies': [i / 1000 for i in range(100, 0,
+                                                                  -1)],
+                            'errors': 2}}
+        summary = build_project.loadtest_summary(results, 10)['home']
+        self.assertEqual(summary['requests'], 100)
+        self.assertAlmostEqual(summary['rps'], 10)
+        self.assertAlmostEqual(summary['p50_ms'], 50)
+        self.assertAlmostEqual(summary['p95_ms'], 95)
+        self.assertAlmostEqual(summary['p99_ms'], 99)
+        self.assertAlmostEqual(summary['error_rate'], 0.02)
+
+    @patch('build_project.run_loadtest')
+    @patch('build_project.docker.from_env')
+    def test_loadtest_pool_sweep(self, m_docker, m_loadtest):
+        '''
+        Test every pool size is installed and measured, then the one of
+        the image restored
+        '''
+        shutil.copy(os.path.join(self.root, 'php-fpm-pool.template'), '.')
+        with open('php-fpm-pool.conf', 'w') as conf:
+            conf.write('[www]\npm.max_children = 7\n')
+        container = MagicMock()
+        container.attrs = {'State': {'Status': 'running',
+                                     'Health': {'Status': 'healthy'}}}
+        m_docker.return_value.containers.list.return_value = [container]
+        m_loadtest.side_effect = [
+            {'home': {'latencies': [0.01] * 50, 'errors': 0}},
+            {'home': {'latencies': [0.01] * 80, 'errors': 0}},
+            {'home': {'latencies': [0.01] * 90, 'errors': 10}},
+            ]
+        argv = ['build_project.py', 'loadtest', '-d', '10', '-w', '0',
+                '--pool-sizes', '2,4,8', '--metrics', 'loadtest.jsonl']
+        with patch.object(sys, 'argv', argv), \
+                patch.dict(build_project.php_fpm_tuning,
+                           {'cpus': 2, 'memory': 2048}):
+            self.assertTrue(build_project.main())
+
+        labels = m_docker.return_value.containers.list.call_args[1][
+            'filters']['label']
+        self.assertIn('com.docker.compose.service=php-fpm', labels)
+        installed = []
+        for call in container.put_archive.call_args_list:
+            self.assertEqual(call[0][0], '/opt/bitnami/php/etc/php-fpm.d')
+            with tarfile.open(fileobj=io.BytesIO(call[0][1])) as tar:
+                conf = tar.extractfile('zz-tuning.conf').read().decode()
+            installed.append(int(conf.split('pm.max_children = ')[1]
+                                 .split()[0]))
+        self.assertEqual(installed, [2, 4, 8, 7])
+        self.assertEqual(container.restart.call_count, 4)
+        self.assertIn('Best : 4 children (8.0 requests/s)',
+                      sys.stdout.getvalue())
+        with open('loadtest.jsonl') as metrics:
+            records = [json.loads(line) for line in metrics]
+        self.assertEqual(len(records), 6)
+        self.assertEqual(set(r['max_children'] for r in records), {2, 4, 8})
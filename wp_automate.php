@@ -1,31 +1,193 @@
 <?php
 // cli.php script
-// Wordpress silent install
+// Wordpress silent install, run by php-fpm_entrypoint.sh on every start
+// Nothing is done when the site was already provisioned with the same
+// settings
 
-if ($db=($GLOBALS["___mysqli_ston"] = mysqli_connect("mariadb", "wordpress", "my-password", null, 3306))) {
+$settings = json_decode(<<<'JSON'
+{"db_name": "wordpress", "db_password": "my-password", "db_user": "wordpress", "domain": "wordpress.example.com", "email": "you@example.com", "indexes": {"options": {"autoload": "autoload"}, "postmeta": {"meta_key_value": "meta_key(191), meta_value(32)", "post_id_meta_key": "post_id, meta_key(191)"}}, "password": "world", "seed_sites": 0, "seed_users": 0, "subdomain": false, "title": "My Bitnami Project", "url": "http://wordpress.example.com", "user": "hello"}
+JSON
+, true);
+$prefix = 'wp_';
 
-    define('WP_INSTALLING', true);
-    if (!file_exists('/app/wp-config.php')) {
-        require_once('/app/wp-includes/functions.php');
-    }
-    require_once('/app/wp-config.php');
-    require_once('/app/wp-admin/upgrade-functions.php');
+// Our queries raise exceptions, WordPress expects the default reporting
+$strict = MYSQLI_REPORT_ERROR | MYSQLI_REPORT_STRICT;
+mysqli_report($strict);
+try {
+    $db = new mysqli('mariadb', $settings['db_user'],
+                     $settings['db_password'], $settings['db_name'], 3306);
+    $db->set_charset('utf8');
+}
+catch (mysqli_sql_exception $e) {
+    echo('Connection failed. Make sure that the database server is running.');
+    exit(1);
+}
+
+function table_exists($db, $table) {
+    $stmt = $db->prepare('SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = ?');
+    $stmt->bind_param('s', $table);
+    $stmt->execute();
+    $stmt->bind_result($count);
+    $stmt->fetch();
+    $stmt->close();
+    return $count > 0;
+}
+
+function get_option_value($db, $prefix, $name) {
+    $stmt = $db->prepare("SELECT option_value FROM {$prefix}options WHERE option_name = ?");
+    $stmt->bind_param('s', $name);
+    $stmt->execute();
+    $stmt->bind_result($value);
+    $found = $stmt->fetch();
+    $stmt->close();
+    return $found ? $value : null;
+}
+
+// The sites can only be seeded once wp_enable_network set the network up
+$network = table_exists($db, "{$prefix}blogs");
+$digest = sha1(serialize(array($settings, $network)));
+if (table_exists($db, "{$prefix}options") &&
+    get_option_value($db, $prefix, 'bitnami_project_provisioned') === $digest) {
+    $db->close();
+    echo('Your Wordpress installation is already configured.');
+    exit(0);
+}
+
+mysqli_report(MYSQLI_REPORT_OFF);
+define('WP_INSTALLING', true);
+if (!file_exists('/app/current/wp-config.php')) {
+    require_once('/app/current/wp-includes/functions.php');
+}
+require_once('/app/current/wp-config.php');
+require_once('/app/current/wp-admin/upgrade-functions.php');
+
+if (!is_blog_installed()) {
+    wp_install($settings['title'], $settings['user'], $settings['email'], 1);
+}
+
+// Hashed once, the seeded users share the password of the admin
+$password = wp_hash_password($settings['password']);
+list($local, $domain) = explode('@', $settings['email'], 2);
+
+mysqli_report($strict);
+$db->begin_transaction();
+try {
+    $stmt = $db->prepare("UPDATE {$prefix}users SET user_pass = ?, user_email = ? WHERE ID = 1");
+    $stmt->bind_param('ss', $password, $settings['email']);
+    $stmt->execute();
+    $stmt->close();
 
-    $weblog_title = stripslashes("My Bitnami Project");
-    $admin_email = stripslashes("bouchard.louis@gmail.com");
-    $user = stripslashes('caribou');
-    $result = wp_install($weblog_title,$user,$admin_email,1);
-    extract($result, EXTR_SKIP);
+    $options = array(
+        'siteurl' => $settings['url'],
+        'home' => $settings['url'],
+        'blogname' => $settings['title'],
+        'admin_email' => $settings['email'],
+    );
+    $stmt = $db->prepare("INSERT INTO {$prefix}options (option_name, option_value, autoload) VALUES (?, ?, 'yes') ON DUPLICATE KEY UPDATE option_value = VALUES(option_value)");
+    $stmt->bind_param('ss', $name, $value);
+    foreach ($options as $name => $value) {
+        $stmt->execute();
+    }
+    $stmt->close();
 
+    // One statement of each kind executed for every user, the commit
+    // writes them all at once
+    $find = $db->prepare("SELECT ID FROM {$prefix}users WHERE user_login = ?");
+    $find->bind_param('s', $login);
+    $find->bind_result($id);
+    $insert = $db->prepare("INSERT INTO {$prefix}users (user_login, user_pass, user_nicename, user_email, user_registered, display_name) VALUES (?, ?, ?, ?, UTC_TIMESTAMP(), ?)");
+    $insert->bind_param('sssss', $login, $password, $login, $email, $login);
+    $meta = $db->prepare("INSERT INTO {$prefix}usermeta (user_id, meta_key, meta_value) VALUES (?, ?, ?)");
+    $meta->bind_param('iss', $user_id, $key, $meta_value);
+    for ($i = 1; $i <= $settings['seed_users']; $i++) {
+        $login = sprintf('%s%d', $settings['user'], $i);
+        $email = sprintf('%s+%d@%s', $local, $i, $domain);
+        $find->execute();
+        $find->store_result();
+        $exists = $find->fetch();
+        $find->free_result();
+        if ($exists) {
+            continue;
+        }
+        $insert->execute();
+        $user_id = $db->insert_id;
+        foreach (array("{$prefix}capabilities" => serialize(array('subscriber' => true)),
+                       "{$prefix}user_level" => '0') as $key => $meta_value) {
+            $meta->execute();
+        }
+    }
+    $find->close();
+    $insert->close();
+    $meta->close();
+    $db->commit();
+}
+catch (mysqli_sql_exception $e) {
+    $db->rollback();
+    echo('Provisioning failed : ' . $e->getMessage());
+    exit(1);
+}
 
-    ((bool)mysqli_query($db, "USE " . wordpress));
-    mysqli_query($GLOBALS["___mysqli_ston"], "UPDATE wp_users SET user_pass = MD5('caribou') WHERE wp_users.ID=1 LIMIT 1");
-    mysqli_query($GLOBALS["___mysqli_ston"], "UPDATE wp_options SET option_value = 'http://wordpress.example.com' WHERE wp_options.option_name = 'siteurl'");
-    mysqli_query($GLOBALS["___mysqli_ston"], "UPDATE wp_options SET option_value = 'http://wordpress.example.com' WHERE wp_options.option_name = 'home'");
+// Creating a site creates its tables, which cannot be part of the
+// transaction
+mysqli_report(MYSQLI_REPORT_OFF);
+if ($network && $settings['seed_sites'] > 0) {
+    $network_id = get_current_network_id();
+    for ($i = 1; $i <= $settings['seed_sites']; $i++) {
+        if ($settings['subdomain']) {
+            $site_domain = sprintf('site%d.%s', $i, $settings['domain']);
+            $site_path = '/';
+        }
+        else {
+            $site_domain = $settings['domain'];
+            $site_path = sprintf('/site%d/', $i);
+        }
+        if (!domain_exists($site_domain, $site_path, $network_id)) {
+            wpmu_create_blog($site_domain, $site_path,
+                             sprintf('%s %d', $settings['title'], $i), 1,
+                             array('public' => 1), $network_id);
+        }
+    }
+}
 
-    ((is_null($___mysqli_res = mysqli_close($db))) ? false : $___mysqli_res);
-    echo('Your Wordpress installation is now configured.');
+// Indexes missing from the WordPress schema, added to the tables of
+// every site once they all exist. Altering a table commits, they stay
+// out of the transaction
+mysqli_report($strict);
+try {
+    $result = $db->query('SELECT table_name FROM information_schema.tables WHERE table_schema = DATABASE()');
+    $tables = array();
+    while ($row = $result->fetch_row()) {
+        $tables[] = $row[0];
+    }
+    $result->free();
+    $find = $db->prepare('SELECT COUNT(*) FROM information_schema.statistics WHERE table_schema = DATABASE() AND table_name = ? AND index_name = ?');
+    $find->bind_param('ss', $table, $index);
+    $find->bind_result($count);
+    foreach ($tables as $table) {
+        if (!preg_match('/^' . preg_quote($prefix, '/') . '(\\d+_)?(\\w+)$/', $table, $match) ||
+            !isset($settings['indexes'][$match[2]])) {
+            continue;
+        }
+        foreach ($settings['indexes'][$match[2]] as $index => $columns) {
+            $find->execute();
+            $find->store_result();
+            $find->fetch();
+            $find->free_result();
+            if ($count == 0) {
+                $db->query("ALTER TABLE `{$table}` ADD INDEX `{$index}` ({$columns})");
+            }
+        }
+    }
+    $find->close();
 }
-else {
-    die('Connection failed. Make sure that the database server is running.');
+catch (mysqli_sql_exception $e) {
+    echo('Indexing failed : ' . $e->getMessage());
+    exit(1);
 }
+
+$stmt = $db->prepare("INSERT INTO {$prefix}options (option_name, option_value, autoload) VALUES ('bitnami_project_provisioned', ?, 'no') ON DUPLICATE KEY UPDATE option_value = VALUES(option_value)");
+$stmt->bind_param('s', $digest);
+$stmt->execute();
+$stmt->close();
+$db->close();
+echo('Your Wordpress installation is now configured.');
\ No newline at end of file